@@ -0,0 +1,413 @@
+"""
+Background analysis jobs for MusicAI
+Library-sized analyses (liked songs, albums, playlists, recently played) run as jobs instead of inside the
+HTTP request. The route answers straight away with a job id, the page polls the job's progress (songs done,
+cached vs fresh, ETA) and renders the finished result, which is kept with the job.
+
+Jobs live in the durable work queue (work_queue.py) split into tasks: a prepare task lists the songs, one task
+per song analyzes it, and a finish task builds the result once every song is through. Workers (worker.py, or
+threads inside the web app) lease those tasks, so a job interrupted by a restart resumes at the songs it had not
+analyzed yet, and a song analyzed once stays in the stage cache.
+
+Each finished song task keeps a short summary of the song (audio features, emotions), so the page can also
+follow a job as a server-sent event stream (JobManager.events) and fill in song by song with running averages.
+Songs the job's result already has (members of the user's kept group aggregate) get no song task, the prepare
+task keeps their summaries and progress and the event stream count them as cached.
+Finished songs are written out and marked done within ANALYSIS_WORKER_REPORT_SECONDS, in small groups.
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+
+import group_aggregates
+import work_queue
+
+QUEUED = work_queue.QUEUED
+RUNNING = work_queue.RUNNING
+DONE = work_queue.DONE
+FAILED = work_queue.FAILED
+
+# task kinds
+PREPARE = 'prepare'
+SONG = 'song'
+FINISH = 'finish'
+
+# seconds a finished job's result can still be opened
+RESULT_TTL = float(os.getenv('ANALYSIS_RESULT_TTL_SECONDS', '86400'))
+
+# song tasks a worker leases at once (run together through the analysis pipeline), and seconds between polls when idle
+WORKER_BATCH = int(os.getenv('ANALYSIS_WORKER_BATCH', '32'))
+WORKER_POLL_SECONDS = 1.0
+# a finished song is marked done (and streamed) at most this many seconds later, with the songs finished meanwhile
+WORKER_REPORT_SECONDS = float(os.getenv('ANALYSIS_WORKER_REPORT_SECONDS', '1.0'))
+
+# event streams look for newly finished songs this often, and send a comment when nothing happened for a while
+STREAM_POLL_SECONDS = 1.0
+STREAM_KEEPALIVE_SECONDS = 15.0
+
+# audio features averaged over a group
+AGGREGATE_FEATURES = group_aggregates.FEATURES
+
+
+class JobManager:
+    """The web app's side: queue jobs and read their progress and results"""
+
+    def __init__(self, queue, result_ttl=RESULT_TTL):
+        self.queue = queue
+        self.result_ttl = result_ttl
+
+    def submit(self, owner, kind, params):
+        """Queue a job, or hand back the id of the owner's unfinished job of the same kind"""
+        job_id = self.queue.active_job(owner, kind)
+        if job_id is not None:
+            return job_id
+        self.queue.purge(time.time() - self.result_ttl)
+        return self.queue.create_job(owner, kind, params, [(PREPARE, {})])
+
+    def _job(self, job_id, owner):
+        job = self.queue.job(job_id)
+        if job is None or job['owner'] != owner:
+            return None
+        if job['finished_at'] and job['finished_at'] < time.time() - self.result_ttl:
+            return None
+        return job
+
+    def status(self, job_id, owner):
+        """Progress of one of the owner's jobs, None for unknown ids and other users' jobs"""
+        job = self._job(job_id, owner)
+        if job is None:
+            return None
+        statuses, results = self.queue.task_counts(job_id, SONG)
+        known = len(self._known(job_id) or ())
+        total = sum(statuses.values())
+        done = statuses.get(DONE, 0) + statuses.get(FAILED, 0)
+        elapsed = (job['finished_at'] or time.time()) - job['started_at'] if job['started_at'] else 0.0
+        # only song tasks take time, known songs are not part of the estimate
+        eta = None
+        if done and total > done:
+            eta = round(elapsed / done * (total - done), 1)
+        elif (total or known) and done >= total:
+            eta = 0.0
+        status = {
+            'id': job_id,
+            'kind': job['kind'],
+            'status': job['status'],
+            'error': job['error'],
+            'created_at': job['created_at'],
+            'finished_at': job['finished_at'],
+            'progress': {
+                'total': total + known,
+                'done': done + known,
+                'cached': results.get('cached', 0) + known,
+                'fresh': results.get('fresh', 0),
+                'failed': statuses.get(FAILED, 0),
+                'elapsed': round(elapsed, 1),
+                'eta_seconds': eta,
+            },
+        }
+        if job['status'] == QUEUED:
+            status['position'] = self.queue.queued_before(job_id)
+        return status
+
+    def _known(self, job_id):
+        """Summaries of the songs that got no song task, None until the prepare task is done"""
+        for task in self.queue.finished(job_id, PREPARE):
+            if task['status'] == DONE:
+                return (task['detail'] or {}).get('known', [])
+        return None
+
+    def result(self, job_id, owner):
+        job = self._job(job_id, owner)
+        if job is None or job['status'] != DONE:
+            return None
+        return job['result']
+
+    def events(self, job_id, owner, after=0, poll=STREAM_POLL_SECONDS, keepalive=STREAM_KEEPALIVE_SECONDS):
+        """Server-sent events for one of the owner's jobs, until it is done or failed
+
+        A `song` event (id = the song's place in the stream) per finished song with the running aggregate,
+        the songs known at prepare time first, then song tasks in finishing order. `progress` when the counts
+        change, then `done` or `failed`. Songs up to `after` (Last-Event-ID of a reconnecting client) are not
+        sent again but still count in the aggregate.
+        """
+        aggregate = RunningAggregate()
+        known = None
+        cursor = 0
+        sent = 0
+        last_progress = None
+        last_sent = time.time()
+        # browsers reconnect after 3s if the stream drops, sending the last song id they saw
+        yield "retry: 3000\n\n"
+        while True:
+            # status first: once it says done, every song task is already finished
+            status = self.status(job_id, owner)
+            if status is None:
+                yield _sse('failed', {'error': 'unknown job'})
+                return
+            if known is None:
+                known = self._known(job_id)
+                songs = [(song, 'cached') for song in known or ()]
+            else:
+                songs = []
+            # song tasks only once the known songs are out, so every stream lists the songs in the same order
+            if known is not None:
+                for task in self.queue.finished(job_id, SONG, cursor):
+                    cursor = task['seq']
+                    songs.append((task['detail'], task['result'] or task['status']))
+            for song, source in songs:
+                sent += 1
+                aggregate.add(song)
+                if sent > after:
+                    yield _sse('song', {'song': song, 'source': source, 'aggregate': aggregate.snapshot()}, sent)
+                    last_sent = time.time()
+            if status['status'] in (DONE, FAILED):
+                yield _sse(status['status'], status)
+                return
+            progress = (status['status'], status.get('position'), status['progress']['total'], status['progress']['done'])
+            if progress != last_progress:
+                last_progress = progress
+                yield _sse('progress', status)
+                last_sent = time.time()
+            elif time.time() - last_sent >= keepalive:
+                # keeps proxies from closing a quiet stream
+                yield ": keepalive\n\n"
+                last_sent = time.time()
+            time.sleep(poll)
+
+    def stats(self):
+        return self.queue.stats()
+
+
+class RunningAggregate:
+    """Group averages over the songs seen so far: audio features, and emotions of the songs with lyrics"""
+
+    def __init__(self):
+        self.songs = 0
+        self.lyric_songs = 0
+        self.sums = dict.fromkeys(AGGREGATE_FEATURES, 0.0)
+        self.counts = dict.fromkeys(AGGREGATE_FEATURES, 0)
+        self.emotions = {}
+
+    def add(self, song):
+        if song is None:
+            return
+        self.songs += 1
+        for key, value in song.get('features', {}).items():
+            if key in self.sums and isinstance(value, (int, float)):
+                self.sums[key] += value
+                self.counts[key] += 1
+        if song.get('emotion'):
+            self.lyric_songs += 1
+            for emotion, value in song['emotion'].items():
+                self.emotions[emotion] = self.emotions.get(emotion, 0.0) + value
+
+    def snapshot(self):
+        return {
+            'songs': self.songs,
+            'lyric_songs': self.lyric_songs,
+            'features': {key: self.sums[key] / self.counts[key] for key in AGGREGATE_FEATURES if self.counts[key]},
+            'emotions': {emotion: total / self.lyric_songs for emotion, total in self.emotions.items()},
+        }
+
+
+def _sse(event, data, event_id=None):
+    lines = [f"event: {event}"]
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"data: {json.dumps(data)}")
+    return '\n'.join(lines) + '\n\n'
+
+
+class Worker:
+    """Leases tasks from the queue and runs them
+
+    token(params) -> spotify token for the job, list_songs(kind, token, params) -> song ids,
+    known(kind, token, params, song_ids) -> {song id: detail} of the songs the job's result already has, they get
+    no song task (leave it out to analyze every song),
+    analyze(token, song_ids, on_song) calls on_song(index, cached, detail) as each song is analyzed
+    (detail: the song's summary for the event stream, see RunningAggregate.add),
+    finish(kind, token, params) -> the job's result, flush() makes the analyzed songs durable (before each group
+    of finished song tasks is marked done, see report_seconds). metrics() -> the process's cache_metrics snapshot,
+    published to the queue after every batch and heartbeat; leave it out for workers inside the web app.
+    """
+
+    def __init__(self, queue, token, list_songs, analyze, finish, flush=None, metrics=None, known=None,
+                 name=None, batch=WORKER_BATCH, visibility=work_queue.VISIBILITY_TIMEOUT, poll=WORKER_POLL_SECONDS,
+                 report_seconds=WORKER_REPORT_SECONDS):
+        self.queue = queue
+        self.token = token
+        self.list_songs = list_songs
+        self.analyze = analyze
+        self.finish = finish
+        self.flush = flush
+        self.metrics = metrics
+        self.known = known
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}:{id(self):x}"
+        self.batch = batch
+        self.visibility = visibility
+        self.poll = poll
+        self.report_seconds = report_seconds
+        self.stopped = threading.Event()
+        self._held = set()
+        self._held_lock = threading.Lock()
+
+    def start(self):
+        """Work on background threads (the web app), returns self"""
+        threading.Thread(target=self.run, name="analysis-worker", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        heartbeat = threading.Thread(target=self._heartbeat, name="analysis-worker-heartbeat", daemon=True)
+        heartbeat.start()
+        while not self.stopped.is_set():
+            try:
+                if not self.run_once():
+                    self.stopped.wait(self.poll)
+            except Exception as e:
+                # the queue itself failed (disk, lock timeout), leases run out and the tasks come back
+                print(f"ERROR: analysis worker {self.name}: {e}")
+                self.stopped.wait(self.poll)
+
+    def _heartbeat(self):
+        while not self.stopped.wait(self.visibility / 3):
+            with self._held_lock:
+                held = list(self._held)
+            try:
+                self.queue.extend(held, self.name, self.visibility)
+            except Exception as e:
+                print(f"ERROR: analysis worker {self.name} could not extend its leases: {e}")
+            self._publish_metrics()
+
+    def _publish_metrics(self):
+        if self.metrics is None:
+            return
+        try:
+            self.queue.put_worker_metrics(self.name, self.metrics())
+        except Exception as e:
+            print(f"ERROR: analysis worker {self.name} could not publish its metrics: {e}")
+
+    def run_once(self):
+        """Lease and run one batch of tasks, returns how many there were"""
+        tasks = self.queue.lease(self.name, self.batch, self.visibility)
+        if not tasks:
+            return 0
+        with self._held_lock:
+            self._held.update(task['id'] for task in tasks)
+        try:
+            jobs = {}
+            for task in tasks:
+                if task.get('expired'):
+                    # every try so far outlived its lease (killed or hung the worker), it is not run again
+                    self._failed(task, RuntimeError(f"lease ran out {task['attempts']} times"))
+                    continue
+                jobs.setdefault(task['job_id'], []).append(task)
+            for job_id, job_tasks in jobs.items():
+                self._run_job_tasks(job_id, job_tasks)
+            if self.flush is not None:
+                self.flush()
+        finally:
+            with self._held_lock:
+                self._held.difference_update(task['id'] for task in tasks)
+        self._publish_metrics()
+        return len(tasks)
+
+    def _run_job_tasks(self, job_id, tasks):
+        job = self.queue.job(job_id)
+        songs = [task for task in tasks if task['kind'] == SONG]
+        try:
+            token = self.token(job['params'])
+            if not token:
+                raise ValueError("no spotify token for the job")
+        except Exception as e:
+            for task in tasks:
+                self._failed(task, e)
+            return
+
+        if songs:
+            self._run_songs(token, songs)
+        for task in tasks:
+            if task['kind'] == PREPARE:
+                self._run_step(task, lambda: self._prepare(job, token))
+            elif task['kind'] == FINISH:
+                self._run_step(task, lambda: self.queue.finish_job(job_id, self.finish(job['kind'], token, job['params'])))
+
+    def _prepare(self, job, token):
+        song_ids = list(dict.fromkeys(song_id for song_id in self.list_songs(job['kind'], token, job['params']) if song_id))
+        known = self.known(job['kind'], token, job['params'], song_ids) if self.known is not None and song_ids else {}
+        fresh = [song_id for song_id in song_ids if song_id not in known]
+        if fresh:
+            self.queue.add_tasks(job['id'], [(SONG, {'id': song_id}) for song_id in fresh])
+        else:
+            self.queue.add_tasks(job['id'], [(FINISH, {})])
+        # kept with the prepare task for the job's progress and event stream
+        return {'known': [known[song_id] for song_id in song_ids if song_id in known]}
+
+    def _run_step(self, task, step):
+        try:
+            detail = step()
+        except Exception as e:
+            self._failed(task, e)
+            return
+        self.queue.complete(task['id'], detail=detail, worker=self.name)
+
+    def _run_songs(self, token, tasks):
+        finished = set()
+        unreported = []
+        lock = threading.Lock()
+        timer = None
+
+        def report():
+            nonlocal timer
+            with lock:
+                group = list(unreported)
+                unreported.clear()
+                timer = None
+            if not group:
+                return
+            try:
+                # the group's stages are written out just before its tasks are done, a restart never loses paid work
+                if self.flush is not None:
+                    self.flush()
+                self.queue.complete_many(group, then=(FINISH, {}), worker=self.name)
+            except Exception as e:
+                # left leased, the tasks come back once their lease runs out
+                print(f"ERROR: analysis worker {self.name} could not report {len(group)} finished song(s): {e}")
+
+        def on_song(index, cached, detail=None):
+            # songs finishing close together are reported together, none waits longer than report_seconds
+            nonlocal timer
+            with lock:
+                finished.add(index)
+                unreported.append((tasks[index]['id'], 'cached' if cached else 'fresh', detail))
+                if timer is None:
+                    timer = threading.Timer(self.report_seconds, report)
+                    timer.daemon = True
+                    timer.start()
+
+        error = None
+        try:
+            self.analyze(token, [task['payload']['id'] for task in tasks], on_song)
+        except Exception as e:
+            error = e
+        with lock:
+            pending = timer
+        if pending is not None:
+            pending.cancel()
+            pending.join()
+        report()
+        for index, task in enumerate(tasks):
+            if index not in finished:
+                self._failed(task, error or RuntimeError("song was not analyzed"))
+
+    def _failed(self, task, error):
+        message = str(error) or error.__class__.__name__
+        retried = self.queue.retry(task['id'], message, then=(FINISH, {}) if task['kind'] == SONG else None, worker=self.name)
+        print(f"ERROR: {task['kind']} task {task['id']} of job {task['job_id']} failed (attempt {task['attempts']}): {message}")
+        if not retried and task['kind'] != SONG:
+            self.queue.fail_job(task['job_id'], message)
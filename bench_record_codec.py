@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Benchmark: plain json rows vs record_codec for cached song records
+Reports stored size and decode time per stage entry
+Usage: python bench_record_codec.py
+"""
+
+import json
+import time
+import random
+import string
+import statistics
+
+import record_codec
+
+
+def words(n, length=6):
+    return [''.join(random.choices(string.ascii_lowercase, k=length)) for _ in range(n)]
+
+
+def sample_entries():
+    """One entry per stage, shaped like what the analysis pipeline stores"""
+    vocab = words(120)
+    lyrics = [' '.join(random.choices(vocab, k=8)).capitalize() for _ in range(70)]
+    keywords = random.choices(vocab, k=30)
+    song_id = ''.join(random.choices(string.ascii_letters + string.digits, k=22))
+
+    features = {
+        'danceability': 0.735, 'energy': 0.578, 'key': 5, 'loudness': -11.84, 'mode': 0,
+        'speechiness': 0.0461, 'acousticness': 0.514, 'instrumentalness': 0.0902, 'liveness': 0.159,
+        'valence': 0.636, 'tempo': 98.002, 'type': 'audio_features', 'id': song_id,
+        'uri': f"spotify:track:{song_id}",
+        'track_href': f"https://api.spotify.com/v1/tracks/{song_id}",
+        'analysis_url': f"https://api.spotify.com/v1/audio-analysis/{song_id}",
+        'duration_ms': 255349, 'time_signature': 4,
+    }
+    model = {
+        'overall_emotion': {'anger': 0.1, 'disgust': 0.05, 'fear': 0.2, 'joy': 0.4, 'sadness': 0.3},
+        'relations': [['Person', w] for w in keywords[:10]],
+        'sentiment': 'positive',
+        'entities': [[w, 'Person', 'neutral'] for w in keywords[:6]],
+        'keywords': [[w, random.choice(['positive', 'negative', 'neutral'])] for w in keywords],
+        'subjects': [[w, random.choice(['past', 'present', 'future'])] for w in random.choices(vocab, k=40)],
+        'concepts': [f"/art and entertainment/music/{w}" for w in keywords[:8]],
+    }
+    nlu = {
+        'averageEmotion': {'Anger': 0.1, 'Disgust': 0.05, 'Fear': 0.2, 'Joy': 0.4, 'Sadness': 0.3},
+        'relationsfrequencies': {'Person': keywords[:10]},
+        'sentiment_frequencies': {'positive': 1},
+        'entityfrequencies': {'neutral': [[w, 'Person'] for w in keywords[:6]]},
+        'keywordfrequencies': {'positive': keywords[:15], 'negative': keywords[15:]},
+        'conceptfrequencies': {'art and entertainment': ['music'] + keywords[:8]},
+        'subjectsfrequencies': {'present': random.choices(vocab, k=25), 'past': random.choices(vocab, k=15)},
+    }
+
+    def envelope(stage, data):
+        return {'stage': stage, 'v': 1, 'versions': {stage: 1}, 'at': time.time(), 'data': data}
+
+    return {
+        'audio_features': envelope('audio_features', features),
+        'lyrics': envelope('lyrics', lyrics),
+        'watson': envelope('watson', model),
+        'nlu': envelope('nlu', nlu),
+        'genius miss': {'stage': 'genius_url', 'v': 1, 'versions': {'genius_url': 1, 'track': 1},
+                        'at': time.time(), 'neg': 'no_hit', 'expires_at': time.time() + 3600},
+    }
+
+
+def decode_us(fn, blob, rounds=2000):
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn(blob)
+        times.append((time.perf_counter() - start) * 1e6)
+    return statistics.median(times)
+
+
+def main():
+    payload_format = 'msgpack' if record_codec.msgpack is not None else 'json'
+    print(f"record_codec payload format: {payload_format} + zlib\n")
+    print(f"{'entry':>14} | {'json bytes':>10} | {'codec bytes':>11} | {'ratio':>5} | "
+          f"{'json decode':>11} | {'codec decode':>12} | {'header only':>11}")
+
+    totals = [0, 0]
+    for name, entry in sample_entries().items():
+        as_json = json.dumps(entry)
+        as_codec = record_codec.encode(entry)
+        assert record_codec.decode(as_codec) == json.loads(as_json)
+        totals[0] += len(as_json)
+        totals[1] += len(as_codec)
+
+        print(f"{name:>14} | {len(as_json):>10} | {len(as_codec):>11} | {len(as_codec) / len(as_json):>5.2f} | "
+              f"{decode_us(json.loads, as_json):>8.1f} us | {decode_us(record_codec.decode, as_codec):>9.1f} us | "
+              f"{decode_us(record_codec.decode_header, as_codec):>8.1f} us")
+    print(f"{'total':>14} | {totals[0]:>10} | {totals[1]:>11} | {totals[1] / totals[0]:>5.2f} |")
+
+
+if __name__ == "__main__":
+    random.seed(7)
+    main()
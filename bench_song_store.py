@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Benchmark: whole-file song_db.json vs the SQLite song store
+Measures lookup and insert latency at 1k, 10k and 100k cached songs
+Usage: python bench_song_store.py [sizes...]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import string
+import tempfile
+import statistics
+
+import song_store
+
+
+def fake_record(song_id):
+    """Roughly the shape of a real analysis record (audio features + ai)"""
+    words = [''.join(random.choices(string.ascii_lowercase, k=6)) for _ in range(40)]
+    return {
+        'id': song_id,
+        'danceability': random.random(),
+        'energy': random.random(),
+        'tempo': random.uniform(60, 180),
+        'duration_ms': random.randint(90000, 400000),
+        'song_title': song_id,
+        'artist_name': 'bench',
+        'ai': {
+            'lyrics': [' '.join(words[i:i + 8]) for i in range(0, 40, 8)],
+            'nlu': {'keywordfrequencies': {'positive': words[:5]}},
+        },
+    }
+
+
+def legacy_lookup(path, song_id):
+    # what _song_analysis_details used to do on every lookup
+    with open(path, 'r') as db:
+        loaded = json.load(db)
+        return loaded.get(song_id)
+
+
+def legacy_insert(path, song_id, record):
+    # ... and on every new song
+    with open(path, 'r') as db:
+        loaded = json.load(db)
+        loaded[song_id] = record
+    with open(path, 'w') as db:
+        db.write(json.dumps(loaded))
+
+
+def timed(fn, samples):
+    times = []
+    for args in samples:
+        start = time.perf_counter()
+        fn(*args)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def bench(size, workdir):
+    ids = [f"song{i:07d}" for i in range(size)]
+    records = {song_id: fake_record(song_id) for song_id in ids}
+
+    json_path = os.path.join(workdir, f"legacy_{size}.json")
+    with open(json_path, 'w') as f:
+        json.dump(records, f)
+
+    store = song_store.SQLiteSongStore(os.path.join(workdir, f"store_{size}.sqlite3"))
+    store.put_many(records)
+
+    # legacy ops get slow fast, keep their sample small
+    legacy_n = 20 if size <= 10000 else 3
+    lookups = [(random.choice(ids),) for _ in range(500)]
+    inserts = [(f"new{size}_{i}", fake_record('new')) for i in range(500)]
+
+    results = {
+        'json_lookup': timed(lambda k: legacy_lookup(json_path, k), lookups[:legacy_n]),
+        'json_insert': timed(lambda k, r: legacy_insert(json_path, k, r), inserts[:legacy_n]),
+        'sqlite_lookup': timed(store.get, lookups),
+        'sqlite_insert': timed(store.put, inserts),
+    }
+    store.close()
+    return results
+
+
+def main():
+    sizes = [int(s) for s in sys.argv[1:]] or [1000, 10000, 100000]
+    print(f"{'entries':>8} | {'json lookup':>12} | {'sqlite lookup':>13} | {'json insert':>12} | {'sqlite insert':>13}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in sizes:
+            r = bench(size, workdir)
+            print(f"{size:>8} | {r['json_lookup']:>9.2f} ms | {r['sqlite_lookup']:>10.3f} ms | "
+                  f"{r['json_insert']:>9.2f} ms | {r['sqlite_insert']:>10.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
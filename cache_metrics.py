@@ -0,0 +1,149 @@
+"""
+Cache metrics for MusicAI
+Per-stage hit/miss/negative-hit counters, coalesced misses, fill latency percentiles and the most expensive misses
+Counters live in the process that made them, worker processes publish theirs through the work queue (see combine).
+"""
+
+import heapq
+import math
+import threading
+import time
+from collections import deque
+
+# fill latencies kept per stage for the percentiles
+LATENCY_SAMPLES = 1000
+
+# per-stage counters, added up over processes by combine()
+COUNTERS = ('hits', 'misses', 'negative_hits', 'fills', 'coalesced')
+
+
+def percentile(values, q):
+    """q-th percentile (0-100) of values, nearest rank"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(q / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def _stage_snapshot(counts, p50_ms, p95_ms):
+    lookups = counts['hits'] + counts['misses'] + counts['negative_hits']
+    filled = counts['fills'] + counts['coalesced']
+    return {
+        'hits': counts['hits'],
+        'misses': counts['misses'],
+        'negative_hits': counts['negative_hits'],
+        'hit_ratio': counts['hits'] / lookups if lookups else 0.0,
+        'miss_ratio': counts['misses'] / lookups if lookups else 0.0,
+        'negative_hit_ratio': counts['negative_hits'] / lookups if lookups else 0.0,
+        'fills': counts['fills'],
+        # misses served by a fill already in flight for another caller, and their share of all misses filled
+        'coalesced': counts['coalesced'],
+        'coalesce_ratio': counts['coalesced'] / filled if filled else 0.0,
+        'fill_p50_ms': p50_ms,
+        'fill_p95_ms': p95_ms,
+    }
+
+
+class StageMetrics:
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.fills = 0
+        self.coalesced = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def snapshot(self):
+        p50 = percentile(self.latencies, 50)
+        p95 = percentile(self.latencies, 95)
+        return _stage_snapshot(
+            {counter: getattr(self, counter) for counter in COUNTERS},
+            round(p50 * 1000, 2) if p50 is not None else None,
+            round(p95 * 1000, 2) if p95 is not None else None,
+        )
+
+
+class CacheMetrics:
+    """Thread-safe metrics registry, one StageMetrics per stage"""
+
+    def __init__(self, top_n=20):
+        self.top_n = top_n
+        self.started_at = time.time()
+        self._stages = {}
+        self._expensive = []  # min-heap of (seconds, stage, key, at)
+        self._lock = threading.Lock()
+
+    def _stage(self, stage):
+        metrics = self._stages.get(stage)
+        if metrics is None:
+            metrics = self._stages[stage] = StageMetrics()
+        return metrics
+
+    def record_hit(self, stage):
+        with self._lock:
+            self._stage(stage).hits += 1
+
+    def record_negative_hit(self, stage):
+        with self._lock:
+            self._stage(stage).negative_hits += 1
+
+    def record_miss(self, stage):
+        with self._lock:
+            self._stage(stage).misses += 1
+
+    def record_coalesced(self, stage):
+        """A miss waited for another caller's fill instead of calling upstream itself"""
+        with self._lock:
+            self._stage(stage).coalesced += 1
+
+    def record_fill(self, stage, key, seconds):
+        """A miss was filled (upstream call) and took this long"""
+        with self._lock:
+            metrics = self._stage(stage)
+            metrics.fills += 1
+            metrics.latencies.append(seconds)
+
+            item = (seconds, stage, key, time.time())
+            if len(self._expensive) < self.top_n:
+                heapq.heappush(self._expensive, item)
+            elif seconds > self._expensive[0][0]:
+                heapq.heapreplace(self._expensive, item)
+
+    def snapshot(self, top=10):
+        with self._lock:
+            stages = {stage: metrics.snapshot() for stage, metrics in self._stages.items()}
+            expensive = sorted(self._expensive, reverse=True)[:top]
+        return {
+            'uptime_seconds': round(time.time() - self.started_at, 1),
+            'stages': stages,
+            'most_expensive_misses': [
+                {'stage': stage, 'key': key, 'fill_ms': round(seconds * 1000, 2), 'at': at}
+                for seconds, stage, key, at in expensive
+            ],
+        }
+
+
+def combine(snapshots, top=10):
+    """One snapshot over several processes' snapshots (the web app's and the worker processes')
+
+    Counters are added up and the ratios worked out again. Latency samples stay in their process,
+    so the percentiles are those of the slowest process. The uptime is the first snapshot's.
+    """
+    counts, p50s, p95s = {}, {}, {}
+    expensive = []
+    for snapshot in snapshots:
+        for stage, metrics in snapshot['stages'].items():
+            stage_counts = counts.setdefault(stage, dict.fromkeys(COUNTERS, 0))
+            for counter in COUNTERS:
+                stage_counts[counter] += metrics.get(counter, 0)
+            for latencies, key in ((p50s, 'fill_p50_ms'), (p95s, 'fill_p95_ms')):
+                if metrics.get(key) is not None:
+                    latencies[stage] = max(latencies.get(stage, 0.0), metrics[key])
+        expensive.extend(snapshot['most_expensive_misses'])
+    return {
+        'uptime_seconds': snapshots[0]['uptime_seconds'] if snapshots else 0.0,
+        'stages': {stage: _stage_snapshot(counts[stage], p50s.get(stage), p95s.get(stage)) for stage in counts},
+        'most_expensive_misses': sorted(expensive, key=lambda miss: miss['fill_ms'], reverse=True)[:top],
+    }
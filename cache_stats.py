@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Cache stats for MusicAI
+Entry count and bytes per cache stage, read straight from the song store.
+With --url the running app's /admin/cache-stats is asked as well for hit/miss/negative-hit
+ratios, p50/p95 fill latency and the most expensive misses since it started, added up over the web app
+and the worker.py processes. The other runtime numbers are the web app's own.
+
+Usage: python cache_stats.py [--url http://localhost:8080] [--token $ADMIN_TOKEN] [--top 10] [--json]
+"""
+
+import os
+import sys
+import json
+import argparse
+import urllib.request
+import urllib.error
+
+import song_store
+
+
+def fetch_runtime(url, token, top):
+    request = urllib.request.Request(
+        f"{url.rstrip('/')}/admin/cache-stats?top={top}",
+        headers={'X-Admin-Token': token or ''},
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.load(response)
+
+
+def _ratio(value):
+    return f"{value * 100:5.1f}%" if value is not None else "    -"
+
+
+def _ms(value):
+    return f"{value:8.1f}" if value is not None else "       -"
+
+
+def _size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.1f} {unit}" if unit != 'B' else f"{size} B"
+        size /= 1024.0
+
+
+def print_report(usage, runtime):
+    stages = dict((stage, dict(counts)) for stage, counts in usage.items())
+    if runtime:
+        for stage, metrics in runtime.get('stages', {}).items():
+            stages.setdefault(stage, {}).update({key: value for key, value in metrics.items() if key not in ('entries', 'bytes')})
+
+    print(f"{'stage':<16}{'entries':>9}{'bytes':>12}{'hit':>8}{'miss':>8}{'neg':>8}{'shared':>8}{'p50 ms':>9}{'p95 ms':>9}")
+    for stage in sorted(stages):
+        row = stages[stage]
+        print(
+            f"{stage:<16}{row.get('entries', 0):>9}{_size(row.get('bytes', 0)):>12}"
+            f"{_ratio(row.get('hit_ratio')):>8}{_ratio(row.get('miss_ratio')):>8}{_ratio(row.get('negative_hit_ratio')):>8}"
+            f"{_ratio(row.get('coalesce_ratio')):>8}"
+            f"{_ms(row.get('fill_p50_ms')):>9}{_ms(row.get('fill_p95_ms')):>9}"
+        )
+
+    if not runtime:
+        print("\n(ratios and latencies come from the running app, pass --url to include them)")
+        return
+
+    print(f"\n⏱  app up {runtime.get('uptime_seconds', 0) / 3600:.1f} h")
+    scope = runtime.get('scope')
+    if scope:
+        processes = scope['cache_metrics']
+        workers = f" + {len(processes) - 1} worker(s) ({', '.join(processes[1:])})" if len(processes) > 1 else " only"
+        print(f"📊 ratios, latencies and misses over: {processes[0]}{workers}; everything else: {scope['everything_else']}")
+    memory = runtime.get('memory_cache')
+    if memory:
+        print(f"🧠 memory tier: {memory['entries']} entries, {_size(memory['bytes'])} of {_size(memory['max_bytes'])}, "
+              f"hit ratio {memory['hit_ratio'] * 100:.1f}%, {memory['evictions']} evicted")
+    flights = runtime.get('single_flight')
+    if flights:
+        print(f"🤝 coalesced misses: {flights['coalesced']} served by {flights['leaders']} fills, {flights['in_flight']} in flight")
+    jobs = runtime.get('analysis_jobs')
+    if jobs:
+        counts = lambda states: ', '.join(f"{n} {state}" for state, n in sorted(states.items())) or 'none'
+        print(f"📋 analysis jobs: {counts(jobs['jobs'])} | tasks: {counts(jobs['tasks'])} | "
+              f"oldest ready {jobs['oldest_ready_seconds']}s, {jobs['expired_leases']} expired lease(s)")
+    dead_ends = runtime.get('dead_ends')
+    if dead_ends:
+        print(f"🚫 dead ends: {dead_ends}")
+
+    pools = runtime.get('http_pools')
+    if pools:
+        print("\n🔌 upstream connections:")
+        for host, counts in sorted(pools.items()):
+            print(f"   {host:<24}{counts['requests']:>7} requests {counts['connections']:>5} opened "
+                  f"{counts['reuse_ratio'] * 100:5.1f}% reused {counts['errors']:>4} errors")
+
+    stages = runtime.get('pipeline')
+    if stages:
+        print("\n🚰 analysis pipeline:")
+        for name, stage in stages.items():
+            capacity = f"{stage['capacity_per_second']:.1f}/s" if stage['capacity_per_second'] is not None else '-'
+            print(f"   {name:<10}{stage['workers']:>3} workers {stage['queued']:>4} queued (max {stage['max_queued']}) "
+                  f"{stage['processed']:>7} done {stage['errors']:>4} errors {_ms(stage['avg_ms'])} ms avg  capacity {capacity}")
+
+    breakers = runtime.get('breakers')
+    if breakers:
+        print("\n🔁 circuit breakers:")
+        for name, breaker in sorted(breakers.items()):
+            retry = f", next try in {breaker['retry_in']:.0f}s" if breaker['state'] == 'open' else ''
+            print(f"   {name:<24}{breaker['state']:>10} {breaker['recent_failures']:>3}/{breaker['recent_calls']:<3} recent failures "
+                  f"{breaker['opened']:>4} opened {breaker['refused']:>6} refused{retry}")
+
+    misses = runtime.get('most_expensive_misses', [])
+    if misses:
+        print("\n💸 most expensive misses:")
+        for miss in misses:
+            print(f"   {miss['fill_ms']:>9.1f} ms  {miss['stage']:<16}{miss['key']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-stage song cache statistics")
+    parser.add_argument('--url', help="base url of a running app, adds runtime ratios and latencies")
+    parser.add_argument('--token', default=os.getenv('ADMIN_TOKEN'), help="admin token (default $ADMIN_TOKEN)")
+    parser.add_argument('--top', type=int, default=10, help="how many expensive misses to list")
+    parser.add_argument('--json', action='store_true', help="print raw json instead of a table")
+    args = parser.parse_args()
+
+    store = song_store.open_song_store()
+    try:
+        usage = store.usage()
+    finally:
+        store.close()
+
+    runtime = None
+    if args.url:
+        try:
+            runtime = fetch_runtime(args.url, args.token, args.top)
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            print(f"❌ Could not read {args.url}/admin/cache-stats: {e}")
+            return 1
+
+    if args.json:
+        print(json.dumps({'usage': usage, 'runtime': runtime}, indent=2))
+    else:
+        print_report(usage, runtime)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
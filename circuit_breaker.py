@@ -0,0 +1,186 @@
+"""
+Circuit breakers for MusicAI's upstreams (Spotify, Genius search, genius.com pages, Watson, Imgflip)
+A breaker opens once too many of its recent calls failed or were too slow. While it is open calls are
+refused straight away instead of each waiting out a timeout; after a cool-down one probe call is let
+through (half-open) and its outcome closes or re-opens the breaker.
+Stages skipped this way are noted per thread so a song's result can be marked as degraded.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# recent calls looked at, and how many are needed before the breaker may open
+WINDOW = 20
+MIN_CALLS = 8
+FAILURE_RATIO = float(os.getenv('CIRCUIT_FAILURE_RATIO', '0.5'))
+# seconds the breaker stays open before a probe is let through
+OPEN_SECONDS = float(os.getenv('CIRCUIT_OPEN_SECONDS', '30'))
+# a call slower than this counts as a failure
+SLOW_SECONDS = float(os.getenv('CIRCUIT_SLOW_SECONDS', '8'))
+SLOW_SECONDS_BY_NAME = {
+    'watson': 20.0,
+}
+
+# names shown to users when a result is degraded
+LABELS = {
+    'api.spotify.com': 'Spotify',
+    'api.genius.com': 'Genius search',
+    'genius.com': 'Genius lyrics',
+    'watson': 'Watson',
+    'api.imgflip.com': 'Imgflip',
+}
+
+
+class CircuitOpen(Exception):
+    """Call refused, the upstream's breaker is open"""
+
+    def __init__(self, name, retry_in=0.0):
+        super().__init__(f"{name} is unavailable (circuit open, next try in {retry_in:.0f}s)")
+        self.name = name
+        self.retry_in = retry_in
+
+
+_skipped = threading.local()
+
+
+def reset_skipped():
+    """Start noting skipped upstreams for the current thread (one song analysis)"""
+    _skipped.names = set()
+
+
+def skipped():
+    """Upstreams refused on this thread since reset_skipped()"""
+    return sorted(getattr(_skipped, 'names', ()))
+
+
+def _note_skip(name):
+    names = getattr(_skipped, 'names', None)
+    if names is not None:
+        names.add(name)
+
+
+class CircuitBreaker:
+
+    def __init__(self, name, window=WINDOW, min_calls=MIN_CALLS, failure_ratio=FAILURE_RATIO,
+                 open_seconds=OPEN_SECONDS, slow_seconds=None):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.open_seconds = open_seconds
+        self.slow_seconds = slow_seconds if slow_seconds is not None else SLOW_SECONDS_BY_NAME.get(name, SLOW_SECONDS)
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.refused = 0
+        self.opened = 0
+        self._outcomes = deque(maxlen=window)
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """True if a call may go ahead now (in half-open state only one probe at a time)"""
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.open_seconds:
+                self.state = HALF_OPEN
+                self._probing = False
+            if self.state == CLOSED or (self.state == HALF_OPEN and not self._probing):
+                if self.state == HALF_OPEN:
+                    self._probing = True
+                return True
+            self.refused += 1
+        _note_skip(self.name)
+        return False
+
+    def check(self):
+        """allow(), raising CircuitOpen when refused"""
+        if not self.allow():
+            raise CircuitOpen(self.name, self.retry_in())
+
+    def record(self, ok, seconds=0.0):
+        ok = ok and seconds <= self.slow_seconds
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probing = False
+                if ok:
+                    self.state = CLOSED
+                    self._outcomes.clear()
+                else:
+                    self._open()
+                return
+            self._outcomes.append(ok)
+            failures = self._outcomes.count(False)
+            if self.state == CLOSED and len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.failure_ratio:
+                self._open()
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.opened += 1
+        print(f"WARNING: {self.name} circuit opened, calls are skipped for {self.open_seconds:.0f}s")
+
+    def reset(self):
+        """Back to closed with no recorded calls, the refused/opened counters are kept"""
+        with self._lock:
+            self.state = CLOSED
+            self._outcomes.clear()
+            self._probing = False
+
+    def retry_in(self):
+        with self._lock:
+            if self.state != OPEN:
+                return 0.0
+            return max(0.0, self.open_seconds - (time.monotonic() - self.opened_at))
+
+    @contextmanager
+    def guard(self, is_failure=lambda error: True):
+        """Run the with-block through the breaker, exceptions for which is_failure() is true count as failures"""
+        self.check()
+        started = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            self.record(not is_failure(e), time.monotonic() - started)
+            raise
+        self.record(True, time.monotonic() - started)
+
+    def snapshot(self):
+        with self._lock:
+            outcomes = list(self._outcomes)
+            state = self.state
+        return {
+            'state': state,
+            'recent_calls': len(outcomes),
+            'recent_failures': outcomes.count(False),
+            'opened': self.opened,
+            'refused': self.refused,
+            'retry_in': round(self.retry_in(), 1),
+        }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker(name):
+    """The process wide breaker for an upstream (host name, or 'watson')"""
+    with _breakers_lock:
+        found = _breakers.get(name)
+        if found is None:
+            found = _breakers[name] = CircuitBreaker(name)
+        return found
+
+
+def snapshot():
+    with _breakers_lock:
+        breakers = dict(_breakers)
+    return {name: found.snapshot() for name, found in sorted(breakers.items())}
+
+
+def labels(names):
+    return [LABELS.get(name, name) for name in names]
@@ -0,0 +1,98 @@
+"""
+Concurrent fan-out for MusicAI
+Runs blocking jobs (spotify_api, http_client, the stage cache, the Watson SDK) from asyncio: each job runs on
+a worker thread and the loop only schedules them, at most `workers` at a time. How many calls reach one
+upstream host at a time is capped by http_client.host_slot.
+gather/run fan one call out over a list of items. Loop keeps one asyncio loop running on a daemon thread for
+fan-outs that outlive a single call, the staged song pipeline (pipeline.py) runs its stages on one.
+"""
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# jobs in flight at once when the caller does not say
+WORKERS = 16
+
+
+async def gather(func, items, workers=WORKERS, executor=None):
+    """func(item) for every item, at most `workers` at a time, results in item order
+
+    The first exception raised by func is raised here once the jobs already started have finished.
+    """
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(workers)
+
+    async def one(item):
+        async with slots:
+            return await loop.run_in_executor(executor, func, item)
+
+    return await asyncio.gather(*(one(item) for item in items))
+
+
+def run(func, items, workers=WORKERS):
+    """Blocking entry point for the sync Flask routes and scripts"""
+    items = list(items)
+    if not items:
+        return []
+    workers = max(1, min(workers, len(items)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fanout') as executor:
+        return asyncio.run(gather(func, items, workers, executor))
+
+
+class Loop:
+    """One asyncio loop on a daemon thread, started on first use and shared by every caller"""
+
+    def __init__(self, name='fanout'):
+        self.name = name
+        self._loop = None
+        self._thread = None
+        # the loop only keeps weak references to its tasks, long-lived ones are kept here
+        self._tasks = set()
+        self._lock = threading.Lock()
+
+    def _running(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._serve, name=self.name, daemon=True)
+                self._thread.start()
+            return self._loop
+
+    def _serve(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def spawn(self, coro):
+        """Schedule coro on the loop from any thread, returns a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self._running())
+
+    def call(self, coro):
+        """Run coro on the loop and wait for its result (or exception)"""
+        return self.spawn(coro).result()
+
+    def keep(self, coro):
+        """Start coro as a task that runs until close(), call from the loop"""
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def close(self):
+        """Cancel the kept tasks and stop the loop thread"""
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+        if loop is None:
+            return
+
+        async def cancel():
+            tasks = list(self._tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(cancel(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
@@ -0,0 +1,296 @@
+"""
+Incremental group aggregates for MusicAI
+A group analysis (liked songs, saved albums, playlists) is kept per user in the song store
+(aggregate:<scope>:<user id>) as counts, sums and frequency tables over its songs. A repeat analysis only adds
+the songs that joined the group and takes out the ones that left, instead of merging the whole library again.
+
+Every member is remembered with a signature of what it added, so a song whose cached analysis changed since
+(re-analyzed, stage version bump) is noticed on the way out and the aggregate is rebuilt from scratch instead of
+drifting. A full rebuild also happens now and then and whenever a stage version changes.
+"""
+
+import copy
+import hashlib
+import json
+import time
+
+# audio features averaged over a group
+FEATURES = ('acousticness', 'danceability', 'duration_ms', 'energy', 'instrumentalness',
+            'liveness', 'loudness', 'speechiness', 'tempo', 'valence')
+
+EMOTIONS = ('Anger', 'Disgust', 'Fear', 'Joy', 'Sadness')
+
+# watson.averages_calc frequency tables: lists of values per key, sentiment_frequencies counts per key
+NLU_TABLES = ('relationsfrequencies', 'entityfrequencies', 'keywordfrequencies', 'conceptfrequencies', 'subjectsfrequencies')
+NLU_COUNTS = ('sentiment_frequencies',)
+
+# a rebuild now and then also picks up songs whose analysis changed without leaving the group
+# (lyrics found once a negative cache entry ran out)
+REBUILD_SECONDS = 24 * 3600
+
+
+def aggregate_key(scope, user_id):
+    return f"aggregate:{scope}:{user_id}"
+
+
+class StaleAggregate(Exception):
+    """A member's cached analysis is not what was added for it, the aggregate can't be updated by deltas"""
+
+
+def _signature(features, nlu):
+    data = json.dumps({'features': features, 'nlu': nlu}, sort_keys=True)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()[:16]
+
+
+def _concepts(values):
+    # concept lists hold strings and lists of strings
+    for value in values:
+        if isinstance(value, list):
+            yield from value
+        else:
+            yield value
+
+
+class GroupAggregate:
+    """Counts, sums and frequency tables over a group's songs, updated one song at a time
+
+    Songs are counted as often as they appear in the group. The record (to_record) is plain JSON.
+    """
+
+    def __init__(self, versions=None):
+        self.versions = versions or {}
+        self.built_at = time.time()
+        self.songs = 0
+        self.sums = dict.fromkeys(FEATURES, 0.0)
+        self.lyric_songs = 0
+        self.emotions = dict.fromkeys(EMOTIONS, 0.0)
+        # table -> key -> json encoded value -> count
+        self.tables = {table: {} for table in NLU_TABLES}
+        self.counts = {table: {} for table in NLU_COUNTS}
+        # song id -> {'n', 'sig', 'title', 'artist', 'duration_ms', 'lyrics', 'degraded', 'counted'}
+        self.members = {}
+
+    @classmethod
+    def from_record(cls, record):
+        # records from the store's memory cache are shared, updates must not show through before they are saved
+        record = copy.deepcopy(record)
+        aggregate = cls(record['versions'])
+        aggregate.built_at = record['built_at']
+        aggregate.songs = record['songs']
+        aggregate.sums = record['sums']
+        aggregate.lyric_songs = record['lyric_songs']
+        aggregate.emotions = record['emotions']
+        aggregate.tables = record['tables']
+        aggregate.counts = record['counts']
+        aggregate.members = record['members']
+        return aggregate
+
+    def to_record(self):
+        return {
+            'versions': self.versions,
+            'built_at': self.built_at,
+            'songs': self.songs,
+            'sums': self.sums,
+            'lyric_songs': self.lyric_songs,
+            'emotions': self.emotions,
+            'tables': self.tables,
+            'counts': self.counts,
+            'members': self.members,
+        }
+
+    def delta(self, song_ids):
+        """(added, removed) song ids, with repeats, that turn the members into song_ids
+
+        Members that were analyzed without an upstream (degraded) or not at all are in both, so they get another try.
+        """
+        wanted = {}
+        for song_id in song_ids:
+            wanted[song_id] = wanted.get(song_id, 0) + 1
+        added, removed = [], []
+        for song_id, member in self.members.items():
+            if member['degraded'] or not member['counted']:
+                removed.extend([song_id] * member['n'])
+            elif member['n'] > wanted.get(song_id, 0):
+                removed.extend([song_id] * (member['n'] - wanted.get(song_id, 0)))
+        for song_id, n in wanted.items():
+            member = self.members.get(song_id)
+            if member is None or member['degraded'] or not member['counted']:
+                added.extend([song_id] * n)
+            elif n > member['n']:
+                added.extend([song_id] * (n - member['n']))
+        return added, removed
+
+    def add(self, song_id, song):
+        """Count an analyzed song once more (a musicAI._song_result, None for a song that could not be analyzed)"""
+        member = self.members.get(song_id)
+        if member is not None:
+            # the song is in the group more than once
+            if member['counted']:
+                if song is None or _signature(*self._contribution(song)) != member['sig']:
+                    raise StaleAggregate(f"analysis of {song_id} changed since it was aggregated")
+                self._apply(self._contribution(song), 1)
+            member['n'] += 1
+            return
+        if song is None:
+            self.members[song_id] = {'n': 1, 'counted': False, 'degraded': [], 'lyrics': False, 'sig': None}
+            return
+        features, nlu = self._contribution(song)
+        self.members[song_id] = {
+            'n': 1,
+            'counted': True,
+            'sig': _signature(features, nlu),
+            'title': song['song_title'],
+            'artist': song['artist_name'],
+            'duration_ms': song.get('duration_ms'),
+            'lyrics': nlu is not None,
+            'degraded': list(song.get('degraded', ())),
+        }
+        self._apply((features, nlu), 1)
+
+    def remove(self, song_id, features=None, nlu=None):
+        """Take one count of a member back out, given its cached audio features and nlu
+
+        nlu is ignored for members added without lyrics. Raises StaleAggregate if they are not what was added.
+        """
+        member = self.members[song_id]
+        if member['counted']:
+            nlu = nlu if member['lyrics'] else None
+            if features is None or _signature(self._features(features), nlu) != member['sig']:
+                raise StaleAggregate(f"cached analysis of {song_id} changed since it was aggregated")
+            self._apply((self._features(features), nlu), -1)
+        member['n'] -= 1
+        if member['n'] <= 0:
+            del self.members[song_id]
+
+    @staticmethod
+    def _features(features):
+        return {key: features.get(key) for key in FEATURES}
+
+    def _contribution(self, song):
+        return self._features(song), song['ai']['nlu']
+
+    def _apply(self, contribution, sign):
+        features, nlu = contribution
+        self.songs += sign
+        for key in FEATURES:
+            if isinstance(features[key], (int, float)):
+                self.sums[key] += sign * features[key]
+        if self.songs == 0:
+            # no float drift left behind in an empty group
+            self.sums = dict.fromkeys(FEATURES, 0.0)
+        if nlu is None:
+            return
+
+        self.lyric_songs += sign
+        for emotion in EMOTIONS:
+            self.emotions[emotion] += sign * nlu['averageEmotion'].get(emotion, 0.0)
+        if self.lyric_songs == 0:
+            self.emotions = dict.fromkeys(EMOTIONS, 0.0)
+        for table in NLU_TABLES:
+            for key, values in nlu.get(table, {}).items():
+                if table == 'conceptfrequencies':
+                    values = _concepts(values)
+                for value in values:
+                    self._count(self.tables[table], key, json.dumps(value), sign)
+        for table in NLU_COUNTS:
+            for key, count in nlu.get(table, {}).items():
+                self._count(self.counts, table, key, sign * count)
+
+    @staticmethod
+    def _count(tables, key, value, change):
+        table = tables.setdefault(key, {})
+        table[value] = table.get(value, 0) + change
+        if table[value] <= 0:
+            del table[value]
+            if not table:
+                del tables[key]
+
+    def stats(self, song_ids):
+        """The group's averages in the shape liked_group_average always returned, songs listed in song_ids order"""
+        stats = {key: self.sums[key] / self.songs if self.songs else 0.0 for key in FEATURES}
+        members = [self.members[song_id] for song_id in song_ids if song_id in self.members]
+        stats['degraded'] = sorted({label for member in members for label in member['degraded']})
+        if not self.lyric_songs:
+            stats['ai'] = None
+            return stats
+
+        ai = {'averageEmotion': {emotion: self.emotions[emotion] / self.lyric_songs for emotion in EMOTIONS}}
+        for table in NLU_TABLES:
+            ai[table] = {
+                key: [json.loads(value) for value, count in values.items() for _ in range(count)]
+                for key, values in self.tables[table].items()
+            }
+        for table in NLU_COUNTS:
+            ai[table] = dict(self.counts.get(table, {}))
+        ai['amount'] = self.lyric_songs
+        ai['watson_songs'] = [(member['title'], member['artist']) for member in members if member['counted'] and member['lyrics']]
+        stats['ai'] = ai
+        return stats
+
+    def song_rows(self, song_ids):
+        """What a group page lists per song, by title"""
+        rows = {}
+        for song_id in song_ids:
+            member = self.members.get(song_id)
+            if member is not None and member['counted']:
+                rows[member['title']] = {
+                    'id': song_id,
+                    'song_title': member['title'],
+                    'artist_name': member['artist'],
+                    'duration_ms': member['duration_ms'],
+                }
+        return rows
+
+
+class GroupAggregates:
+    """Per user group aggregates kept in a song store, brought up to date by deltas"""
+
+    def __init__(self, store, rebuild_seconds=REBUILD_SECONDS):
+        self.store = store
+        self.rebuild_seconds = rebuild_seconds
+
+    def current(self, key, versions):
+        """The kept aggregate for key if the next update() builds on it, None if it starts from scratch"""
+        record = self.store.get(key) if key else None
+        if not record:
+            return None
+        aggregate = GroupAggregate.from_record(record)
+        if aggregate.versions != versions or aggregate.built_at < time.time() - self.rebuild_seconds:
+            return None
+        return aggregate
+
+    def update(self, key, song_ids, analyze, cached, versions):
+        """The group's aggregate for song_ids, after adding and removing only what changed since the last one
+
+        analyze(song_ids) -> their analyses in order (None for songs that could not be analyzed),
+        cached(song_id) -> (audio features, nlu) from the stage cache, versions: the stage versions
+        the aggregate is built from. Without a key nothing is kept and every song is added.
+        """
+        aggregate = self.current(key, versions)
+        fresh = aggregate is None
+        if fresh:
+            aggregate = GroupAggregate(versions)
+
+        added, removed = aggregate.delta(song_ids)
+        try:
+            self._apply_delta(aggregate, added, removed, analyze, cached)
+        except StaleAggregate as e:
+            print(f"WARNING: rebuilding group aggregate {key}: {e}")
+            aggregate = GroupAggregate(versions)
+            added, removed = list(song_ids), []
+            self._apply_delta(aggregate, added, removed, analyze, cached)
+
+        if key and (added or removed or fresh):
+            self.store.put(key, aggregate.to_record())
+        return aggregate
+
+    @staticmethod
+    def _apply_delta(aggregate, added, removed, analyze, cached):
+        for song_id in removed:
+            aggregate.remove(song_id, *cached(song_id))
+        if added:
+            # a song in the group twice is analyzed once
+            unique = list(dict.fromkeys(added))
+            analyses = dict(zip(unique, analyze(unique)))
+            for song_id in added:
+                aggregate.add(song_id, analyses[song_id])
@@ -0,0 +1,205 @@
+"""
+Shared HTTP client for MusicAI
+Every upstream call (Spotify, Genius, genius.com lyric pages, Imgflip) goes through one session:
+keep-alive connection pools per host, gzip, default connect/read timeouts and per-host stats
+showing how often a pooled connection was reused instead of paying a new TCP + TLS handshake.
+Each host also has a circuit breaker: once a host keeps failing or timing out, calls to it fail fast
+with UpstreamUnavailable (a requests ConnectionError) until a probe call succeeds again.
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+import circuit_breaker
+
+# seconds, connect timeout slightly above a TCP retransmit window
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 15.0
+
+# hosts with a pool kept open, and keep-alive connections per host (should cover the worker threads)
+POOL_HOSTS = 16
+POOL_SIZE = 20
+
+# calls in flight at once per upstream (concurrent group analyses share these), other hosts get POOL_SIZE
+HOST_LIMITS = {
+    'api.spotify.com': 10,
+    'api.genius.com': 6,
+    'genius.com': 6,
+    'watson': 6,  # not an http_client host, musicAI takes this slot around Watson SDK calls
+}
+
+
+class UpstreamUnavailable(circuit_breaker.CircuitOpen, requests.exceptions.ConnectionError):
+    """The host's circuit is open, raised without making the call"""
+
+
+class PoolStats:
+    """Requests and freshly opened connections per host"""
+
+    def __init__(self):
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _host(self, host):
+        counts = self._hosts.get(host)
+        if counts is None:
+            counts = self._hosts[host] = {'requests': 0, 'connections': 0, 'errors': 0, 'seconds': 0.0}
+        return counts
+
+    def connection_opened(self, host):
+        with self._lock:
+            self._host(host)['connections'] += 1
+
+    def request_done(self, host, seconds, error=False):
+        with self._lock:
+            counts = self._host(host)
+            counts['requests'] += 1
+            counts['seconds'] += seconds
+            if error:
+                counts['errors'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            hosts = {host: dict(counts) for host, counts in self._hosts.items()}
+        for counts in hosts.values():
+            done = counts['requests']
+            reused = max(0, done - counts['connections'])
+            counts['reused'] = reused
+            counts['reuse_ratio'] = reused / done if done else 0.0
+            counts['avg_ms'] = round(counts.pop('seconds') / done * 1000, 2) if done else None
+        return hosts
+
+
+def _counting_pools(stats):
+    """urllib3 pool classes that report every new connection to stats"""
+
+    class CountingHTTPConnectionPool(HTTPConnectionPool):
+        def _new_conn(self):
+            stats.connection_opened(self.host)
+            return super()._new_conn()
+
+    class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+        def _new_conn(self):
+            stats.connection_opened(self.host)
+            return super()._new_conn()
+
+    return {'http': CountingHTTPConnectionPool, 'https': CountingHTTPSConnectionPool}
+
+
+class _PoolAdapter(HTTPAdapter):
+
+    def __init__(self, stats, **kwargs):
+        self._stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = _counting_pools(self._stats)
+
+
+class HttpClient:
+    """Thread-safe pooled client, same call style as requests.get / requests.post"""
+
+    def __init__(self, pool_size=POOL_SIZE, pool_hosts=POOL_HOSTS, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, host_limits=None):
+        self.timeout = (connect_timeout, read_timeout)
+        self.stats = PoolStats()
+        self.pool_size = pool_size
+        self.host_limits = dict(HOST_LIMITS)
+        self.host_limits.update(host_limits or {})
+        self._slots = {}
+        self._slots_lock = threading.Lock()
+        self.session = requests.Session()
+        # shared by every user's requests, so nothing is remembered between calls
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+        adapter = _PoolAdapter(self.stats, pool_connections=pool_hosts, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    @contextmanager
+    def host_slot(self, host):
+        """Hold one of the host's concurrent call slots (blocks while they are all taken)"""
+        with self._slots_lock:
+            slot = self._slots.get(host)
+            if slot is None:
+                slot = self._slots[host] = threading.BoundedSemaphore(self.host_limits.get(host, self.pool_size))
+        with slot:
+            yield
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        host = urlsplit(url).hostname or ''
+        breaker = circuit_breaker.breaker(host)
+        if not breaker.allow():
+            raise UpstreamUnavailable(host, breaker.retry_in())
+        with self.host_slot(host):
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except Exception:
+                # not only network errors: a failing hook or adapter must not leave a half-open probe taken forever
+                seconds = time.perf_counter() - started
+                self.stats.request_done(host, seconds, error=True)
+                breaker.record(False, seconds)
+                raise
+            seconds = time.perf_counter() - started
+            self.stats.request_done(host, seconds)
+            # 4xx is the caller's problem (bad token, unknown id), not the upstream's
+            breaker.record(response.status_code < 500, seconds)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+def _host_limits(text):
+    """HTTP_HOST_LIMITS, e.g. 'api.spotify.com=10,genius.com=4'"""
+    limits = {}
+    for part in text.split(','):
+        host, _, limit = part.partition('=')
+        if host.strip() and limit.strip():
+            limits[host.strip()] = int(limit)
+    return limits
+
+
+def _default_client():
+    return HttpClient(
+        pool_size=int(os.getenv('HTTP_POOL_SIZE', POOL_SIZE)),
+        connect_timeout=float(os.getenv('HTTP_CONNECT_TIMEOUT', CONNECT_TIMEOUT)),
+        read_timeout=float(os.getenv('HTTP_READ_TIMEOUT', READ_TIMEOUT)),
+        host_limits=_host_limits(os.getenv('HTTP_HOST_LIMITS', '')),
+    )
+
+
+# the process wide client
+client = _default_client()
+
+
+def get(url, **kwargs):
+    return client.get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    return client.post(url, **kwargs)
+
+
+def host_slot(host):
+    return client.host_slot(host)
+
+
+def stats():
+    return client.stats.snapshot()
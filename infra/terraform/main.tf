@@ -58,12 +58,34 @@ resource "azurerm_container_app" "app" {
         name  = "PORT"
         value = var.container_port
       }
+
+      # replicas share one analysis cache when a redis url is given
+      env {
+        name  = "SONG_STORE_BACKEND"
+        value = var.redis_url == "" ? "sqlite" : "redis"
+      }
+
+      dynamic "env" {
+        for_each = var.redis_url == "" ? [] : [1]
+        content {
+          name        = "REDIS_URL"
+          secret_name = "redis-url"
+        }
+      }
     }
 
     min_replicas = 0
     max_replicas = 1
   }
 
+  dynamic "secret" {
+    for_each = var.redis_url == "" ? [] : [1]
+    content {
+      name  = "redis-url"
+      value = var.redis_url
+    }
+  }
+
   ingress {
     external_enabled = true
     target_port     = var.container_port
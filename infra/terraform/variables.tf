@@ -33,6 +33,13 @@ variable "image_tag" {
   default     = "latest"
 }
 
+variable "redis_url" {
+  description = "Shared song analysis cache (redis:// or rediss:// url), empty keeps a local sqlite cache per replica"
+  type        = string
+  default     = ""
+  sensitive   = true
+}
+
 variable "tags" {
   description = "Resource tags"
   type        = map(string)
@@ -0,0 +1,179 @@
+"""
+Per-user library mirror for MusicAI
+Liked songs, saved albums and playlists are kept in the song store (library:<kind>:<user id>), so a
+repeat visit only downloads what changed: saved items newer than the newest one already seen
+(added_at high-water mark) and playlists whose snapshot_id moved.
+Spotify has no feed of unsaves: removed liked songs and albums are only noticed by their count, and then
+everything is downloaded again (see FULL_SYNC_SECONDS).
+"""
+
+import time
+
+import spotify_api
+
+LIKES = 'likes'
+ALBUMS = 'albums'
+PLAYLISTS = 'playlists'
+
+# liked songs and saved albums are downloaded in full again whenever mirrored + new items != Spotify's total,
+# which is how unsaves are detected (also when a new save keeps the total the same, the new save is counted
+# separately), and at least this often, for what no count shows: saved albums and tracks changing in place
+FULL_SYNC_SECONDS = 24 * 3600
+
+
+def library_key(kind, user_id):
+    return f"library:{kind}:{user_id}"
+
+
+def like_from_item(item):
+    track = item.get('track')
+    if not track:
+        return None
+    return {
+        "artists": [artist['name'] for artist in track['artists']],
+        "name": track['name'],
+        "id": track['id'],
+        "popularity": track['popularity'],
+    }
+
+
+def album_from_item(item):
+    album = item['album']
+    return {
+        'name': album['name'],
+        "genres": album['genres'],
+        "id": album['id'],
+        "popularity": album['popularity'],
+        "songs": [(track['id'], track['name'], [artist['name'] for artist in track['artists']]) for track in album['tracks']['items']],
+    }
+
+
+def playlist_from_item(item):
+    return {
+        'owner': item['owner']['display_name'],
+        'name': item['name'],
+        "description": item['description'],
+        "id": item['id'],
+        "snapshot_id": item.get('snapshot_id'),
+        "songs": [],
+    }
+
+
+def songs_from_page(page):
+    songs = []
+    for entry in page['items']:
+        track = entry.get('track')
+        if track:
+            songs.append((track['id'], track['name'], [artist['name'] for artist in track.get('artists', [])]))
+    return songs
+
+
+class LibrarySync:
+    """Reads a user's library from Spotify through a mirror kept in a song store
+
+    Without a user id nothing is mirrored and the whole library is downloaded.
+    Returned entries come from a shared record, callers must not modify them.
+    """
+
+    def __init__(self, store, full_sync_seconds=FULL_SYNC_SECONDS):
+        self.store = store
+        self.full_sync_seconds = full_sync_seconds
+
+    def likes(self, token, user_id=None):
+        return self._saved(token, user_id, LIKES, f"{spotify_api.API_URL}/me/tracks", like_from_item)
+
+    def albums(self, token, user_id=None):
+        return self._saved(token, user_id, ALBUMS, f"{spotify_api.API_URL}/me/albums", album_from_item)
+
+    def playlists(self, token, user_id=None):
+        mirror = self._mirror(PLAYLISTS, user_id)
+        known = {playlist['id']: playlist for playlist in mirror['entries']} if mirror else {}
+
+        playlists = []
+        track_pages = []
+        for page in spotify_api.get_all_pages(token, f"{spotify_api.API_URL}/me/playlists"):
+            for item in page['items']:
+                if not item:
+                    continue
+                playlist = playlist_from_item(item)
+                cached = known.get(playlist['id'])
+                if cached is not None and playlist['snapshot_id'] and cached.get('snapshot_id') == playlist['snapshot_id']:
+                    playlist['songs'] = cached['songs']
+                else:
+                    # changed or new: every track page is known up front from the listing's total
+                    tracks = item['tracks']
+                    for offset in range(0, tracks['total'], spotify_api.PLAYLIST_PAGE_LIMIT):
+                        track_pages.append((playlist, tracks['href'], offset, tracks['total']))
+                playlists.append(playlist)
+
+        # track pages of every changed playlist at once, only id / name / artist names
+        pages = spotify_api.get_pages(token, [(href, offset) for _, href, offset, _ in track_pages],
+                                      limit=spotify_api.PLAYLIST_PAGE_LIMIT, params={'fields': spotify_api.PLAYLIST_TRACK_FIELDS})
+        for (playlist, _, offset, total), page in zip(track_pages, pages):
+            playlist['songs'].extend(songs_from_page(page))
+            # a playlist that grew since it was listed has a 'next' on its last page, the rest is read in sequence
+            while offset + spotify_api.PLAYLIST_PAGE_LIMIT >= total and page.get('next'):
+                page = spotify_api.get(token, page['next']).json()
+                playlist['songs'].extend(songs_from_page(page))
+
+        versions = [(playlist['id'], playlist['snapshot_id']) for playlist in playlists]
+        if mirror is None or versions != [(playlist['id'], playlist.get('snapshot_id')) for playlist in mirror['entries']]:
+            self._save(PLAYLISTS, user_id, {'entries': playlists, 'synced_at': time.time()})
+        return playlists
+
+    def forget(self, user_id):
+        for kind in (LIKES, ALBUMS, PLAYLISTS):
+            self.store.delete(library_key(kind, user_id))
+
+    def _mirror(self, kind, user_id):
+        if not user_id:
+            return None
+        return self.store.get(library_key(kind, user_id))
+
+    def _save(self, kind, user_id, mirror):
+        if user_id:
+            self.store.put(library_key(kind, user_id), mirror)
+
+    def _saved(self, token, user_id, kind, url, convert):
+        """Liked songs / saved albums, newest first, only items past the high-water mark are downloaded"""
+        mirror = self._mirror(kind, user_id)
+        now = time.time()
+        if mirror is not None and now - mirror.get('full_sync_at', 0) < self.full_sync_seconds:
+            new_items, total = self._newer_items(token, url, mirror['watermark'])
+            # anything unsaved since the last sync shows up as a count that doesn't add up, the only sign of it
+            if mirror['count'] + len(new_items) == total:
+                if not new_items:
+                    return mirror['entries']
+                entries = [entry for entry in map(convert, new_items) if entry is not None] + mirror['entries']
+                self._save(kind, user_id, {
+                    'entries': entries,
+                    'count': total,
+                    'watermark': max(item['added_at'] for item in new_items),
+                    'synced_at': now,
+                    'full_sync_at': mirror['full_sync_at'],
+                })
+                return entries
+
+        items = [item for page in spotify_api.get_all_pages(token, url) for item in page['items']]
+        entries = [entry for entry in map(convert, items) if entry is not None]
+        self._save(kind, user_id, {
+            'entries': entries,
+            'count': len(items),
+            'watermark': max((item['added_at'] for item in items), default=''),
+            'synced_at': now,
+            'full_sync_at': now,
+        })
+        return entries
+
+    def _newer_items(self, token, url, watermark):
+        """(items added after watermark, current total), page by page until an older item shows up"""
+        new_items = []
+        offset = 0
+        while True:
+            page = spotify_api.get_page(token, url, offset)
+            items = page['items']
+            fresh = [item for item in items if item['added_at'] > watermark]
+            new_items.extend(fresh)
+            if len(fresh) < len(items) or not page.get('next'):
+                return new_items, page['total']
+            offset += len(items)
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""
+One-shot migration from song_db.json into the configured song store
+Usage: python migrate_song_db.py [path/to/song_db.json]
+"""
+
+import os
+import sys
+
+import song_store
+
+
+def main():
+    json_path = sys.argv[1] if len(sys.argv) > 1 else song_store.SONG_DB_FILE
+    if not os.path.exists(json_path):
+        print(f"❌ {json_path} not found, nothing to migrate.")
+        return 1
+
+    # batched writes, flushed by close()
+    store = song_store.open_write_behind_store()
+    if isinstance(store.store, song_store.JsonSongStore) and os.path.abspath(store.store.path) == os.path.abspath(json_path):
+        print("❌ SONG_STORE_BACKEND points at the same json file, set it to sqlite first.")
+        return 1
+
+    try:
+        copied = song_store.migrate_song_db(json_path, store)
+    except Exception as e:
+        print(f"❌ Migration failed: {e}")
+        return 1
+
+    store.close()
+    print(f"✅ Migrated {copied} song(s) from {json_path}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,16 +7,19 @@ from flask import request, jsonify , render_template ,jsonify
 import requests
 import json
 import base64
+import hmac
+import http_client
+import spotify_api
+import circuit_breaker
 
 # string to python class type
 import ast
 
-# check files in running machine
-from os.path import exists
-
 
 # debugging
+import threading
 import time
+import uuid
 import pprint
 
 # webcrawl lyrics
@@ -25,9 +28,19 @@ import bs4
 # WATSON AI
 import watson
 
+# analyzed songs database
+import song_store
+import memory_cache
+import stage_cache
+import cache_metrics
+import library_sync
+import group_aggregates
+import pipeline
+import analysis_jobs
+import work_queue
+
 
 # MATH
-import statistics
 import random
 
 # Environment variables
@@ -77,11 +90,6 @@ if missing_optional:
         print(f"  - {var}")
     print("These are not required but enable additional features like meme generation.\n")
 
-# TODO make a json database of all the songs watson has already analyzed
-# make a function to apply the database before running the analysis, check if we already have it
-
-
-
 # # DISABLE EXTRA INFORMATION FROM LOGS
 # import logging
 # log = logging.getLogger('werkzeug')
@@ -112,9 +120,6 @@ TOKEN_FILE = 'user_tokens.json'
 imgflip_username = os.getenv('IMGFLIP_USERNAME', '')
 imgflip_password = os.getenv('IMGFLIP_PASSWORD', '')
 
-API_COOLDOWN_RATE = 3
-
-
 # auth SPOTFITY scopes
 scopes = [
  'ugc-image-upload',
@@ -184,11 +189,42 @@ def is_token_expired(expires_at):
         return True
     return time.time() > (expires_at - 300)  # 5 minute buffer
 
+# refreshes are serialized so concurrent callers (job workers, warm_cache.py threads) don't each use up the refresh token
+_token_refresh_lock = threading.Lock()
+
+def fresh_spotify_token(user_id):
+    """The stored user's Spotify access token, refreshed and saved first when it is about to expire
+
+    None when the user has no stored token or it could not be refreshed.
+    """
+    with _token_refresh_lock:
+        token_data = load_user_token(user_id) if user_id else {}
+        if not token_data:
+            return None
+        if token_data.get('spotify_token') and not is_token_expired(token_data.get('spotify_expires_at')):
+            return token_data['spotify_token']
+
+        print(f"INFO: Spotify token expired for user {user_id}, attempting refresh...")
+        if not token_data.get('spotify_refresh_token'):
+            print(f"ERROR: No refresh token available for user {user_id}")
+            return None
+        new_tokens = _refresh_spotify_token(token_data['spotify_refresh_token'])
+        if not new_tokens:
+            print(f"ERROR: Failed to refresh Spotify token for user {user_id}")
+            return None
+        token_data.update({
+            'spotify_token': new_tokens['access_token'],
+            'spotify_refresh_token': new_tokens['refresh_token'],
+            'spotify_expires_at': time.time() + new_tokens['expires_in'],
+        })
+        save_user_token(user_id, token_data)
+        print(f"SUCCESS: Refreshed Spotify token for user {user_id}")
+        return token_data['spotify_token']
+
 def validate_token_scopes(token):
     """Validate token and check available scopes"""
     try:
-        headers = {"Authorization": "Bearer " + token}
-        response = requests.get('https://api.spotify.com/v1/me', headers=headers)
+        response = spotify_api.get(token, 'https://api.spotify.com/v1/me', max_retries=0)
         
         if response.status_code == 200:
             user_data = response.json()
@@ -209,13 +245,36 @@ def validate_token_scopes(token):
         return False
 
 
-# database check
-path_to_file = "song_db.json"
-if exists(path_to_file):
-    pass
-else:
-    with open("song_db.json" , "w") as f:
-        f.write("{}")
+# database of every song watson has already analyzed (see song_store.py, migrate_song_db.py)
+# writes are queued and flushed in batches, reads see queued songs straight away
+# hot songs are kept decoded in memory (bounded by SONG_CACHE_MAX_MB, expire after SONG_CACHE_TTL_SECONDS)
+song_db = song_store.CachedStore(
+    song_store.open_write_behind_store(),
+    memory_cache.LRUCache(
+        max_bytes=int(os.getenv('SONG_CACHE_MAX_MB', '64')) * 1024 * 1024,
+        ttl=float(os.getenv('SONG_CACHE_TTL_SECONDS', '86400')),
+    ),
+)
+# every analysis step is cached on its own so a retry only re-runs what failed
+# dead ends (no genius hit, bad lyric page, watson error) are remembered for NEGATIVE_TTL_<REASON> seconds
+song_stages = stage_cache.StageCache(song_db, negative_ttls={
+    reason: float(os.getenv(f'NEGATIVE_TTL_{reason.upper()}', ttl))
+    for reason, ttl in stage_cache.DEFAULT_NEGATIVE_TTLS.items()
+})
+# each user's liked songs, albums and playlists, kept next to the songs
+library = library_sync.LibrarySync(song_db)
+# each user's group analyses as counts, sums and frequency tables, updated by the songs that changed
+group_aggregate_store = group_aggregates.GroupAggregates(song_db)
+# background library analyses, jobs and their per-song tasks kept in a local sqlite queue (WORK_QUEUE_PATH)
+analysis_jobs_manager = analysis_jobs.JobManager(work_queue.open_work_queue())
+# Watson is called through its SDK, not http_client, so it gets its breaker here
+watson_breaker = circuit_breaker.breaker('watson')
+
+# artist images / genres, shared by every user
+artist_resolver = spotify_api.ArtistResolver(memory_cache.LRUCache(
+    max_bytes=8 * 1024 * 1024,
+    ttl=float(os.getenv('ARTIST_CACHE_TTL_SECONDS', '86400')),
+))
 
 
 
@@ -294,25 +353,9 @@ def Dashboard():
         return flask.redirect('/')
     
     # Check if Spotify token is expired and refresh if needed
-    spotify_token = token_data.get('spotify_token')
-    if not spotify_token or is_token_expired(token_data.get('spotify_expires_at')):
-        print(f"INFO: Spotify token expired for user {user_id}, attempting refresh...")
-        
-        if token_data.get('spotify_refresh_token'):
-            new_tokens = _refresh_spotify_token(token_data['spotify_refresh_token'])
-            if new_tokens:
-                # Update stored tokens
-                token_data.update(new_tokens)
-                save_user_token(user_id, token_data)
-                spotify_token = new_tokens['access_token']
-                flask.session['spotify_token'] = spotify_token
-                print(f"SUCCESS: Refreshed Spotify token for user {user_id}")
-            else:
-                print(f"ERROR: Failed to refresh Spotify token for user {user_id}")
-                return flask.redirect('/')
-        else:
-            print(f"ERROR: No refresh token available for user {user_id}")
-            return flask.redirect('/')
+    spotify_token = fresh_spotify_token(user_id)
+    if not spotify_token:
+        return flask.redirect('/')
     
     # Store current token in session for compatibility
     flask.session['spotify_token'] = spotify_token
@@ -415,24 +458,10 @@ def search_results():
             q_type += 's'
             tracks = data.get(q_type, {}).get('items', [])
             
-            # add images safely
+            # add images safely (every main artist in one batched call)
+            thumbnails = _artist_thumbnails(spotify_token, tracks)
             for i in tracks:
-                try:
-                    if i.get('artists') and len(i['artists']) > 0:
-                        artist_href = i['artists'][0].get('href')
-                        if artist_href:
-                            artist_data = fetch_spotify_data(spotify_token, artist_href)
-                            if artist_data != "ERROR" and artist_data.get('images'):
-                                i['thumbnail'] = artist_data['images'][-1]['url']
-                            else:
-                                i['thumbnail'] = '/static/fallback.svg'
-                        else:
-                            i['thumbnail'] = '/static/fallback.svg'
-                    else:
-                        i['thumbnail'] = '/static/fallback.svg'
-                except Exception as e:
-                    print(f"ERROR adding thumbnail for track {i.get('name', 'Unknown')}: {e}")
-                    i['thumbnail'] = '/static/fallback.svg'
+                i['thumbnail'] = thumbnails.get(_main_artist_id(i), '/static/fallback.svg')
 
         # SEARCHING FOR ARTISTS
         else:
@@ -478,6 +507,8 @@ def song_analysis():
             error_message += "This song may not be available for analysis due to regional restrictions or premium content requirements."
             return error_message, 500
         
+        # copy, the record is shared with the song cache
+        stats = dict(stats)
         stats['song_title'] = song_title
         stats['song_artist_name'] = song_artist_name
 
@@ -498,8 +529,9 @@ def song_analysis():
         ]
 
         # PIE CHART
+        # lyrics without nlu: watson was down (circuit open), the song is shown without the watson part
         ai_response = False
-        if stats['ai']['lyrics'] is not None : 
+        if stats['ai']['nlu'] is not None : 
             ai_response = True
             emotionsLabels = list(stats['ai']['nlu']['averageEmotion'].keys())
             emotionValues = [    stats['ai']['nlu']['averageEmotion'][i] for i in emotionsLabels  ]
@@ -549,15 +581,14 @@ def song_analysis():
 # Album Analysis
 @application.route('/album-analysis', methods=['GET'])
 def album_analysis():
+    return _start_analysis_job('albums')
+
+def _album_analysis_content(spotify_token, user_id):
     # grab music
-    spotify_token = flask.session.get('spotify_token')
-    albums = user_albums(spotify_token)
+    albums = user_albums(spotify_token, user_id)
 
     # GROUP ANALYSIS FUNCTION USES THE  liked_group_average() function
-    final  = group_music_analysis(spotify_token, albums)
-
-    # Add amount to total analyized
-    flask.session['amount'] += final['ai']['amount']
+    final  = group_music_analysis(spotify_token, albums, _aggregate_key('albums', user_id))
 
     # GRAPHING
 
@@ -615,23 +646,21 @@ def album_analysis():
         }
 
 
-    # sessions for passed songs on html
-
-    return flask.render_template('Liked_Group_analysis.html' , content = content)
+    # songs added to the session total once the result is opened
+    content['amount'] = final['ai']['amount'] if final['ai'] is not None else 0
+    return content
 
 # Playlist Analysis
 @application.route('/playlist-analysis', methods=['GET'])
 def playlist_analysis():
+    return _start_analysis_job('playlists')
 
+def _playlist_analysis_content(spotify_token, user_id):
     # grab music
-    spotify_token = flask.session.get('spotify_token')
-    playlist_response = user_playlists(spotify_token)
+    playlist_response = user_playlists(spotify_token, user_id)
 
     # GROUP ANALYSIS FUNCTION USES THE  liked_group_average() function
-    final  = group_music_analysis(spotify_token, playlist_response)
-
-    # Add amount to total analyized
-    flask.session['amount'] += final['ai']['amount']
+    final  = group_music_analysis(spotify_token, playlist_response, _aggregate_key('playlists', user_id))
 
 
     # GRAPHING
@@ -690,9 +719,9 @@ def playlist_analysis():
         }
 
 
-    # sessions for passed songs on html
-
-    return flask.render_template('Liked_Group_analysis.html' , content = content)
+    # songs added to the session total once the result is opened
+    content['amount'] = final['ai']['amount'] if final['ai'] is not None else 0
+    return content
 
 
 
@@ -990,12 +1019,12 @@ def recent_analysis():
         }
         tracks_for_analysis.append(track_info)
     
+    return _start_analysis_job('recent', {'tracks': tracks_for_analysis})
+
+def _recent_analysis_content(spotify_token, tracks_for_analysis):
     # Analyze tracks using existing function
     song_stats, each_song_stats = liked_group_average(spotify_token, tracks_for_analysis)
     
-    # Add amount to total analyzed
-    flask.session['amount'] += song_stats['ai']['amount'] if song_stats.get('ai') else 0
-    
     # Prepare chart data
     spotty_chart_datapoint_labels = [
         'danceability',
@@ -1042,19 +1071,20 @@ def recent_analysis():
     song_stats['song_title'] = USERNAME['display_name']
     song_stats['song_artist_name'] = "Recently Played Tracks"
     
-    return flask.render_template('Liked_Group_analysis.html', content=content)
+    # songs added to the session total once the result is opened
+    content['amount'] = song_stats['ai']['amount'] if song_stats.get('ai') else 0
+    return content
 
 # liked songs Analysis
 @application.route('/liked-analysis', methods=['GET'])
 def liked_analysis():
-    spotify_token = flask.session.get('spotify_token')
-    likes = user_likes(spotify_token)
+    return _start_analysis_job('liked')
+
+def _liked_analysis_content(spotify_token, user_id):
+    likes = user_likes(spotify_token, user_id)
 
     # this function returns two for parallel display of each (song) & grouped ai
-    song_stats , each_song_stats = liked_group_average(spotify_token , likes)
-    
-    # Add amount to total analyized
-    flask.session['amount'] += song_stats['ai']['amount']
+    song_stats , each_song_stats = liked_group_average(spotify_token , likes, _aggregate_key('liked', user_id))
 
 
 
@@ -1114,16 +1144,214 @@ def liked_analysis():
         }
 
 
-    # sessions for passed songs on html
-
-    return flask.render_template('Liked_Group_analysis.html' , content = content)
+    # songs added to the session total once the result is opened
+    content['amount'] = song_stats['ai']['amount'] if song_stats['ai'] is not None else 0
+    return content
 
 
 
+# ANALYSIS JOBS (see analysis_jobs.py, work_queue.py, worker.py)
+# library-sized analyses run in the background, the request only queues them and answers with the job id
+def _job_owner():
+    if 'job_owner' not in flask.session:
+        flask.session['job_owner'] = flask.session.get('user_id') or uuid.uuid4().hex
+    return flask.session['job_owner']
 
+def _start_analysis_job(kind, params=None):
+    params = dict(params or {})
+    # workers look up the user's stored (refreshable) token when they run the job, it is never kept in the queue
+    params['user_id'] = _library_user()
+    if not fresh_spotify_token(params['user_id']):
+        if flask.request.accept_mimetypes.best == 'application/json':
+            return jsonify({'error': 'log in again to analyze your library'}), 401
+        return flask.redirect('/')
+    job_id = analysis_jobs_manager.submit(_job_owner(), kind, params)
+    if flask.request.accept_mimetypes.best == 'application/json':
+        return jsonify({'job_id': job_id, 'progress_url': f'/analysis-jobs/{job_id}/progress'}), 202
+    return flask.redirect(f'/analysis-jobs/{job_id}')
+
+def _count_analyzed(job_id, amount):
+    # a finished job adds its songs to the session total once, however often its page is opened
+    counted = flask.session.get('counted_jobs', [])
+    if job_id in counted:
+        return
+    flask.session['amount'] = flask.session.get('amount', 0) + amount
+    flask.session['counted_jobs'] = (counted + [job_id])[-20:]
+
+@application.route('/analysis-jobs/<job_id>', methods=['GET'])
+def analysis_job(job_id):
+    job = analysis_jobs_manager.status(job_id, _job_owner())
+    if job is None:
+        flask.abort(404)
+    if job['status'] != analysis_jobs.DONE:
+        return flask.render_template('analysis_progress.html', content={'job': job})
+
+    content = analysis_jobs_manager.result(job_id, _job_owner())
+    if content is None:
+        flask.abort(404)
+    _count_analyzed(job_id, content.get('amount', 0))
+    return flask.render_template('Liked_Group_analysis.html' , content = content)
 
+@application.route('/analysis-jobs/<job_id>/progress', methods=['GET'])
+def analysis_job_progress(job_id):
+    job = analysis_jobs_manager.status(job_id, _job_owner())
+    if job is None:
+        return jsonify({'error': 'unknown job'}), 404
+    return jsonify(job)
+
+# server-sent events: every song as soon as it is analyzed, with the group's running averages
+@application.route('/analysis-jobs/<job_id>/events', methods=['GET'])
+def analysis_job_events(job_id):
+    owner = _job_owner()
+    if analysis_jobs_manager.status(job_id, owner) is None:
+        return jsonify({'error': 'unknown job'}), 404
+    try:
+        after = int(flask.request.headers.get('Last-Event-ID') or flask.request.args.get('after') or 0)
+    except ValueError:
+        after = 0
+    return flask.Response(
+        flask.stream_with_context(analysis_jobs_manager.events(job_id, owner, after)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+# how each kind of job lists its songs and builds its page, run by analysis_jobs.Worker
+def _job_songs(kind, token, params):
+    if kind == 'liked':
+        song_ids = [song['id'] for song in user_likes(token, params.get('user_id'))]
+    elif kind == 'albums':
+        song_ids = [song[0] for album in user_albums(token, params.get('user_id')).values() for song in album['songs']]
+    elif kind == 'playlists':
+        song_ids = [song[0] for playlist in user_playlists(token, params.get('user_id')).values() for song in playlist['songs']]
+    elif kind == 'recent':
+        song_ids = [track['id'] for track in params['tracks']]
+    else:
+        raise ValueError(f"unknown analysis job kind {kind!r}")
+    _prefetch_spotify_stages(token, song_ids)
+    return song_ids
+
+def _job_analyze(token, song_ids, on_song):
+    song_stages.prefetch(song_ids)
+    cached = _cached_songs(song_ids)
+    song_pipeline.run((_song_job(token, song_id) for song_id in song_ids),
+                      lambda index, job: on_song(index, song_ids[index] in cached, _song_summary(job)))
+
+# what the event stream shows of an analyzed song (see analysis_jobs.RunningAggregate)
+def _song_summary(job):
+    if job is None:
+        return None
+    song = _song_result(job)
+    nlu = song['ai']['nlu']
+    return {
+        'id': job['id'],
+        'song_title': song['song_title'],
+        'artist_name': song['artist_name'],
+        'features': {key: song.get(key) for key in analysis_jobs.AGGREGATE_FEATURES},
+        'emotion': nlu['averageEmotion'] if nlu else None,
+        'degraded': song['degraded'],
+    }
 
+# songs counted in the user's kept group aggregate get no song task, only the aggregate's delta is analyzed;
+# their summaries come from the aggregate's members and the stage cache
+def _job_known(kind, token, params, song_ids):
+    if kind not in ('liked', 'albums', 'playlists'):
+        return {}
+    aggregate = group_aggregate_store.current(_aggregate_key(kind, params.get('user_id')), dict(song_stages.versions))
+    if aggregate is None:
+        return {}
+    added = set(aggregate.delta(song_ids)[0])
+    unchanged = [song_id for song_id in song_ids if song_id not in added and song_id in aggregate.members]
+    song_stages.prefetch(unchanged, (stage_cache.AUDIO_FEATURES, stage_cache.NLU))
+    return {song_id: _member_summary(song_id, aggregate.members[song_id]) for song_id in unchanged}
+
+def _member_summary(song_id, member):
+    features, nlu = _cached_analysis(song_id)
+    return {
+        'id': song_id,
+        'song_title': member['title'],
+        'artist_name': member['artist'],
+        'features': {key: (features or {}).get(key) for key in analysis_jobs.AGGREGATE_FEATURES},
+        'emotion': nlu['averageEmotion'] if nlu and member['lyrics'] else None,
+        'degraded': member['degraded'],
+    }
 
+def _job_finish(kind, token, params):
+    # every song is in the stage cache by now, this only adds them up
+    if kind == 'liked':
+        return _liked_analysis_content(token, params.get('user_id'))
+    if kind == 'albums':
+        return _album_analysis_content(token, params.get('user_id'))
+    if kind == 'playlists':
+        return _playlist_analysis_content(token, params.get('user_id'))
+    if kind == 'recent':
+        return _recent_analysis_content(token, params['tracks'])
+    raise ValueError(f"unknown analysis job kind {kind!r}")
+
+def _job_token(params):
+    return fresh_spotify_token(params.get('user_id'))
+
+def analysis_worker(**kwargs):
+    """A worker for the analysis job queue (worker.py runs these in their own processes)"""
+    # song_db.store is the write-behind queue, flushed so finished songs are on disk before their task is done
+    return analysis_jobs.Worker(analysis_jobs_manager.queue, _job_token, _job_songs, _job_analyze, _job_finish,
+                                flush=song_db.store.flush, known=_job_known, **kwargs)
+
+# workers inside the web app (ANALYSIS_EMBEDDED_WORKERS, 0 when worker.py processes do the work)
+# started with the first request, so scripts importing this module (warm_cache.py, worker.py) don't get them
+_embedded_workers = []
+_embedded_workers_lock = threading.Lock()
+
+@application.before_request
+def _start_embedded_workers():
+    if _embedded_workers:
+        return
+    with _embedded_workers_lock:
+        if not _embedded_workers:
+            count = int(os.getenv('ANALYSIS_EMBEDDED_WORKERS', '1'))
+            _embedded_workers.extend(analysis_worker().start() for _ in range(count))
+            _embedded_workers.append(None)  # started (even with none configured)
+
+
+
+# CACHE METRICS (see cache_stats.py)
+# disabled unless ADMIN_TOKEN is set, send it as X-Admin-Token (or ?token=)
+@application.route('/admin/cache-stats', methods=['GET'])
+def cache_stats():
+    admin_token = os.getenv('ADMIN_TOKEN')
+    supplied = flask.request.headers.get('X-Admin-Token') or flask.request.args.get('token', '')
+    if not admin_token or not hmac.compare_digest(supplied, admin_token):
+        flask.abort(404)
+
+    top = flask.request.args.get('top', default=10, type=int)
+    # stage counters of worker.py processes come from the queue, everything else below is this process's own
+    workers = analysis_jobs_manager.queue.worker_metrics()
+    report = cache_metrics.combine([song_stages.metrics.snapshot(top=top), *workers.values()], top=top)
+    report['scope'] = {
+        # stages and most_expensive_misses
+        'cache_metrics': ['web app', *workers],
+        # memory_cache, write_behind, http_pools, pipeline, breakers, ...
+        'everything_else': 'web app',
+    }
+    usage = song_db.usage()
+    for stage, counts in usage.items():
+        report['stages'].setdefault(stage, {}).update(counts)
+    report['stale'] = dict(song_stages.stale)
+    report['dead_ends'] = song_stages.negative_stats()
+    report['single_flight'] = song_stages.flights.stats()
+    report['memory_cache'] = song_db.cache.stats()
+    write_behind = song_db.store
+    report['write_behind'] = {
+        'pending': write_behind.pending(),
+        'flushes': write_behind.flushes,
+        'flushed_records': write_behind.flushed_records,
+    }
+    report['http_pools'] = http_client.stats()
+    report['spotify'] = spotify_api.stats()
+    report['breakers'] = circuit_breaker.snapshot()
+    report['pipeline'] = song_pipeline.stats()
+    report['analysis_jobs'] = analysis_jobs_manager.stats()
+    report['artist_cache'] = dict(artist_resolver.cache.stats(), fetched=artist_resolver.fetched)
+    return jsonify(report)
 
 
 
@@ -1185,7 +1413,7 @@ def authorize_spotify_NO_USER():
     data['grant_type'] = "client_credentials"
 
 
-    r = requests.post(url, headers=headers, data=data).json()
+    r = http_client.post(url, headers=headers, data=data).json()
 
     token = r['access_token']
     return token
@@ -1232,7 +1460,7 @@ def _retrieve_refreshable_token(auth_code):
     data['redirect_uri'] = spotify_callbackURL
 
     try:
-        r = requests.post(url, headers=headers, data=data)
+        r = http_client.post(url, headers=headers, data=data)
         r.raise_for_status()
         response_data = r.json()
         
@@ -1262,7 +1490,7 @@ def _refresh_spotify_token(refresh_token):
     data['refresh_token'] = refresh_token
 
     try:
-        r = requests.post(url, headers=headers, data=data)
+        r = http_client.post(url, headers=headers, data=data)
         r.raise_for_status()
         response_data = r.json()
         
@@ -1287,7 +1515,7 @@ def _retrieve_genius_token(auth_code):
     }
     
     try:
-        r = requests.post(url, data=data)
+        r = http_client.post(url, data=data)
         r.raise_for_status()  # Raise exception for bad status codes
         
         response_data = r.json()
@@ -1317,129 +1545,70 @@ def Oauth_function(base_url, CLIENT_ID, callback, scope, clientsECRET, res_type)
 
 
 # SPOTIFFY ENDPOINTS
+# rate limiting and retries live in spotify_api.get, only a 401 means the user has to log in again
 def fetch_spotify_data(token , endpoint ):
     try:
-        headers = {"Authorization": "Bearer " + token}
-        response = requests.get(url=endpoint, headers=headers)
+        response = spotify_api.get(token, endpoint)
+        if response.status_code == 401:
+            print(f"\n{_remote_addr()} -------\nERROR spotify token expired or revoked \n")
+            _flag_spotify_expired()
+            return f"ERROR"
         response.raise_for_status()
         res = response.json()
         
         if 'error' in res:
             error_msg = res['error'].get('message', 'Unknown error')
-            print(f"\n{flask.request.remote_addr} -------\nERROR {error_msg} \n")
-            flask.session['spotify_expired'] = True
+            print(f"\n{_remote_addr()} -------\nERROR {error_msg} \n")
+            if res['error'].get('status') == 401:
+                _flag_spotify_expired()
             return f"ERROR"
         
         return res
+    except spotify_api.RateLimited as e:
+        print(f"\n{_remote_addr()} -------\nRATE LIMITED: {str(e)} \n")
+        return f"ERROR"
     except requests.exceptions.RequestException as e:
-        print(f"\n{flask.request.remote_addr} -------\nREQUEST ERROR: {str(e)} \n")
-        flask.session['spotify_expired'] = True
+        print(f"\n{_remote_addr()} -------\nREQUEST ERROR: {str(e)} \n")
         return f"ERROR"
     except Exception as e:
-        print(f"\n{flask.request.remote_addr} -------\nUNEXPECTED ERROR: {str(e)} \n")
-        flask.session['spotify_expired'] = True
+        print(f"\n{_remote_addr()} -------\nUNEXPECTED ERROR: {str(e)} \n")
         return f"ERROR"
 
+# the analysis functions also run outside a request (warm_cache.py), there is no session there
+def _remote_addr():
+    return flask.request.remote_addr if flask.has_request_context() else 'background'
+def _flag_spotify_expired():
+    if flask.has_request_context():
+        flask.session['spotify_expired'] = True
 
 
 
 
-# grab music groups
-def user_likes(token):
-   
-    # LOOKUP SONGS
-    # headers = {"Authorization": "Bearer " + token}
-    results = fetch_spotify_data(token , 'https://api.spotify.com/v1/me/tracks' )
-    all_songs = []
-    totalLikedSongs = int(results['total'])
-    while results:   
-        for idx, item in enumerate(results['items']):
-            track = item['track']
-            song_info = {
-                "artists"  : [  track['artists'][i]['name']  for i in range(len(track['artists']))  ],
-                "name"  :  track['name'] ,
-                "id"  :  track['id'],
-                "popularity"  :  track['popularity']
-            }
-            all_songs.append( song_info )
-       
-        #next page check
-        if results['next']: 
-            results = fetch_spotify_data(token , results['next'] )
-        else:
-            results = None
-
-    return all_songs
-def user_albums(token):
-    playlistUrl = f"https://api.spotify.com/v1/me/albums"
-    headers = {"Authorization": "Bearer " + token}
-    results = requests.get(url=playlistUrl, headers=headers).json()
-
-    # GRAB ALBUMS
-    all_albums = {}
-    count = 0
-    while results:  
-        for item in results['items']:
-            album = item['album']
-            all_albums[count] =  {
-                'name' : item['album']['name'],
-                "genres" : album['genres'],
-                "id" : album['id'],
-                "popularity" : album['popularity'],
-                "songs" : [],
-            }
-            # ADD SONGS
-            for track in item['album']['tracks']['items']:
-                all_albums[count]['songs'].append(   (track['id'] , track['name']    ,  [i['name'] for i in track['artists']  ]  )   )
-            count += 1
-
-        if results['next']: #next page check
-            results = requests.get(url=results['next'], headers=headers).json()
-        else:
-            results = None
-    
-    
-    
-    return all_albums
-def user_playlists(token):
-    playlistUrl = f"https://api.spotify.com/v1/me/playlists"
-    headers = {"Authorization": "Bearer " + token}
-    results = requests.get(url=playlistUrl, headers=headers).json()
-
-    all_playlists = {}
-    count = 0
-    # EVERY PLAYLIST
-    while results:   
-        for item in results['items']:
-            all_playlists[count] =  {
-                'owner' : item['owner']['display_name'],
-                'name' : item['name'],
-                "description" : item['description'],
-                "id" : item['id'],
-                "songs" : [],
-            }
-
-            # LOOKUP SONGS (pagination using key next)
-            pl_tracks_call = requests.get(url=item['tracks']['href'] , headers = headers).json()
-            while pl_tracks_call:
-                for track in pl_tracks_call['items']:
-                    
-                    all_playlists[count]['songs'].append(   (track['track']['id'] , track['track']['name']  ,[ i['name'] for i in track['track']['artists']  ] )   )
-            
-                # PAGINATION [TRACKS]
-                if pl_tracks_call['next']:
-                    pl_tracks_call = requests.get(url=pl_tracks_call['next'] , headers = headers).json()
-                else:
-                    pl_tracks_call = None
-            
-            count += 1
 
-         # PAGINATION [PLAYLISTS]
-        if results['next']:
-            results = requests.get(url=item['next'] , headers = headers).json()
-        else:
-            results = None
-    return all_playlists
+# grab music groups
+# mirrored per user in the song store, repeat visits only download what changed (see library_sync.py)
+def _library_user():
+    return flask.session.get('user_id') if flask.has_request_context() else None
+
+def user_likes(token, user_id=None):
+    return library.likes(token, user_id or _library_user())
+def user_albums(token, user_id=None):
+    # numbered from zero like the rest of the group code expects
+    return dict(enumerate(library.albums(token, user_id or _library_user())))
+def user_playlists(token, user_id=None):
+    return dict(enumerate(library.playlists(token, user_id or _library_user())))
+
+# artist thumbnails for track rows, cached for every user (ARTIST_CACHE_TTL_SECONDS)
+def _main_artist_id(track):
+    if track.get('artists'):
+        return track['artists'][0].get('id')
+    return None
+def _artist_thumbnails(token, tracks):
+    try:
+        return artist_resolver.thumbnails(token, [_main_artist_id(track) for track in tracks], '/static/fallback.svg')
+    except Exception as e:
+        print(f"ERROR: Failed to resolve artist thumbnails: {e}")
+        return {}
 
 def user_recently_played(token, limit=20):
     """Fetch user's recently played tracks from Spotify"""
@@ -1453,18 +1622,12 @@ def user_recently_played(token, limit=20):
             return []
         
         recent_tracks = []
+        # artist images for thumbnails, every main artist in one batched call
+        thumbnails = _artist_thumbnails(token, [item['track'] for item in results.get('items', [])])
         for item in results.get('items', []):
             track = item['track']
             played_at = item['played_at']
-            
-            # Get artist image for thumbnail
-            thumbnail = '/static/fallback.svg'
-            if track.get('artists') and len(track['artists']) > 0:
-                artist_href = track['artists'][0].get('href')
-                if artist_href:
-                    artist_data = fetch_spotify_data(token, artist_href)
-                    if artist_data != "ERROR" and artist_data.get('images'):
-                        thumbnail = artist_data['images'][-1]['url']
+            thumbnail = thumbnails.get(_main_artist_id(track), '/static/fallback.svg')
             
             # GET TRACK INFO
             track_info = {
@@ -1491,31 +1654,153 @@ def user_recently_played(token, limit=20):
 
 # song AI  analysis 
 def _song_analysis_details(token , song_id , details : bool , song_title , artist_name): 
+    job = _song_job(token, song_id)
+
+    # SONG DETAIL DOUBLE FEATURE of the function
+    if details:
+        job = _stage_spotify(job)
+        if job is None:
+            return None
+        try:
+            analysis = spotify_api.get(token, job['features']['analysis_url']).json()
+            pprint.pprint( analysis.keys()  );print("\n")
+            pprint.pprint( analysis['track']   )
+            return analysis
+        except Exception as e:
+            print(f"ERROR: Failed to fetch detailed analysis: {e}")
+            return None
+
+    # one song runs the pipeline stages one after another, groups go through song_pipeline (_analyze_songs)
+    for stage in song_pipeline.stages:
+        job = stage.func(job)
+        if job is None:
+            return None
+    return _song_result(job)
 
-    # check if song in database already
+# per-song analysis in stages: spotify track + audio features -> genius search -> lyrics page -> watson nlu
+# a job dict is handed from stage to stage, a stage returning None ends the song (its result is None)
+def _song_job(token, song_id):
+    return {'token': token, 'id': song_id, 'song_url': None, 'lyrics': None, 'nlu': None, 'degraded': set()}
+
+def _tracked(stage):
+    # upstreams the stage skipped because their circuit is open end up in the song's 'degraded'
+    def run(job):
+        circuit_breaker.reset_skipped()
+        try:
+            return stage(job)
+        finally:
+            job['degraded'].update(circuit_breaker.skipped())
+    return run
+
+def _stage_spotify(job):
+    token, song_id = job['token'], job['id']
+
+    # SPOTIFY TRACK (title + main artist used for the lyric search)
+    track = song_stages.get_or_fill(stage_cache.TRACK, song_id, lambda: _fetch_track(token, song_id))
+    if track is None:
+        return None
+    job['song_title'] = track['name']
+    job['artist_name'] = track['artists'][0]
+
+    # SPOTIFY AUDIO FEATURES
+    features = song_stages.get_or_fill(stage_cache.AUDIO_FEATURES, song_id, lambda: _fetch_audio_features(token, song_id, job['song_title'], job['artist_name']))
+    if features is None:
+        return None
+    job['features'] = features
+    return job
+
+def _stage_genius(job):
+    # genius page for the song, not needed when its lyrics are cached already
+    found, lyrics = song_stages.lookup(stage_cache.LYRICS, job['id'])
+    if found:
+        job['lyrics'] = lyrics
+        return job
     try:
-        with open('song_db.json' , "r") as db:
-            loaded = json.load(db)
-            if song_id in loaded:
-                return loaded[song_id]
-    except (FileNotFoundError, json.JSONDecodeError):
-        # Create empty database if it doesn't exist
-        loaded = {}
+        job['song_url'] = song_stages.get_or_fill(stage_cache.GENIUS_URL, job['id'], lambda: _genius_song_url(job['song_title'], job['artist_name']))
+    except requests.exceptions.RequestException as e:
+        _no_lyrics(job, e)
+    return job
 
-    endpoint = f"https://api.spotify.com/v1/audio-features/{song_id}"
+def _stage_lyrics(job):
+    if job['song_url'] is None:
+        return job
+    try:
+        job['lyrics'] = song_stages.get_or_fill(stage_cache.LYRICS, job['id'], lambda: _webcrawl_lyrics(job['song_url']))
+    except requests.exceptions.RequestException as e:
+        _no_lyrics(job, e)
+    return job
+
+def _no_lyrics(job, error):
+    # genius down or its circuit open: the song goes on without lyrics, nothing cached so it is retried later
+    print(f"WARNING: no lyrics for {job['song_title']} by {job['artist_name']}: {error}")
+
+def _stage_watson(job):
+    print(f"\nAnalyzing {job['artist_name']} : {job['song_title']}")
+    if not job['lyrics']:
+        print("No lyrics found\n")
+        return job
+
+    # raw watson model and the averages over it are cached apart,
+    # so a change to averages_calc never has to pay for watson again
+    found, nlu = song_stages.lookup(stage_cache.NLU, job['id'])
+    if not found:
+        model = song_stages.get_or_fill(stage_cache.WATSON, job['id'], lambda: _watson_model(job['lyrics']))
+        if model is not None:
+            nlu = song_stages.get_or_fill(stage_cache.NLU, job['id'], lambda: _watson_averages(model))
+    job['nlu'] = nlu
+    return job
+
+def _song_result(job):
+    # append WATSON AI to SOTIFY results  (master dictionary of clean watson frequencies)
+    # copy, the features dict is shared with the stage cache
+    res = dict(job['features'])
+    res['ai'] = {
+        'lyrics' : job['lyrics'],
+        'nlu' : job['nlu'],
+    }
+    res['song_title'] = job['song_title']
+    res['artist_name'] = job['artist_name']
+    res['degraded'] = circuit_breaker.labels(sorted(job['degraded']))
+    return res
+
+def _fetch_track(token, song_id):
     titleInfo = fetch_spotify_data(token, f'https://api.spotify.com/v1/tracks/{song_id}')
     
     if titleInfo == "ERROR":
         print(f"ERROR: Failed to fetch track info for {song_id}")
         return None
         
+    track = _trim_track(titleInfo)
+    if track is None:
+        print(f"ERROR: Invalid track info structure for {song_id}")
+    return track
+
+def _trim_track(titleInfo):
+    # only what the analysis needs, not the whole track object
     try:
-        song_title = titleInfo['name']  
-        artist_name = titleInfo['artists'][0]['name']
+        return {
+            'id': titleInfo['id'],
+            'name': titleInfo['name'],
+            'artists': [artist['name'] for artist in titleInfo['artists']],
+            'album': (titleInfo.get('album') or {}).get('name'),
+            'popularity': titleInfo.get('popularity', 0),
+        }
     except (KeyError, IndexError, TypeError):
-        print(f"ERROR: Invalid track info structure for {song_id}")
         return None
 
+# fills the track and audio feature stages of a whole group with the multi-id endpoints
+# (50 tracks / 100 audio features per call), songs still missing afterwards fall back to one call each
+def _prefetch_spotify_stages(token, song_ids):
+    song_ids = [song_id for song_id in song_ids if song_id]
+    tracks = song_stages.fill_many(stage_cache.TRACK, song_ids, lambda ids: {
+        song_id: _trim_track(track) for song_id, track in spotify_api.tracks(token, ids).items() if track
+    })
+    features = song_stages.fill_many(stage_cache.AUDIO_FEATURES, song_ids, lambda ids: spotify_api.audio_features(token, ids))
+    print(f"INFO: batch fetched {tracks} track(s) and {features} audio feature set(s) for {len(song_ids)} song(s)")
+
+def _fetch_audio_features(token, song_id, song_title, artist_name):
+    endpoint = f"https://api.spotify.com/v1/audio-features/{song_id}"
+
     # fetch data
     res = fetch_spotify_data(token , endpoint )
     
@@ -1525,8 +1810,7 @@ def _song_analysis_details(token , song_id , details : bool , song_title , artis
         print(res)
         # Additional debugging for 403 errors
         try:
-            headers = {"Authorization": "Bearer " + token}
-            response = requests.get(url=endpoint, headers=headers)
+            response = spotify_api.get(token, endpoint, max_retries=0)
             
             if response.status_code == 403:
                 print(f"DEBUG: 403 Forbidden - Checking token scopes...")
@@ -1551,17 +1835,6 @@ def _song_analysis_details(token , song_id , details : bool , song_title , artis
         
         return None
 
-    # SONG DETAIL DOUBLE FEATURE of the function
-    if details:
-        try:
-            analysis = requests.get( url = res['analysis_url'], headers = {"Authorization": "Bearer " + token} ).json()
-            pprint.pprint( analysis.keys()  );print("\n")
-            pprint.pprint( analysis['track']   )
-            return analysis
-        except Exception as e:
-            print(f"ERROR: Failed to fetch detailed analysis: {e}")
-            return None
-
     # check if response was a dictionary
     if isinstance(res , dict):
         pass
@@ -1569,95 +1842,62 @@ def _song_analysis_details(token , song_id , details : bool , song_title , artis
         print(f"ERROR: Invalid response type for {song_id}: {type(res)}")
         return None
 
-    # API COOL DOWN ERROR HANDLING
-    while 'error' in res.keys():
-        print(f'< {song_id} > got an error\n waiting for api cooldown')
-        time.sleep(API_COOLDOWN_RATE)
-        res = _song_analysis_details(token, song_id , details, song_title, artist_name )
-    
-    # append WATSON AI to SOTIFY results  (master dictionary of clean watson frequencies)
-    res['ai'] = _watson_lyric_analysis( song_title, artist_name)
-    res['song_title'] = song_title
-    res['artist_name'] = artist_name
+    return res
 
-    # adding items to song_db.json DATABASE
+def _watson_model(lyrics):
+    # INSTEAD OF GRABBING AI RESPONSE FOR EACH BAR... JUST RUN THE WHOLE LYRIC STRING
+    watson_input = ""
     try:
-        with open('song_db.json' , 'r') as db:
-            loaded = json.load( db )
-            loaded[song_id] = res
-        with open('song_db.json' , 'w') as db:
-            db.write( json.dumps(loaded) )
+        # APPEND LYRICS
+        for bar in lyrics:
+            watson_input += f"{bar} "
+        # GET WATSON INFO (shares the per-host concurrency caps of http_client, skipped while watson's circuit is open)
+        with http_client.host_slot('watson'), watson_breaker.guard(_watson_outage):
+            return watson.ai_to_Text( watson_input )
+
+    except circuit_breaker.CircuitOpen as e:
+        # nothing cached, the song gets its watson analysis once watson is back
+        print(f"WARNING: {e}")
+        return None
     except Exception as e:
-        print(f"ERROR: Failed to save to database: {e}")
-
-    return res
+        print(f'\n\nWATSON API ERROR: {e}\n\n\n{watson_input}\n')
+        return stage_cache.Negative(stage_cache.WATSON_ERROR)
 
-def _watson_lyric_analysis(  song_title, artist_name):
-    print(f"\nAnalyzing {artist_name} : {song_title}")
-    genius_token = flask.session.get("genius_token")
-    lyrics = _request_song_info(genius_token , song_title , artist_name )
-
-    # NLU
-    song_ai = []
-    nlu = None
-    if lyrics:
-        # INSTEAD OF GRABBING AI RESPONSE FOR EACH BAR... JUST RUN THE WHOLE LYRIC STRING
-        watson_input = ""
-        try:
-            # APPEND LYRICS
-            for bar in lyrics:
-                watson_input += f"{bar} "
-            # GET WATSON INFO
-            nlu = watson.ai_to_Text( watson_input )
-            # AVERAGE CALC IS RETURNING CLEAN DATA by reading an array,
-            # WE PLACE ONE ITEM IF WE DECIDE TO RUN LYRICS AS ONE
-            nlu =  watson.averages_calc(   [  nlu  ]   )
+# a 4xx (lyrics too short, unsupported language) is about the input, not watson being down
+def _watson_outage(error):
+    code = getattr(error, 'code', None)
+    return not isinstance(code, int) or code >= 500 or code == 429
 
-        except Exception as e:
-            nlu = None
-            print(f'\n\nWATSON API ERROR: {e}\n\n\n{watson_input}\n')
-    else:
-        print("No lyrics found\n")
+def _watson_averages(model):
+    # AVERAGE CALC IS RETURNING CLEAN DATA by reading an array,
+    # WE PLACE ONE ITEM IF WE DECIDE TO RUN LYRICS AS ONE
+    return watson.averages_calc(   [  model  ]   )
 
-    context = {
-        'lyrics' : lyrics,
-        'nlu' : nlu,
-        # 'tone' : tone
-    }
-    return context
-
-def _request_song_info(token, song_title, artist_name):
+def _genius_song_url(song_title, artist_name):
     base_url = 'https://api.genius.com'
     # Use the stored Genius API key directly
     headers = {'Authorization': 'Bearer ' + genius_api_key}
     search_url = base_url + '/search'
     data = {'q': song_title + ' ' + artist_name}
-    response = requests.get(search_url, data=data, headers=headers).json()
+    response = http_client.get(search_url, data=data, headers=headers).json()
 
     # Search for matches in the request response
-    remote_song_info = None
     for hit in response['response']['hits']:
         if artist_name.lower() in hit['result']['primary_artist']['name'].lower():
-            remote_song_info = hit
-            break
-
-    # Extract lyrics from URL if the song was found
-    if remote_song_info:
-        song_url = remote_song_info['result']['url']
-        return _webcrawl_lyrics(song_url)
-    else:
-        return None
+            return hit['result']['url']
+    return stage_cache.Negative(stage_cache.NO_HIT)
 
+# NOTE: bump stage_cache.STAGE_VERSIONS['lyrics'] when changing how bars are split
 def _webcrawl_lyrics(url):
     # EXTRACT HTML
-    page = requests.get(url)
+    page = http_client.get(url)
     html = bs4.BeautifulSoup(page.text, 'html.parser')
 
     try:
         lyrics = html.find("div", {"id": "lyrics-root-pin-spacer"}).get_text()
     except Exception as e:
         print(  '\ndef _webcrawl_lyrics(url):\nERROR FINDING LYRICS: ' , str(e))
-        return None
+        return stage_cache.Negative(stage_cache.PARSE_FAILED)
 
 
     
@@ -1694,7 +1934,7 @@ def _webcrawl_lyrics(url):
     if all_bars[-1] == "Embed":
         all_bars.pop(-1)
     if len(all_bars) <= 3:
-        all_bars = None
+        return stage_cache.Negative(stage_cache.TOO_SHORT)
 
     return all_bars
 
@@ -1703,366 +1943,66 @@ def _webcrawl_lyrics(url):
 
 # music group analysis
 
-def group_music_analysis(token , group:dict() ):
-    final  = {
-        'acousticness' : [],
-        'danceability' : [],
-        'duration_ms' : [],
-        'energy' : [],
-        'instrumentalness' : [],
-        'liveness' : [],
-        'loudness' : [],
-        'speechiness' : [],
-        'tempo' : [],
-        'valence' : [],
-        'ai' : []
-    }
-
-    # songs found by WATSON
-    watson_arr = []
-
-    for album in group:
-        print("\n\n--------" ,  group[album]["name"] , "------"  )
-        for song in group[album]['songs']:
-            song_id = song[0]
-            song_name = song[1]
-            song_artists = song[2] #main artist is item number 0
-            analysis = _song_analysis_details(token,  song_id , False ,  song_name , song_artists[0] )
-            
-            # check if response returned a dictionary
-            if isinstance(analysis , dict):
-                pass
-            else:
-                print('\n----- DEBUG -----\n------ group_music_analysis(token , group:dict() ) --------')
-                print("Spotify returned a Response type instead of JSON")
-                continue
-
-
-            # populates all songs into final song_stat variable
-            for x in final.keys():
-                final[x].append(analysis[x])
-                
-            # check if watson ai
-            if analysis['ai']['nlu'] is not None:
-                print("☁☁☁")
-                watson_arr.append(  (analysis['song_title'] , analysis['artist_name']  )   )
-
-
-
-    # AVERAGING  SPOTIFY  #every key except ["ai"]
-    spotty_keys = list(final.keys())[:-1]
-    for attribute in spotty_keys:
-        final[attribute] =  statistics.mean(final[attribute])
-    
-
-
-    # ----------------AVERAGING WATSON for FINAL ["ai"]   --------------------
-    group_merge_ai = {}
-
-    # CHECKING FOR PROPER nlu DICTIONARY && creating merged dict...
-    solid_nlu = False
-    for x in range(  len(final['ai'])   ):
-        if final['ai'][x]['nlu'] is not None :
-            solid_nlu = True
-            good_dict = final['ai'][x]['nlu']
-            break
-    if solid_nlu:
-        for key in good_dict :
-            if key =='averageEmotion':
-                group_merge_ai[key] = []
-                continue
-            group_merge_ai[key] = {}
-            for inner_keys in good_dict[key]:
-                group_merge_ai[key][inner_keys] = []
-    else: #IMPORTANT CATCH IF NO AI
-        final['ai'] = None
-        return final 
-
-
-    # # # DEBUG
-    # with open("group_merge_ai.json" , "a") as output:
-    #     json.dump(group_merge_ai, output, indent = 2)
-
-
-    # merge all values in NLU into group_merge_ai
-    for x in range( 0 ,   len(final['ai'])   ,   1  ):
-        NLU = final['ai'][x]['nlu']
-        
-        # APPEND ALL WATSON DATA INTO group_merge_ai , otherwise ignore it and move on
-        if NLU is not None :
-            # append all group emotions ------> EMOTIONS
-            group_merge_ai['averageEmotion'].append(NLU['averageEmotion'])
-
-            # create dict keys for all concept frequencies  ------> CONCEPTS
-            singularities = []
-            for i in NLU['conceptfrequencies']:
-                # Singular keys found with empty arr
-                if len( NLU['conceptfrequencies'][i] ) < 1:
-                    print("DEBUG full group: singularity:   ", i)
-                    singularities.append(i)
-                    continue
-                # if there the key already exists!
-                if i in group_merge_ai['conceptfrequencies']:
-                    # ITERATE THROUGH NLU['conceptfrequencies'][i]
-                    for concept in NLU['conceptfrequencies'][i]:
-                        if isinstance(concept, str):
-                            group_merge_ai['conceptfrequencies'][i].append(concept)
-                        elif isinstance(concept, list):
-                            for inner_concept in concept:
-                                group_merge_ai['conceptfrequencies'][i].append(inner_concept)
-                else:
-                    # if the concept is not in the dictionary as a key... add it with it's coentents as well
-                    # print(NLU['conceptfrequencies'][i] )
-                    group_merge_ai['conceptfrequencies'][i] = []
-                    for concept in NLU['conceptfrequencies'][i]:
-                        if isinstance(concept, str):
-                            group_merge_ai['conceptfrequencies'][i].append(concept)
-                        elif isinstance(concept, list):
-                            for inner_concept in concept:
-                                group_merge_ai['conceptfrequencies'][i].append(inner_concept)
-            NLU['conceptfrequencies']['singularities'] = singularities
-
-
-            # goes through dictionary and populates the merge
-            for key in NLU.keys():
-                if key == "averageEmotion" or  key == "conceptfrequencies":
-                    continue
-                for i in NLU[key]:
-                    if isinstance(NLU[key][i], int):
-                        if  i  in group_merge_ai[key]:
-                            if isinstance(group_merge_ai[key][i], list):
-                                group_merge_ai[key][i] = 1
-                            else:
-                                group_merge_ai[key][i] +=  NLU[key][i]
-                        else:
-                             group_merge_ai[key][i] = NLU[key][i]
-                    else:
-                        # print( group_merge_ai[key][i]  ) #/// VARIALE IN QUESION!
-                        if i  in group_merge_ai[key]:
-                            group_merge_ai[key][i].extend(  NLU[key][i]    )
-                        else:
-                            group_merge_ai[key][i] = NLU[key][i]
-
-    # OVER ALL EMOTION AVERAGE
-    temp = {
-        "Anger": [],
-        "Disgust": [],
-        "Fear": [],
-        "Joy": [],
-        "Sadness": []
-      }
-    for x in  range( 0 , len(group_merge_ai['averageEmotion'])  ,   1 ):
-        for key in group_merge_ai['averageEmotion'][x]:
-            temp[key].append(group_merge_ai['averageEmotion'][x][key])
-    # replace vars 
-    for emotion in temp:
-        temp[emotion] = statistics.mean(temp[emotion])
-
-
-    # LISTS BECOMES MERGED DICTIONARIES
-    group_merge_ai['amount'] = len(group_merge_ai['averageEmotion']) #FIND AMOUNT OF ANALYZED SONGS  
-    group_merge_ai['averageEmotion'] = temp
-    final['ai'] = group_merge_ai
-    
-    # remember watson_arr? 
-    final['ai']['watson_songs'] = watson_arr
-    
-
-
-    # # DEBUG
-    # with open("final.json" , "a") as output:
-    #     json.dump(final, output, indent = 2)
-
-    return final 
-
-def liked_group_average(token , group : list()  ): 
-
-    #  -------   spotify OUTPUT VARIABLES    -------
-    # populate song arr
-    song_stats  = {
-        'acousticness' : [],
-        'danceability' : [],
-        'duration_ms' : [],
-        'energy' : [],
-        'instrumentalness' : [],
-        'liveness' : [],
-        'loudness' : [],
-        'speechiness' : [],
-        'tempo' : [],
-        'valence' : [],
-        'ai' : []
-    }
-    # populating song_stats arrays with song stats.
-    each_song_stats = {}
-
-    # WATSON ai found songs
-    watson_arr = []
-    
-    # iterate through each sonf in group ----> (group is a list)
-    for song in group :
-        name = song['name']
-        song_id = song['id']
-        # Song == a specific song's clean data //phase 0
-        song = _song_analysis_details(token, song_id , False ,  name , song['artists'][0] )
-        # append data to keys of 
-        for x in song_stats.keys():
-            song_stats[x].append(song[x])
-       
-
-        # ADD FINAL SONG PRODUCT as a key in each_song_stats
-        each_song_stats[name] = song
-
-        # check if watson ai
-        if song['ai']['nlu'] is not None:
-            print("☁")
-            watson_arr.append(  ( song['song_title'] , song['artist_name'] )    )
-
-
- 
- 
-    #    DEBUG
-        # each_song_stats[song_id] = song
-        # print(each_song_stats[name]['id'])
-
-
-
-
-    # ****************
-    # AT THIS POINT song_stats is a dictionary that holds arrays populated with all the user's liked music
-    # this is to analyse the average of the whole playlist
-    # ****************
-
-
-
-    # averaging spotify (turning each key into it's average)
-    spotty_keys = list(song_stats.keys())[:-1]  #every key except ["ai"]
-    for x in spotty_keys:
-        song_stats[x] =  statistics.mean(song_stats[x])
-
-
-
-
-    # averaging watson    ["ai"]
-    #  -------  watson  OUTPUT VARIABLES    -------
-    group_merge_ai = {}
-
-    # CHECKING FOR PROPER nlu DICTIONARY && creating merged dict...
-    solid_nlu = False
-    for x in range(len(song_stats['ai'])):
-        if song_stats['ai'][x]['nlu'] :
-            solid_nlu = True
-            good_dict = x
-            break
-    if solid_nlu:
-        for key in song_stats['ai'][x]['nlu']:
-            if key =='averageEmotion':
-                group_merge_ai[key] = []
-                continue
-            group_merge_ai[key] = {}
-            for inner_keys in song_stats['ai'][x]['nlu'][key]:
-                group_merge_ai[key][inner_keys] = []
-    else: #IMPORTANT CATCH IF NO AI
-        song_stats['ai'] = None
-
-        return song_stats , each_song_stats
-
-    #    NLU IS EACH ITEM IN THE SONG_STATS['ai']  ---> which needs to become a grouped dict of lists avg!!!!!
-
-
-    # iterate through every SONG TEXT and grab nlu
-    # merge all values in NLU into group_merge_ai
-    for x in range( 0 ,   len(song_stats['ai'])   ,   1  ):
-        NLU = song_stats['ai'][x]['nlu']
-
-        if NLU is not None :
-            # append all group emotions ------> EMOTIONS
-            group_merge_ai['averageEmotion'].append(NLU['averageEmotion'])
-
-            # create dict keys for all concept frequencies  ------> CONCEPTS
-            singularities = []
-            for i in NLU['conceptfrequencies']:
-                # Singular keys found with empty arr
-                if len( NLU['conceptfrequencies'][i] ) < 1:
-                    # print("DEBUG: singularity:   ", i)
-                    singularities.append(i)
-                    continue
-                # if there the key already exists!
-                if i in group_merge_ai['conceptfrequencies']:
-                    # ITERATE THROUGH NLU['conceptfrequencies'][i]
-                    for concept in NLU['conceptfrequencies'][i]:
-                        if isinstance(concept, str):
-                            group_merge_ai['conceptfrequencies'][i].append(concept)
-                        elif isinstance(concept, list):
-                            for inner_concept in concept:
-                                group_merge_ai['conceptfrequencies'][i].append(inner_concept)
-                else:
-                    # if the concept is not in the dictionary as a key... add it with it's coentents as well
-                    # print(NLU['conceptfrequencies'][i] )
-                    group_merge_ai['conceptfrequencies'][i] = []
-                    for concept in NLU['conceptfrequencies'][i]:
-                        if isinstance(concept, str):
-                            group_merge_ai['conceptfrequencies'][i].append(concept)
-                        elif isinstance(concept, list):
-                            for inner_concept in concept:
-                                group_merge_ai['conceptfrequencies'][i].append(inner_concept)
-            NLU['conceptfrequencies']['singularities'] = singularities
-
-
-            # goes through dictionary and populates the merge
-            for key in NLU.keys():
-                if key == "averageEmotion" or  key == "conceptfrequencies":
-                    continue
-                for i in NLU[key]:
-                    if isinstance(NLU[key][i], int):
-                        if  i  in group_merge_ai[key]:
-                            if isinstance(group_merge_ai[key][i], list):
-                                group_merge_ai[key][i] = 1
-                            else:
-                                group_merge_ai[key][i] +=  NLU[key][i]
-                        else:
-                             group_merge_ai[key][i] = NLU[key][i]
-                    else:
-                        # print( group_merge_ai[key][i]  ) #/// VARIALE IN QUESION!
-                        if i  in group_merge_ai[key]:
-                            group_merge_ai[key][i].extend(  NLU[key][i]    )
-                        else:
-                            group_merge_ai[key][i] = NLU[key][i]
-
-
-
-
-
-
-    # Average all emotions in array
-    # OVER ALL EMOTION AVERAGE
-    temp = {
-        "Anger": [],
-        "Disgust": [],
-        "Fear": [],
-        "Joy": [],
-        "Sadness": []
-      }
-    for x in  range( 0 , len(group_merge_ai['averageEmotion'])  ,   1 ):
-        for key in group_merge_ai['averageEmotion'][x]:
-            temp[key].append(group_merge_ai['averageEmotion'][x][key])
-    # replace vars 
-    for emotion in temp:
-        temp[emotion] = statistics.mean(temp[emotion])
-
-
-
-
-    # LISTS BECOMES MERGED DICTIONARIES
-    group_merge_ai['amount'] = len(group_merge_ai['averageEmotion']) #FIND AMOUNT OF ANALYZED SONGS  
-    group_merge_ai['averageEmotion'] = temp
-    song_stats['ai'] = group_merge_ai
-
-    
-    
-    # remember watson_arr?
-    song_stats['ai']['watson_songs'] = watson_arr
-    
-    return song_stats , each_song_stats
+# the song analysis stages as a pipeline shared by every group analysis (pipeline.py), each stage with
+# its own workers so spotify lookups run ahead while watson works at its own pace
+song_pipeline = pipeline.Pipeline([
+    pipeline.Stage('spotify', _tracked(_stage_spotify), int(os.getenv('PIPELINE_SPOTIFY_WORKERS', '8'))),
+    pipeline.Stage('genius', _tracked(_stage_genius), int(os.getenv('PIPELINE_GENIUS_WORKERS', '6'))),
+    pipeline.Stage('lyrics', _tracked(_stage_lyrics), int(os.getenv('PIPELINE_LYRICS_WORKERS', '6'))),
+    pipeline.Stage('watson', _tracked(_stage_watson), int(os.getenv('PIPELINE_WATSON_WORKERS', '4'))),
+], queue_size=int(os.getenv('PIPELINE_QUEUE_SIZE', pipeline.QUEUE_SIZE)))
+
+# runs (song_id, title, main artist) songs through song_pipeline, results in the same order
+# as the songs so the group averages match a one-by-one run
+def _analyze_songs(token, song_ids):
+    jobs = song_pipeline.run(_song_job(token, song_id) for song_id in song_ids)
+    return [_song_result(job) if job is not None else None for job in jobs]
+
+# group averages come from a group_aggregates.GroupAggregate: kept per user (key) and brought up to date
+# with only the songs that joined or left the group, songs are analyzed (concurrently) only when they join
+def _aggregate_key(scope, user_id):
+    return group_aggregates.aggregate_key(scope, user_id) if user_id else None
+
+def _group_aggregate(token, song_ids, key):
+    def analyze(added):
+        # every cached stage of the new songs in one store round trip, then whatever spotify data is missing in batches
+        song_stages.prefetch(added)
+        _prefetch_spotify_stages(token, added)
+        return _analyze_songs(token, added)
+
+    aggregate = group_aggregate_store.update(key, song_ids, analyze, _cached_analysis, dict(song_stages.versions))
+    # dead ends skipped thanks to the negative cache (per reason)
+    print(f"INFO: known dead ends: {song_stages.negative_stats()}")
+    return aggregate
+
+# what a song added to a group aggregate, read back when it leaves the group
+def _cached_analysis(song_id):
+    return song_stages.get(stage_cache.AUDIO_FEATURES, song_id), song_stages.get(stage_cache.NLU, song_id)
+
+# songs whose analysis is all in the cache (no upstream call needed): audio features, and watson nlu or a remembered lyric dead end
+def _cached_songs(song_ids):
+    cached = set()
+    for song_id in song_ids:
+        if song_stages.get(stage_cache.AUDIO_FEATURES, song_id) is None:
+            continue
+        if song_stages.get(stage_cache.NLU, song_id) is not None or any(
+            song_stages.negative_reason(stage, song_id) for stage in (stage_cache.GENIUS_URL, stage_cache.LYRICS, stage_cache.WATSON)
+        ):
+            cached.add(song_id)
+    return cached
+
+def group_music_analysis(token , group:dict() , aggregate_key=None ):
+    # every song of every album / playlist, a song in two of them counts twice
+    group_ids = [song[0] for album in group for song in group[album]['songs']]
+    return _group_aggregate(token, group_ids, aggregate_key).stats(group_ids)
+
+
+
+def liked_group_average(token , group : list() , aggregate_key=None ): 
+    # averages of the group, and per song what the group page lists (by title)
+    group_ids = [song['id'] for song in group]
+    aggregate = _group_aggregate(token, group_ids, aggregate_key)
+    return aggregate.stats(group_ids) , aggregate.song_rows(group_ids)
 
 
 
@@ -2117,7 +2057,7 @@ def fetch_meme(username):
         text0, text1 = random.choice(meme_texts)
 
         # fetch all memes
-        response = requests.get('https://api.imgflip.com/get_memes')
+        response = http_client.get('https://api.imgflip.com/get_memes')
         response.raise_for_status()
         data = response.json()
         
@@ -2147,7 +2087,7 @@ def fetch_meme(username):
             'text1': text1
         }
         
-        meme_response = requests.post(URL, data=params)
+        meme_response = http_client.post(URL, data=params)
         meme_response.raise_for_status()
         result = meme_response.json()
         
@@ -2166,7 +2106,9 @@ def fetch_meme(username):
 
 
 
-application.run(host = '0.0.0.0' , port = 8080)
-# application.run( port = 8080)
+# only when run directly, warm_cache.py imports this module for the analysis functions
+if __name__ == "__main__":
+    application.run(host = '0.0.0.0' , port = 8080)
+    # application.run( port = 8080)
 
 
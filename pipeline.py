@@ -0,0 +1,171 @@
+"""
+Staged song analysis pipeline for MusicAI
+A song goes through a fixed row of stages (spotify -> genius search -> lyrics page -> watson). Every stage has
+its own workers and a bounded queue in front of it, shared by all group analyses running at the time,
+so cheap stages run ahead while a slow one (watson) works through its queue at its own pace. A group then takes
+about as long as its slowest stage instead of the sum of all of them, and full queues hold back the stages
+feeding them instead of piling up work in memory.
+Built on the fan-out engine (fanout.py): the stage workers are coroutines on one fanout.Loop, each taking
+items off its stage's asyncio queue and running the blocking stage function on the stage's executor threads.
+"""
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import fanout
+
+# items waiting in front of each stage before the stage feeding it blocks
+QUEUE_SIZE = 64
+
+
+class Stage:
+    """func(item) -> item for the next stage, or None to finish the item early (result None)"""
+
+    def __init__(self, name, func, workers):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.queue = None
+        self.executor = None
+        self.processed = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.max_queued = 0
+        self._lock = threading.Lock()
+
+    def _done(self, seconds, error=False):
+        with self._lock:
+            self.processed += 1
+            self.busy_seconds += seconds
+            if error:
+                self.errors += 1
+
+    def snapshot(self):
+        with self._lock:
+            processed, busy = self.processed, self.busy_seconds
+            stats = {'workers': self.workers, 'processed': processed, 'errors': self.errors, 'max_queued': self.max_queued}
+        stats['queued'] = self.queue.qsize() if self.queue is not None else 0
+        avg = busy / processed if processed else None
+        stats['avg_ms'] = round(avg * 1000, 2) if avg is not None else None
+        # songs per second the stage keeps up with when all its workers are busy, the lowest one is the bottleneck
+        stats['capacity_per_second'] = round(self.workers / avg, 2) if avg else None
+        return stats
+
+
+class _Run:
+    """Results of one run() call, filled in by whichever stage finishes each item"""
+
+    def __init__(self, count, on_result):
+        self.results = [None] * count
+        self.error = None
+        self.on_result = on_result
+        self._left = count
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        if not count:
+            self._done.set()
+
+    def finish(self, index, result, error=None):
+        with self._lock:
+            self.results[index] = result
+            if error is not None and self.error is None:
+                self.error = error
+            self._left -= 1
+            last = self._left == 0
+        if self.on_result is not None and error is None:
+            try:
+                self.on_result(index, result)
+            except Exception as e:
+                print(f"ERROR: pipeline result callback failed: {e}")
+        if last:
+            self._done.set()
+
+    def wait(self):
+        self._done.wait()
+
+
+class Pipeline:
+    """Long-lived stage workers, run() may be called from many threads at once"""
+
+    def __init__(self, stages, queue_size=QUEUE_SIZE, loop=None):
+        self.stages = list(stages)
+        self.queue_size = queue_size
+        self.loop = loop or fanout.Loop('pipeline')
+        self.started_at = None
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        with self._start_lock:
+            if self.started_at is not None:
+                return
+            self.loop.call(self._start_workers())
+            self.started_at = time.time()
+
+    async def _start_workers(self):
+        # queues are made on the loop that uses them
+        for position, stage in enumerate(self.stages):
+            following = self.stages[position + 1] if position + 1 < len(self.stages) else None
+            stage.queue = asyncio.Queue(maxsize=self.queue_size)
+            stage.executor = ThreadPoolExecutor(max_workers=stage.workers, thread_name_prefix=f"pipeline-{stage.name}")
+            for _ in range(stage.workers):
+                self.loop.keep(self._work(stage, following))
+
+    @staticmethod
+    async def _put(stage, work):
+        await stage.queue.put(work)
+        queued = stage.queue.qsize()
+        if queued > stage.max_queued:
+            stage.max_queued = queued
+
+    async def _feed(self, run, items):
+        for index, item in enumerate(items):
+            await self._put(self.stages[0], (run, index, item))
+
+    async def _work(self, stage, following):
+        loop = asyncio.get_running_loop()
+        while True:
+            run, index, item = await stage.queue.get()
+            started = time.perf_counter()
+            try:
+                item = await loop.run_in_executor(stage.executor, stage.func, item)
+            except Exception as e:
+                stage._done(time.perf_counter() - started, error=True)
+                await loop.run_in_executor(stage.executor, run.finish, index, None, e)
+                continue
+            stage._done(time.perf_counter() - started)
+            if item is None or following is None:
+                # on_result may block, keep it off the loop
+                await loop.run_in_executor(stage.executor, run.finish, index, item)
+            else:
+                await self._put(following, (run, index, item))
+
+    def run(self, items, on_result=None):
+        """Every item through every stage, results in item order
+
+        on_result(index, result) is called as each item finishes (from a stage worker thread).
+        The first exception raised by a stage is raised here once every item is done.
+        """
+        items = list(items)
+        run = _Run(len(items), on_result)
+        if items:
+            self._start()
+            self.loop.call(self._feed(run, items))
+        run.wait()
+        if run.error is not None:
+            raise run.error
+        return run.results
+
+    def close(self):
+        """Stop the stage workers and their loop thread, the next run() starts them again"""
+        with self._start_lock:
+            if self.started_at is None:
+                return
+            self.loop.close()
+            for stage in self.stages:
+                stage.executor.shutdown(wait=True)
+            self.started_at = None
+
+    def stats(self):
+        return {stage.name: stage.snapshot() for stage in self.stages}
@@ -0,0 +1,160 @@
+"""
+Client-side rate limiting for MusicAI's upstream APIs
+Token buckets (one for the whole app, one per access token), Retry-After parsing,
+jittered exponential backoff and a retry budget that caps retries to a share of real traffic.
+"""
+
+import hashlib
+import random
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+
+# per-token buckets kept, least recently used ones are dropped first
+MAX_KEYS = 1024
+
+
+class TokenBucket:
+    """rate tokens per second, up to capacity saved up for bursts"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self):
+        """Take a token, returns how long to wait before using it (0 when one was available)"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            return max(wait, self._paused_until - now)
+
+    def pause(self, seconds):
+        """Hand out nothing for the next seconds (server said Retry-After)"""
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._refill(now)
+            self._tokens = min(self._tokens, 0.0)
+
+
+class RateLimiter:
+    """App wide bucket plus one bucket per key (access token)"""
+
+    def __init__(self, app_rate, app_burst=None, key_rate=None, key_burst=None, sleep=time.sleep):
+        self.app = TokenBucket(app_rate, app_burst)
+        self.key_rate = key_rate
+        self.key_burst = key_burst
+        self.sleep = sleep
+        self.waited = 0.0
+        self.throttled = 0
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _bucket(self, key):
+        if self.key_rate is None or key is None:
+            return None
+        key = hashlib.sha256(key.encode('utf-8')).hexdigest()  # tokens are not kept around in clear
+        with self._lock:
+            bucket = self._keys.get(key)
+            if bucket is None:
+                bucket = self._keys[key] = TokenBucket(self.key_rate, self.key_burst)
+                if len(self._keys) > MAX_KEYS:
+                    self._keys.popitem(last=False)
+            else:
+                self._keys.move_to_end(key)
+            return bucket
+
+    def acquire(self, key=None):
+        """Block until both the app and the key may send one more request"""
+        wait = self.app.reserve()
+        bucket = self._bucket(key)
+        if bucket is not None:
+            wait = max(wait, bucket.reserve())
+        if wait > 0:
+            with self._lock:
+                self.waited += wait
+            self.sleep(wait)
+        return wait
+
+    def throttle(self, seconds, key=None):
+        """The server pushed back, hold everyone (limits are per app) for seconds"""
+        with self._lock:
+            self.throttled += 1
+        self.app.pause(seconds)
+        bucket = self._bucket(key)
+        if bucket is not None:
+            bucket.pause(seconds)
+
+    def stats(self):
+        with self._lock:
+            return {'throttled': self.throttled, 'waited_seconds': round(self.waited, 2), 'tokens_tracked': len(self._keys)}
+
+
+class RetryBudget:
+    """Retries allowed as a ratio of requests, so a struggling upstream isn't flooded with retries
+
+    Every request adds `ratio` to the budget, every retry spends 1. `min_retries` are always available.
+    """
+
+    def __init__(self, ratio=0.2, min_retries=10, max_balance=100):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.max_balance = max_balance
+        self._balance = float(min_retries)
+        self.spent = 0
+        self.denied = 0
+        self._lock = threading.Lock()
+
+    def record_request(self):
+        with self._lock:
+            self._balance = min(self.max_balance, self._balance + self.ratio)
+
+    def try_spend(self):
+        with self._lock:
+            if self._balance >= 1:
+                self._balance -= 1
+                self.spent += 1
+                return True
+            self.denied += 1
+            return False
+
+    def stats(self):
+        with self._lock:
+            return {'balance': round(self._balance, 2), 'spent': self.spent, 'denied': self.denied}
+
+
+def parse_retry_after(value, default=None):
+    """Retry-After header (delta seconds or an HTTP date) -> seconds, default when missing/invalid"""
+    if value is None:
+        return default
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return default
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0, retry_after=None):
+    """Seconds to wait before retry number attempt (0 based)
+
+    With a Retry-After the server's wait is used plus a little jitter, so waiting clients don't all return at once.
+    Otherwise "full jitter": uniform between 0 and the exponential step.
+    """
+    if retry_after is not None:
+        return retry_after + random.uniform(0, min(1.0, retry_after * 0.1 + 0.1))
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
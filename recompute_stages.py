@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Re-derive cached analysis stages after a STAGE_VERSIONS bump in stage_cache.py
+Only stages that can be rebuilt from cached upstream data are recomputed (no paid API calls),
+everything else is reported and refreshed lazily the next time the song is analyzed.
+Usage: python recompute_stages.py [--dry-run]
+"""
+
+import sys
+
+import song_store
+import stage_cache
+
+
+def stale_counts(store, stages):
+    """Entries per stage that no longer match the current stage versions"""
+    counts = {}
+    for stage in stage_cache.STAGES:
+        stale = 0
+        for key in store.keys(f"{stage}:"):
+            # header only, the payload is never decompressed here
+            entry = store.get_header(key)
+            if entry is not None and not (stages.is_current(entry) and stages.is_derived_from_current(entry)):
+                stale += 1
+        counts[stage] = stale
+    return counts
+
+
+def recompute_nlu(store, stages, dry_run=False):
+    """Re-run watson.averages_calc on cached watson output wherever the nlu stage is missing or outdated"""
+    import watson
+
+    recomputed = 0
+    for key in store.keys(f"{stage_cache.WATSON}:"):
+        song_id = key.split(':', 1)[1]
+        model = stages.get(stage_cache.WATSON, song_id)
+        if model is None:
+            continue
+
+        entry = store.get_header(stage_cache.stage_key(stage_cache.NLU, song_id))
+        if entry is not None and stages.is_current(entry) and stages.is_derived_from_current(entry):
+            continue
+
+        if not dry_run:
+            stages.put(stage_cache.NLU, song_id, watson.averages_calc([model]))
+        recomputed += 1
+    return recomputed
+
+
+def main():
+    dry_run = '--dry-run' in sys.argv[1:]
+    store = song_store.open_write_behind_store()
+    stages = stage_cache.StageCache(store)
+
+    print("🔎 Outdated entries per stage:")
+    for stage, count in stale_counts(store, stages).items():
+        print(f"   {stage}: {count} (v{stages.versions[stage]})")
+
+    recomputed = recompute_nlu(store, stages, dry_run)
+    verb = "Would recompute" if dry_run else "Recomputed"
+    print(f"✅ {verb} {recomputed} nlu entr{'y' if recomputed == 1 else 'ies'} from cached watson output.")
+    print("   Other outdated stages need an upstream call and refresh on the next analysis of the song.")
+
+    store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""
+Binary encoding for cached song records
+Stage metadata (version, timestamps, dead-end reason) sits in a small uncompressed header,
+the payload (lyrics, watson output, ...) is msgpack or json, zlib compressed once it is big enough.
+
+Layout: MAGIC | kind (1) | format (1) | compression (1) | header length (4, big endian) | header json | payload
+"""
+
+import json
+import struct
+import zlib
+
+try:
+    import msgpack
+except ImportError:  # falls back to compact json
+    msgpack = None
+
+MAGIC = b'MA\x01'
+
+KIND_ENVELOPE = b'E'   # stage entry, header is everything but 'data'
+KIND_RECORD = b'R'     # plain record (full records from the old song_db.json layout)
+
+FORMAT_JSON = b'j'
+FORMAT_MSGPACK = b'm'
+
+COMPRESSION_NONE = b'-'
+COMPRESSION_ZLIB = b'z'
+
+# below this many payload bytes compression costs more than it saves
+COMPRESS_MIN_BYTES = 256
+ZLIB_LEVEL = 6
+
+_PREFIX = struct.Struct('>3sccc I')
+
+
+def _dump_payload(data):
+    if msgpack is not None:
+        return FORMAT_MSGPACK, msgpack.packb(data, use_bin_type=True)
+    return FORMAT_JSON, json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+
+def _load_payload(fmt, raw):
+    if fmt == FORMAT_MSGPACK:
+        if msgpack is None:
+            raise ValueError("record was written with msgpack, but msgpack is not installed")
+        return msgpack.unpackb(raw, raw=False)
+    return json.loads(raw)
+
+
+def encode(record):
+    """Record (json-like dict) -> bytes"""
+    if isinstance(record, dict) and 'data' in record:
+        kind = KIND_ENVELOPE
+        header = {key: value for key, value in record.items() if key != 'data'}
+        payload = record['data']
+    else:
+        kind = KIND_RECORD
+        header = {}
+        payload = record
+
+    fmt, raw = _dump_payload(payload)
+    compression = COMPRESSION_NONE
+    if len(raw) >= COMPRESS_MIN_BYTES:
+        raw = zlib.compress(raw, ZLIB_LEVEL)
+        compression = COMPRESSION_ZLIB
+
+    header_raw = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    return _PREFIX.pack(MAGIC, kind, fmt, compression, len(header_raw)) + header_raw + raw
+
+
+def _split(blob):
+    magic, kind, fmt, compression, header_len = _PREFIX.unpack_from(blob)
+    if magic != MAGIC:
+        raise ValueError("not an encoded record")
+    start = _PREFIX.size
+    header = json.loads(blob[start:start + header_len])
+    return kind, fmt, compression, header, start + header_len
+
+
+def is_encoded(blob):
+    return isinstance(blob, (bytes, bytearray, memoryview)) and bytes(blob[:len(MAGIC)]) == MAGIC
+
+
+def decode(blob):
+    """bytes -> record, plain json text (rows written before this encoding) is still accepted"""
+    if not is_encoded(blob):
+        return json.loads(blob)
+
+    blob = bytes(blob)
+    kind, fmt, compression, header, offset = _split(blob)
+    raw = blob[offset:]
+    if compression == COMPRESSION_ZLIB:
+        raw = zlib.decompress(raw)
+    payload = _load_payload(fmt, raw)
+
+    if kind == KIND_RECORD:
+        return payload
+    header['data'] = payload
+    return header
+
+
+def decode_header(blob):
+    """Stage metadata only, without touching the payload (plain records give {})"""
+    if not is_encoded(blob):
+        record = json.loads(blob)
+        if isinstance(record, dict) and 'data' in record:
+            return {key: value for key, value in record.items() if key != 'data'}
+        return {}
+    return _split(bytes(blob))[3]
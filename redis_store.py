@@ -0,0 +1,233 @@
+"""
+Redis backed song store for MusicAI
+Lets every container replica share one analysis cache. Talks the Redis protocol (RESP) directly
+over a socket, so any Redis compatible server works (Azure Cache for Redis, redis-server, ...).
+"""
+
+import socket
+import ssl
+import threading
+from urllib.parse import urlparse, unquote
+
+import record_codec
+
+KEY_PREFIX = 'musicai:song:'
+
+# keys per MGET / MSET round trip
+BATCH_SIZE = 500
+
+# enough to hold the record_codec prefix + stage header
+HEADER_BYTES = 4096
+
+
+class RespError(Exception):
+    """Error reply from the server"""
+
+
+class RespClient:
+    """Minimal Redis protocol client, one connection per thread"""
+
+    def __init__(self, host='localhost', port=6379, password=None, db=0, use_ssl=False, timeout=5.0):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.db = db
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self._local = threading.local()
+
+    @classmethod
+    def from_url(cls, url, timeout=5.0):
+        """redis://[:password@]host[:port][/db] or rediss:// for TLS"""
+        parsed = urlparse(url)
+        db = parsed.path.lstrip('/')
+        return cls(
+            host=parsed.hostname or 'localhost',
+            port=parsed.port or 6379,
+            password=unquote(parsed.password) if parsed.password else None,
+            db=int(db) if db else 0,
+            use_ssl=parsed.scheme == 'rediss',
+            timeout=timeout,
+        )
+
+    def execute(self, *args):
+        return self.pipeline([args])[0]
+
+    def pipeline(self, commands):
+        """Send every command in one write, then read all the replies"""
+        payload = b''.join(_encode_command(command) for command in commands)
+        try:
+            return self._roundtrip(payload, len(commands))
+        except (ConnectionError, OSError):
+            # stale connection (server restart, idle timeout), retry once on a fresh one
+            self.close()
+            return self._roundtrip(payload, len(commands))
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            sock, reader = conn
+            try:
+                reader.close()
+                sock.close()
+            except OSError:
+                pass
+            self._local.conn = None
+
+    def _roundtrip(self, payload, count):
+        sock, reader = self._connection()
+        sock.sendall(payload)
+        replies = [_read_reply(reader) for _ in range(count)]
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        return replies
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            return conn
+
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        if self.use_ssl:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=self.host)
+        conn = (sock, sock.makefile('rb'))
+        self._local.conn = conn
+
+        setup = []
+        if self.password:
+            setup.append(('AUTH', self.password))
+        if self.db:
+            setup.append(('SELECT', self.db))
+        if setup:
+            self._roundtrip(b''.join(_encode_command(command) for command in setup), len(setup))
+        return conn
+
+
+def _encode_command(args):
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode('utf-8')
+        elif isinstance(arg, int):
+            arg = str(arg).encode('ascii')
+        parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(parts)
+
+
+def _read_reply(reader):
+    line = reader.readline()
+    if not line:
+        raise ConnectionError("connection closed by the server")
+    kind, rest = line[:1], line[1:-2]
+
+    if kind == b'+':
+        return rest.decode('utf-8')
+    if kind == b'-':
+        return RespError(rest.decode('utf-8'))
+    if kind == b':':
+        return int(rest)
+    if kind == b'$':
+        length = int(rest)
+        if length == -1:
+            return None
+        data = reader.read(length + 2)
+        return data[:-2]
+    if kind == b'*':
+        length = int(rest)
+        if length == -1:
+            return None
+        return [_read_reply(reader) for _ in range(length)]
+    raise ConnectionError(f"unexpected reply from server: {line!r}")
+
+
+def _glob_escape(text):
+    for char in '\\*?[]':
+        text = text.replace(char, '\\' + char)
+    return text
+
+
+class RedisSongStore:
+    """Song store kept in Redis, records are stored with record_codec"""
+
+    def __init__(self, client, prefix=KEY_PREFIX):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        blob = self.client.execute('GET', self.prefix + key)
+        if blob is None:
+            return None
+        return record_codec.decode(blob)
+
+    def get_many(self, keys):
+        """Pipelined MGET, returns {key: record} for the keys that exist"""
+        found = {}
+        keys = list(keys)
+        for start in range(0, len(keys), BATCH_SIZE):
+            chunk = keys[start:start + BATCH_SIZE]
+            blobs = self.client.execute('MGET', *[self.prefix + key for key in chunk])
+            for key, blob in zip(chunk, blobs):
+                if blob is not None:
+                    found[key] = record_codec.decode(blob)
+        return found
+
+    def get_header(self, key):
+        blob = self.client.execute('GETRANGE', self.prefix + key, 0, HEADER_BYTES - 1)
+        if not blob:
+            return None
+        try:
+            return record_codec.decode_header(blob)
+        except ValueError:
+            # header longer than HEADER_BYTES, or an old plain json row
+            return record_codec.decode_header(self.client.execute('GET', self.prefix + key))
+
+    def put(self, key, record):
+        self.client.execute('SET', self.prefix + key, record_codec.encode(record))
+
+    def put_many(self, items):
+        items = list(items.items())
+        commands = []
+        for start in range(0, len(items), BATCH_SIZE):
+            args = ['MSET']
+            for key, record in items[start:start + BATCH_SIZE]:
+                args.extend((self.prefix + key, record_codec.encode(record)))
+            commands.append(args)
+        if commands:
+            self.client.pipeline(commands)
+
+    def delete(self, key):
+        self.client.execute('DEL', self.prefix + key)
+
+    def keys(self, prefix=''):
+        found = []
+        cursor = b'0'
+        pattern = _glob_escape(self.prefix + prefix) + '*'
+        while True:
+            cursor, batch = self.client.execute('SCAN', cursor, 'MATCH', pattern, 'COUNT', 1000)
+            found.extend(key.decode('utf-8')[len(self.prefix):] for key in batch)
+            if cursor in (b'0', 0, '0'):
+                break
+        return list(dict.fromkeys(found))
+
+    def __contains__(self, key):
+        return self.client.execute('EXISTS', self.prefix + key) == 1
+
+    def __len__(self):
+        return len(self.keys())
+
+    def usage(self):
+        """Entries and bytes per stage (scans the whole keyspace, admin use only)"""
+        import song_store
+
+        usage = {}
+        keys = self.keys()
+        for start in range(0, len(keys), BATCH_SIZE):
+            chunk = keys[start:start + BATCH_SIZE]
+            sizes = self.client.pipeline([('STRLEN', self.prefix + key) for key in chunk])
+            for key, size in zip(chunk, sizes):
+                song_store._add_usage(usage, key, size)
+        return usage
+
+    def close(self):
+        self.client.close()
@@ -0,0 +1,466 @@
+"""
+Song analysis store for MusicAI
+Keyed storage for analyzed songs so a lookup never has to load the whole database
+"""
+
+import os
+import json
+import atexit
+import sqlite3
+import threading
+import time
+
+import record_codec
+import stage_cache
+
+SONG_DB_FILE = 'song_db.json'
+SONG_STORE_FILE = 'song_db.sqlite3'
+
+
+class JsonSongStore:
+    """Legacy single-file store (song_db.json), kept for small local setups"""
+
+    def __init__(self, path=SONG_DB_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._records = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self._records = json.load(f)
+            except json.JSONDecodeError:
+                print(f"WARNING: {path} is not valid JSON, starting with an empty song store")
+                self._records = {}
+
+    def get(self, key):
+        return self._records.get(key)
+
+    def get_many(self, keys):
+        return {key: self._records[key] for key in keys if key in self._records}
+
+    def get_header(self, key):
+        return _header_of(self._records.get(key))
+
+    def put(self, key, record):
+        with self._lock:
+            self._records[key] = record
+            self._write()
+
+    def put_many(self, items):
+        with self._lock:
+            self._records.update(items)
+            self._write()
+
+    def delete(self, key):
+        with self._lock:
+            if self._records.pop(key, None) is not None:
+                self._write()
+
+    def keys(self, prefix=''):
+        return [key for key in list(self._records.keys()) if key.startswith(prefix)]
+
+    def __contains__(self, key):
+        return key in self._records
+
+    def __len__(self):
+        return len(self._records)
+
+    def usage(self):
+        usage = {}
+        for key, record in list(self._records.items()):
+            _add_usage(usage, key, len(json.dumps(record)))
+        return usage
+
+    def close(self):
+        pass
+
+    def _write(self):
+        # write next to the real file and swap it in so readers never see half a file
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self._records, f)
+        os.replace(tmp_path, self.path)
+
+
+class SQLiteSongStore:
+    """SQLite store in WAL mode keyed by Spotify track id, records are stored with record_codec"""
+
+    def __init__(self, path=SONG_STORE_FILE):
+        self.path = path
+        self._local = threading.local()
+        # every thread's connection, so close() can close them all
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS songs ('
+            ' id TEXT PRIMARY KEY,'
+            ' record TEXT NOT NULL,'
+            ' updated_at REAL NOT NULL)'
+        )
+        conn.commit()
+
+    def _conn(self):
+        # sqlite connections can't be shared across threads, flask serves each request on its own
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # closed by close() from whichever thread that runs on
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def get(self, key):
+        row = self._conn().execute('SELECT record FROM songs WHERE id = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return record_codec.decode(row[0])
+
+    def get_many(self, keys):
+        found = {}
+        keys = list(keys)
+        # stay under sqlite's bound parameter limit
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self._conn().execute(f'SELECT id, record FROM songs WHERE id IN ({placeholders})', chunk)
+            for key, blob in rows:
+                found[key] = record_codec.decode(blob)
+        return found
+
+    def get_header(self, key):
+        """Stage metadata of a record without decompressing it"""
+        row = self._conn().execute('SELECT record FROM songs WHERE id = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return record_codec.decode_header(row[0])
+
+    def put(self, key, record):
+        conn = self._conn()
+        conn.execute(
+            'INSERT INTO songs (id, record, updated_at) VALUES (?, ?, ?) '
+            'ON CONFLICT(id) DO UPDATE SET record = excluded.record, updated_at = excluded.updated_at',
+            (key, record_codec.encode(record), time.time())
+        )
+        conn.commit()
+
+    def put_many(self, items):
+        # one transaction for the whole batch
+        now = time.time()
+        conn = self._conn()
+        conn.executemany(
+            'INSERT INTO songs (id, record, updated_at) VALUES (?, ?, ?) '
+            'ON CONFLICT(id) DO UPDATE SET record = excluded.record, updated_at = excluded.updated_at',
+            [(key, record_codec.encode(record), now) for key, record in items.items()]
+        )
+        conn.commit()
+
+    def delete(self, key):
+        conn = self._conn()
+        conn.execute('DELETE FROM songs WHERE id = ?', (key,))
+        conn.commit()
+
+    def keys(self, prefix=''):
+        if not prefix:
+            return [row[0] for row in self._conn().execute('SELECT id FROM songs')]
+        # range scan on the primary key instead of LIKE (prefixes contain ':' and '_')
+        return [row[0] for row in self._conn().execute(
+            'SELECT id FROM songs WHERE id >= ? AND id < ?', (prefix, prefix + '\U0010ffff')
+        )]
+
+    def __contains__(self, key):
+        return self._conn().execute('SELECT 1 FROM songs WHERE id = ?', (key,)).fetchone() is not None
+
+    def __len__(self):
+        return self._conn().execute('SELECT COUNT(*) FROM songs').fetchone()[0]
+
+    def usage(self):
+        rows = self._conn().execute(
+            "SELECT CASE WHEN instr(id, ':') > 0 THEN substr(id, 1, instr(id, ':') - 1) ELSE '' END AS stage,"
+            " COUNT(*), SUM(length(record)) FROM songs GROUP BY stage"
+        )
+        usage = {}
+        for stage, count, size in rows:
+            usage[stage or 'record'] = {'entries': count, 'bytes': size or 0}
+        return usage
+
+    def close(self):
+        with self._connections_lock:
+            connections = self._connections
+            self._connections = []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+
+class WriteBehindStore:
+    """Queues writes in memory and flushes them to the wrapped store in batches
+
+    Records stay readable while their batch is being written (_inflight) and are queued again if it fails.
+    """
+
+    def __init__(self, store, max_batch=100, flush_interval=30.0):
+        self.store = store
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.flushes = 0
+        self.flushed_records = 0
+        self._pending = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+
+        self._thread = threading.Thread(target=self._flush_loop, name='song-store-flush', daemon=True)
+        self._thread.start()
+        # flush whatever is still queued when the app shuts down
+        atexit.register(self.close)
+
+    def _queued(self, key):
+        # call with _lock held, newer queued writes win over the batch being flushed
+        if key in self._pending:
+            return True, self._pending[key]
+        if key in self._inflight:
+            return True, self._inflight[key]
+        return False, None
+
+    def get(self, key):
+        with self._lock:
+            found, record = self._queued(key)
+        if found:
+            return record
+        return self.store.get(key)
+
+    def get_many(self, keys):
+        found = {}
+        rest = []
+        with self._lock:
+            for key in keys:
+                queued, record = self._queued(key)
+                if queued:
+                    found[key] = record
+                else:
+                    rest.append(key)
+        if rest:
+            found.update(self.store.get_many(rest))
+        return found
+
+    def get_header(self, key):
+        with self._lock:
+            found, record = self._queued(key)
+        if found:
+            return _header_of(record)
+        return self.store.get_header(key)
+
+    def put(self, key, record):
+        with self._lock:
+            self._pending[key] = record
+            full = len(self._pending) >= self.max_batch
+        if full:
+            self.flush()
+
+    def put_many(self, items):
+        with self._lock:
+            self._pending.update(items)
+            full = len(self._pending) >= self.max_batch
+        if full:
+            self.flush()
+
+    def delete(self, key):
+        # a flush in progress could otherwise write the key back after it is deleted
+        with self._flush_lock:
+            with self._lock:
+                self._pending.pop(key, None)
+            self.store.delete(key)
+
+    def keys(self, prefix=''):
+        with self._lock:
+            pending = [key for key in (*self._pending, *self._inflight) if key.startswith(prefix)]
+        return list(dict.fromkeys(self.store.keys(prefix) + pending))
+
+    def __contains__(self, key):
+        with self._lock:
+            if self._queued(key)[0]:
+                return True
+        return key in self.store
+
+    def __len__(self):
+        return len(self.keys())
+
+    def usage(self):
+        return self.store.usage()
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """Write every queued record in one batch, returns how many were written"""
+        with self._flush_lock:
+            with self._lock:
+                batch = self._pending
+                self._pending = {}
+                # readers keep seeing the batch until the store has it
+                self._inflight = batch
+            if not batch:
+                return 0
+
+            try:
+                self.store.put_many(batch)
+            except Exception as e:
+                print(f"ERROR: Failed to flush {len(batch)} song(s) to the store: {e}")
+                # requeue, but never over a newer result written in the meantime
+                with self._lock:
+                    for key, record in batch.items():
+                        self._pending.setdefault(key, record)
+                    self._inflight = {}
+                return 0
+
+            with self._lock:
+                self._inflight = {}
+
+            self.flushes += 1
+            self.flushed_records += len(batch)
+            return len(batch)
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self.flush()
+        self.store.close()
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+
+class CachedStore:
+    """Memory tier (memory_cache.LRUCache) in front of a store
+
+    Records are handed out as-is without copying, callers must not modify them.
+    """
+
+    def __init__(self, store, cache):
+        self.store = store
+        self.cache = cache
+
+    def get(self, key):
+        record = self.cache.get(key)
+        if record is not None:
+            return record
+        record = self.store.get(key)
+        if record is not None:
+            self.cache.put(key, record)
+        return record
+
+    def get_many(self, keys):
+        found = {}
+        rest = []
+        for key in keys:
+            record = self.cache.get(key)
+            if record is not None:
+                found[key] = record
+            else:
+                rest.append(key)
+        if rest:
+            fetched = self.store.get_many(rest)
+            for key, record in fetched.items():
+                self.cache.put(key, record)
+            found.update(fetched)
+        return found
+
+    def get_header(self, key):
+        record = self.cache.get(key)
+        if record is not None:
+            return _header_of(record)
+        return self.store.get_header(key)
+
+    def put(self, key, record):
+        self.store.put(key, record)
+        self.cache.put(key, record)
+
+    def put_many(self, items):
+        self.store.put_many(items)
+        for key, record in items.items():
+            self.cache.put(key, record)
+
+    def delete(self, key):
+        self.cache.delete(key)
+        self.store.delete(key)
+
+    def keys(self, prefix=''):
+        return self.store.keys(prefix)
+
+    def __contains__(self, key):
+        return key in self.cache or key in self.store
+
+    def __len__(self):
+        return len(self.store)
+
+    def usage(self):
+        return self.store.usage()
+
+    def close(self):
+        self.cache.clear()
+        self.store.close()
+
+
+def _add_usage(usage, key, size):
+    """Count one entry towards its stage (the part of the key before ':')"""
+    stage = key.split(':', 1)[0] if ':' in key else 'record'
+    counts = usage.setdefault(stage, {'entries': 0, 'bytes': 0})
+    counts['entries'] += 1
+    counts['bytes'] += size
+
+
+def _header_of(record):
+    """Stage metadata of a decoded record (everything but the payload)"""
+    if record is None:
+        return None
+    if isinstance(record, dict) and 'data' in record:
+        return {key: value for key, value in record.items() if key != 'data'}
+    return {}
+
+
+def open_song_store(backend=None, path=None):
+    """Open the store picked by SONG_STORE_BACKEND (sqlite by default, json or redis)"""
+    backend = (backend or os.getenv('SONG_STORE_BACKEND', 'sqlite')).lower()
+    if backend == 'redis':
+        # shared between replicas, path is the redis url here
+        import redis_store
+        url = path or os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+        return redis_store.RedisSongStore(redis_store.RespClient.from_url(url))
+    if backend == 'json':
+        return JsonSongStore(path or os.getenv('SONG_STORE_PATH', SONG_DB_FILE))
+    if backend == 'sqlite':
+        return SQLiteSongStore(path or os.getenv('SONG_STORE_PATH', SONG_STORE_FILE))
+    raise ValueError(f"Unknown SONG_STORE_BACKEND: {backend}")
+
+
+def open_write_behind_store(backend=None, path=None):
+    """open_song_store() behind a WriteBehindStore, batch size/interval come from the environment"""
+    return WriteBehindStore(
+        open_song_store(backend, path),
+        max_batch=int(os.getenv('SONG_STORE_FLUSH_BATCH', '100')),
+        flush_interval=float(os.getenv('SONG_STORE_FLUSH_SECONDS', '30')),
+    )
+
+
+def migrate_song_db(json_path, store):
+    """Copy every song from an old song_db.json into store as stage entries, returns how many were copied"""
+    with open(json_path, 'r') as f:
+        loaded = json.load(f)
+
+    stages = stage_cache.StageCache(store)
+    copied = 0
+    for song_id, record in loaded.items():
+        if stage_cache.stage_key(stage_cache.AUDIO_FEATURES, song_id) in store:
+            continue
+        for stage, value in stage_cache.legacy_stages(record).items():
+            stages.put(stage, song_id, value)
+        copied += 1
+    return copied
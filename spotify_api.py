@@ -0,0 +1,217 @@
+"""
+Spotify Web API access for MusicAI
+Every Spotify call goes through get(): the shared pooled client, a token bucket for the app and
+one per access token, Retry-After on 429 and jittered retries on 5xx / network errors within a retry budget.
+"""
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import http_client
+import rate_limit
+
+API_URL = 'https://api.spotify.com/v1'
+
+# statuses worth another try, anything else goes straight back to the caller
+RETRY_STATUSES = (500, 502, 503, 504)
+MAX_RETRIES = 4
+
+# most ids the multi-id endpoints take per call
+TRACKS_BATCH = 50
+AUDIO_FEATURES_BATCH = 100
+ARTISTS_BATCH = 50
+
+# biggest page the paging endpoints (/me/tracks, /me/albums, ...) hand out, and pages fetched at once
+PAGE_LIMIT = 50
+PAGE_WORKERS = int(os.getenv('SPOTIFY_PAGE_WORKERS', '8'))
+PLAYLIST_PAGE_LIMIT = 100
+
+# projection for playlist track pages, only what the analysis keeps
+PLAYLIST_TRACK_FIELDS = 'items(track(id,name,artists(name))),next,total'
+
+# a 429 without Retry-After waits this long, one asking for more than MAX_RETRY_AFTER fails the call instead
+DEFAULT_RETRY_AFTER = 1.0
+MAX_RETRY_AFTER = 60.0
+
+
+class SpotifyError(Exception):
+    """Spotify call that could not be completed"""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class RateLimited(SpotifyError):
+    """Still rate limited after the retries the budget allowed"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message, status=429)
+        self.retry_after = retry_after
+
+
+limiter = rate_limit.RateLimiter(
+    app_rate=float(os.getenv('SPOTIFY_RATE_PER_SECOND', '20')),
+    app_burst=float(os.getenv('SPOTIFY_BURST', '40')),
+    key_rate=float(os.getenv('SPOTIFY_TOKEN_RATE_PER_SECOND', '10')),
+    key_burst=float(os.getenv('SPOTIFY_TOKEN_BURST', '20')),
+)
+retry_budget = rate_limit.RetryBudget(ratio=float(os.getenv('SPOTIFY_RETRY_RATIO', '0.2')))
+
+
+def get(token, url, max_retries=MAX_RETRIES, **kwargs):
+    """GET a Spotify endpoint, returns the response
+
+    Raises RateLimited if Spotify still says 429 when retries run out, and the requests
+    exception if the network keeps failing (straight away if Spotify's circuit is open).
+    Other statuses are left to the caller.
+    """
+    headers = {"Authorization": "Bearer " + token}
+    headers.update(kwargs.pop('headers', None) or {})
+
+    attempt = 0
+    while True:
+        limiter.acquire(token)
+        retry_budget.record_request()
+        try:
+            response = http_client.get(url, headers=headers, **kwargs)
+        except http_client.UpstreamUnavailable:
+            raise
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if attempt >= max_retries or not retry_budget.try_spend():
+                raise
+            time.sleep(rate_limit.backoff_delay(attempt))
+            attempt += 1
+            continue
+
+        if response.status_code == 429:
+            retry_after = rate_limit.parse_retry_after(response.headers.get('Retry-After'), DEFAULT_RETRY_AFTER)
+            limiter.throttle(min(retry_after, MAX_RETRY_AFTER), token)
+            if retry_after > MAX_RETRY_AFTER or attempt >= max_retries or not retry_budget.try_spend():
+                raise RateLimited(f"rate limited by Spotify, retry after {retry_after:.0f}s", retry_after)
+            time.sleep(rate_limit.backoff_delay(attempt, retry_after=retry_after))
+            attempt += 1
+            continue
+
+        if response.status_code in RETRY_STATUSES and attempt < max_retries and retry_budget.try_spend():
+            time.sleep(rate_limit.backoff_delay(attempt))
+            attempt += 1
+            continue
+
+        return response
+
+
+def get_page(token, url, offset=0, limit=PAGE_LIMIT, params=None):
+    query = {'offset': offset, 'limit': limit}
+    query.update(params or {})
+    response = get(token, url, params=query)
+    if response.status_code != 200:
+        raise SpotifyError(f"{url} (offset {offset}) returned HTTP {response.status_code}", response.status_code)
+    return response.json()
+
+
+def get_pages(token, pages, limit=PAGE_LIMIT, params=None, workers=PAGE_WORKERS):
+    """Many (url, offset) pages at once, at most `workers` in flight, returned in the order asked for"""
+    pages = list(pages)
+    if not pages:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(pages)))) as pool:
+        return list(pool.map(lambda page: get_page(token, page[0], page[1], limit, params), pages))
+
+
+def get_all_pages(token, url, limit=PAGE_LIMIT, params=None, workers=PAGE_WORKERS):
+    """Every page of an offset paginated endpoint, in order
+
+    The first page gives the total, the remaining offsets are then fetched concurrently
+    (each still paced by the rate limiter).
+    """
+    first = get_page(token, url, 0, limit, params)
+    offsets = range(limit, first.get('total') or 0, limit)
+    return [first] + get_pages(token, [(url, offset) for offset in offsets], limit, params, workers)
+
+
+def get_many(token, url, ids, batch_size, field):
+    """GET a multi-id endpoint (/tracks, /audio-features) in chunks of batch_size
+
+    Returns {id: object}, ids Spotify doesn't know map to None. Ids of a chunk that failed
+    are left out, so the caller can fall back to fetching them one by one.
+    """
+    found = {}
+    ids = list(dict.fromkeys(ids))
+    for start in range(0, len(ids), batch_size):
+        chunk = ids[start:start + batch_size]
+        try:
+            response = get(token, url, params={'ids': ','.join(chunk)})
+            response.raise_for_status()
+            objects = response.json()[field]
+        except (SpotifyError, requests.exceptions.RequestException, ValueError, KeyError) as e:
+            print(f"ERROR: Failed to fetch {len(chunk)} {field} from {url}: {e}")
+            continue
+        # results come back in request order, null for unknown ids
+        for song_id, obj in zip(chunk, objects):
+            found[song_id] = obj
+    return found
+
+
+def tracks(token, ids):
+    return get_many(token, f"{API_URL}/tracks", ids, TRACKS_BATCH, 'tracks')
+
+
+def audio_features(token, ids):
+    return get_many(token, f"{API_URL}/audio-features", ids, AUDIO_FEATURES_BATCH, 'audio_features')
+
+
+def artists(token, ids):
+    return get_many(token, f"{API_URL}/artists", ids, ARTISTS_BATCH, 'artists')
+
+
+class ArtistResolver:
+    """Artist images and genres by id, batched and de-duplicated, kept in a cache shared by every user
+
+    cache is a memory_cache.LRUCache (its ttl decides how long artist metadata is trusted).
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.fetched = 0
+
+    def resolve(self, token, artist_ids):
+        """{artist id: {'name', 'images', 'genres'}} for every id Spotify knows, one call per 50 uncached ids"""
+        found = {}
+        missing = []
+        for artist_id in dict.fromkeys(artist_ids):
+            if not artist_id:
+                continue
+            artist = self.cache.get(artist_id)
+            if artist is None:
+                missing.append(artist_id)
+            else:
+                found[artist_id] = artist
+
+        if missing:
+            for artist_id, artist in artists(token, missing).items():
+                # unknown ids are cached as empty too, so they aren't asked for again
+                artist = {
+                    'name': (artist or {}).get('name'),
+                    'images': (artist or {}).get('images') or [],
+                    'genres': (artist or {}).get('genres') or [],
+                }
+                self.cache.put(artist_id, artist)
+                found[artist_id] = artist
+            self.fetched += len(missing)
+        return found
+
+    def thumbnails(self, token, artist_ids, fallback):
+        """{artist id: smallest image url}, fallback for artists without images"""
+        resolved = self.resolve(token, artist_ids)
+        return {
+            artist_id: resolved[artist_id]['images'][-1]['url'] if artist_id in resolved and resolved[artist_id]['images'] else fallback
+            for artist_id in artist_ids if artist_id
+        }
+
+
+def stats():
+    return {'limiter': limiter.stats(), 'retry_budget': retry_budget.stats()}
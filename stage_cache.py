@@ -0,0 +1,266 @@
+"""
+Per-stage song cache for MusicAI
+Each step of a song analysis (spotify track, audio features, genius url, lyrics, watson nlu)
+is cached on its own so a retry only re-runs the step that failed.
+Known dead ends (no genius hit, unparseable page, ...) are cached too, for a limited time.
+Every entry is stamped with the version of the code that produced it, see STAGE_VERSIONS.
+Concurrent misses for the same (stage, song id) are coalesced: one caller fills, the others wait for it.
+"""
+
+import threading
+import time
+
+import cache_metrics
+import single_flight
+
+TRACK = 'track'
+AUDIO_FEATURES = 'audio_features'
+GENIUS_URL = 'genius_url'
+LYRICS = 'lyrics'
+WATSON = 'watson'
+NLU = 'nlu'
+
+STAGES = (TRACK, AUDIO_FEATURES, GENIUS_URL, LYRICS, WATSON, NLU)
+
+# bump a stage when the code behind it changes, its cached entries are then ignored (lazily)
+STAGE_VERSIONS = {
+    TRACK: 1,
+    AUDIO_FEATURES: 1,
+    GENIUS_URL: 1,      # musicAI._genius_song_url hit matching
+    LYRICS: 1,          # musicAI._webcrawl_lyrics bar splitting
+    WATSON: 1,          # watson.analyzeText features + watson.ai_to_Text cleaning
+    NLU: 1,             # watson.averages_calc
+}
+
+# which stage each stage is computed from
+UPSTREAM = {
+    TRACK: None,
+    AUDIO_FEATURES: None,
+    GENIUS_URL: TRACK,
+    LYRICS: GENIUS_URL,
+    WATSON: LYRICS,
+    NLU: WATSON,
+}
+
+# why a stage came back empty
+NO_HIT = 'no_hit'
+PARSE_FAILED = 'parse_failed'
+TOO_SHORT = 'too_short'
+WATSON_ERROR = 'watson_error'
+
+# how long each dead end is remembered (seconds)
+DEFAULT_NEGATIVE_TTLS = {
+    NO_HIT: 7 * 24 * 3600,
+    PARSE_FAILED: 24 * 3600,
+    TOO_SHORT: 7 * 24 * 3600,
+    WATSON_ERROR: 3600,
+}
+
+
+class Negative:
+    """Returned by a stage fill to record a known dead end instead of a value"""
+
+    def __init__(self, reason):
+        self.reason = reason
+
+    def __repr__(self):
+        return f"Negative({self.reason!r})"
+
+
+def stage_key(stage, song_id):
+    return f"{stage}:{song_id}"
+
+
+def legacy_stages(record):
+    """Split a full record from the old song_db.json layout into {stage: value}"""
+    ai = record.get('ai') or {}
+    stages = {
+        AUDIO_FEATURES: {key: value for key, value in record.items() if key not in ('ai', 'song_title', 'artist_name')},
+    }
+    if record.get('song_title') and record.get('artist_name'):
+        stages[TRACK] = {'id': record.get('id'), 'name': record['song_title'], 'artists': [record['artist_name']]}
+    if ai.get('lyrics'):
+        stages[LYRICS] = ai['lyrics']
+    if ai.get('nlu'):
+        stages[NLU] = ai['nlu']
+    return stages
+
+
+def stage_chain(stage):
+    """The stage and every stage it was derived from"""
+    chain = []
+    while stage is not None:
+        chain.append(stage)
+        stage = UPSTREAM.get(stage)
+    return chain
+
+
+class StageCache:
+    """Keeps one entry per (stage, song id) in a song store"""
+
+    def __init__(self, store, negative_ttls=None, versions=None, metrics=None):
+        self.store = store
+        self.metrics = metrics or cache_metrics.CacheMetrics()
+        self.versions = dict(STAGE_VERSIONS)
+        self.versions.update(versions or {})
+        self.stale = {stage: 0 for stage in self.versions}
+        self.negative_ttls = dict(DEFAULT_NEGATIVE_TTLS)
+        self.negative_ttls.update(negative_ttls or {})
+        self.negative_hits = {reason: 0 for reason in self.negative_ttls}
+        self.negatives_stored = {reason: 0 for reason in self.negative_ttls}
+        self.flights = single_flight.SingleFlight()
+        self._lock = threading.Lock()
+
+    def get(self, stage, song_id):
+        entry = self._entry(stage, song_id)
+        if entry is None or 'neg' in entry:
+            return None
+        return entry['data']
+
+    def put(self, stage, song_id, data):
+        entry = self.stamp(stage)
+        entry['data'] = data
+        self.store.put(stage_key(stage, song_id), entry)
+
+    def prefetch(self, song_ids, stages=STAGES):
+        """Load every stage of many songs in one store round trip (warms a CachedStore's memory tier)"""
+        keys = [stage_key(stage, song_id) for song_id in song_ids for stage in stages]
+        if not keys:
+            return 0
+        return len(self.store.get_many(keys))
+
+    def missing(self, stage, song_ids):
+        """Song ids without a current entry (value or remembered dead end) for the stage"""
+        return [song_id for song_id in dict.fromkeys(song_ids) if self._entry(stage, song_id) is None]
+
+    def fill_many(self, stage, song_ids, fill_many):
+        """Fill every song the stage is missing for with one fill_many(ids) -> {id: value} call
+
+        Used for upstream endpoints that take many ids at once, values of None are not cached.
+        Songs another caller is filling right now are left to it. Returns how many entries were stored.
+        """
+        missing = []
+        for song_id in self.missing(stage, song_ids):
+            if self.flights.in_flight(stage_key(stage, song_id)):
+                self.metrics.record_coalesced(stage)
+            else:
+                missing.append(song_id)
+        if not missing:
+            return 0
+
+        started = time.perf_counter()
+        values = fill_many(missing)
+        self.metrics.record_fill(stage, f"{len(missing)} songs", time.perf_counter() - started)
+
+        entries = {}
+        for song_id, data in values.items():
+            if data is None or isinstance(data, Negative):
+                continue
+            entry = self.stamp(stage)
+            entry['data'] = data
+            entries[stage_key(stage, song_id)] = entry
+        if entries:
+            self.store.put_many(entries)
+        return len(entries)
+
+    def put_negative(self, stage, song_id, reason):
+        entry = self.stamp(stage)
+        entry['neg'] = reason
+        entry['expires_at'] = entry['at'] + self.negative_ttls.get(reason, DEFAULT_NEGATIVE_TTLS[NO_HIT])
+        self.store.put(stage_key(stage, song_id), entry)
+        with self._lock:
+            self.negatives_stored[reason] = self.negatives_stored.get(reason, 0) + 1
+
+    def negative_reason(self, stage, song_id):
+        """Reason code if the stage is a remembered dead end, otherwise None"""
+        entry = self._entry(stage, song_id)
+        if entry is None:
+            return None
+        return entry.get('neg')
+
+    def lookup(self, stage, song_id):
+        """(found, value) - found is True for cached values and for remembered dead ends (value None)"""
+        entry = self._entry(stage, song_id)
+        if entry is None:
+            self.metrics.record_miss(stage)
+            return False, None
+        if 'neg' in entry:
+            self.metrics.record_negative_hit(stage)
+            with self._lock:
+                self.negative_hits[entry['neg']] = self.negative_hits.get(entry['neg'], 0) + 1
+            return True, None
+        self.metrics.record_hit(stage)
+        return True, entry['data']
+
+    def get_or_fill(self, stage, song_id, fill):
+        """Cached value for the stage, otherwise fill() is run and its result cached
+
+        fill() returning None means the stage failed, nothing is cached so the next call retries it.
+        fill() returning Negative(reason) caches the dead end, the stage is skipped until it expires.
+        Callers missing the same entry at the same time share one fill() and its result (or exception).
+        """
+        found, data = self.lookup(stage, song_id)
+        if found:
+            return data
+
+        data, shared = self.flights.do(stage_key(stage, song_id), lambda: self._fill(stage, song_id, fill))
+        if shared:
+            self.metrics.record_coalesced(stage)
+        return data
+
+    def _fill(self, stage, song_id, fill):
+        # the previous leader may have stored the entry between our lookup and taking the lead
+        entry = self._entry(stage, song_id)
+        if entry is not None:
+            self.metrics.record_coalesced(stage)
+            return None if 'neg' in entry else entry['data']
+
+        started = time.perf_counter()
+        data = fill()
+        self.metrics.record_fill(stage, song_id, time.perf_counter() - started)
+        if isinstance(data, Negative):
+            self.put_negative(stage, song_id, data.reason)
+            return None
+        if data is not None:
+            self.put(stage, song_id, data)
+        return data
+
+    def negative_stats(self):
+        """Dead ends skipped and stored so far, per reason"""
+        with self._lock:
+            return {
+                reason: {'skipped': self.negative_hits.get(reason, 0), 'stored': self.negatives_stored.get(reason, 0)}
+                for reason in self.negative_ttls
+            }
+
+    def stamp(self, stage):
+        """Entry header: the stage's version and the versions of everything it was derived from"""
+        return {
+            'stage': stage,
+            'v': self.versions.get(stage, 1),
+            'versions': {name: self.versions.get(name, 1) for name in stage_chain(stage)},
+            'at': time.time(),
+        }
+
+    def is_current(self, entry):
+        # entries written before versioning are version 1
+        return entry.get('v', 1) == self.versions.get(entry.get('stage'), 1)
+
+    def is_derived_from_current(self, entry):
+        """True if every upstream stage the entry was computed from is still at its current version"""
+        stamped = entry.get('versions', {})
+        return all(stamped.get(name, 1) == self.versions.get(name, 1) for name in stage_chain(entry.get('stage')))
+
+    def _entry(self, stage, song_id):
+        entry = self.store.get(stage_key(stage, song_id))
+        if entry is None:
+            return None
+        # expired dead ends count as never seen
+        if 'neg' in entry and entry['expires_at'] <= time.time():
+            return None
+        # produced by an older version of the stage or from an older upstream stage, recomputed on next fill
+        if not (self.is_current(entry) and self.is_derived_from_current(entry)):
+            with self._lock:
+                self.stale[stage] = self.stale.get(stage, 0) + 1
+            return None
+        return entry
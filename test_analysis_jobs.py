@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+"""
+Test script for the background analysis jobs and their work queue
+"""
+
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import analysis_jobs
+import work_queue
+
+
+def _queue(directory, max_attempts=3):
+    return work_queue.WorkQueue(os.path.join(directory, 'work_queue.db'), max_attempts=max_attempts)
+
+
+class FakeApp:
+    """list_songs / analyze / finish for a Worker, songs starting with 'c' are already cached, ones ending in 'l' have lyrics"""
+
+    def __init__(self, songs):
+        self.songs = songs
+        self.analyzed = []
+        self.broken = set()
+        self.batches = []        # songs analyzed per analyze() call
+        self.flushed = []        # songs written out per flush()
+        self.unflushed = 0
+        self.slow = {}           # song id -> seconds its analysis takes
+        self.tokens = {'alice': 'tok', 'bob': 'tok'}   # stored tokens per user id
+
+    def token(self, params):
+        return self.tokens.get(params.get('user_id'))
+
+    def list_songs(self, kind, token, params):
+        return list(self.songs)
+
+    def analyze(self, token, song_ids, on_song):
+        self.batches.append(0)
+        for index, song_id in enumerate(song_ids):
+            if song_id in self.broken:
+                continue
+            time.sleep(self.slow.get(song_id, 0))
+            self.analyzed.append(song_id)
+            detail = {
+                'id': song_id,
+                'features': {'energy': 0.2 * (index + 1), 'tempo': 120},
+                'emotion': {'Joy': 0.8, 'Sadness': 0.2} if song_id.endswith('l') else None,
+            }
+            self.batches[-1] += 1
+            self.unflushed += 1
+            on_song(index, song_id.startswith('c'), detail)
+
+    def finish(self, kind, token, params):
+        return {'kind': kind, 'amount': len(self.songs)}
+
+    def flush(self):
+        if self.unflushed:
+            self.flushed.append(self.unflushed)
+            self.unflushed = 0
+
+    def worker(self, queue, name='w1', **kwargs):
+        return analysis_jobs.Worker(queue, self.token, self.list_songs, self.analyze, self.finish,
+                                    flush=self.flush, name=name, **kwargs)
+
+
+def _due(queue):
+    """Skip the backoff of every waiting task"""
+    queue._conn().execute('UPDATE tasks SET available_at = 0 WHERE status = ?', (work_queue.PENDING,))
+
+
+def _drain(worker):
+    while worker.run_once():
+        pass
+
+
+def test_job_runs_through_tasks():
+    """submit() only queues, a worker prepares, analyzes every song and builds the result"""
+    with tempfile.TemporaryDirectory() as directory:
+        queue = _queue(directory)
+        manager = analysis_jobs.JobManager(queue)
+        app = FakeApp(['c1', 'c2', 'f1', 'f2', 'f3'])
+
+        job_id = manager.submit('alice', 'liked', {'user_id': 'alice'})
+        assert manager.submit('alice', 'liked', {'user_id': 'alice'}) == job_id   # a double click joins it
+        other = manager.submit('bob', 'liked', {'user_id': 'bob'})
+        assert other != job_id
+        assert manager.status(job_id, 'bob') is None                                    # other users can't see it
+        status = manager.status(other, 'bob')
+        assert status['status'] == analysis_jobs.QUEUED and status['position'] == 2
+
+        worker = app.worker(queue, batch=3, metrics=lambda: {'stages': {}, 'most_expensive_misses': []})
+        _drain(worker)
+        status = manager.status(job_id, 'alice')
+        assert status['status'] == analysis_jobs.DONE
+        progress = status['progress']
+        assert progress['total'] == 5 and progress['done'] == 5
+        assert progress['cached'] == 2 and progress['fresh'] == 3 and progress['eta_seconds'] == 0.0
+        assert manager.result(job_id, 'alice') == {'kind': 'liked', 'amount': 5}
+        assert manager.result(job_id, 'bob') is None
+        assert sum(app.flushed) == len(app.analyzed) and len(app.flushed) < 10    # written out in groups, not per song
+        assert manager.stats()['jobs'] == {analysis_jobs.DONE: 2}
+        assert list(queue.worker_metrics()) == ['w1']          # published for the web app's admin page
+        queue.close()
+    print("✓ Jobs run as prepare, song and finish tasks")
+
+
+def test_songs_done_during_batch():
+    """Finished songs are marked done while a slow song of the same batch is still running"""
+    with tempfile.TemporaryDirectory() as directory:
+        queue = _queue(directory)
+        manager = analysis_jobs.JobManager(queue)
+        app = FakeApp(['f1', 'f2', 'f3'])
+        app.slow['f3'] = 0.3
+        job_id = manager.submit('alice', 'liked', {'user_id': 'alice'})
+        worker = app.worker(queue, report_seconds=0.05)
+        worker.run_once()                                   # prepare
+
+        running = threading.Thread(target=worker.run_once)
+        running.start()
+        time.sleep(0.2)
+        assert manager.status(job_id, 'alice')['progress']['done'] == 2
+        assert app.flushed == [2]                           # written out before they were marked done
+        running.join()
+        assert manager.status(job_id, 'alice')['progress']['done'] == 3 and app.flushed == [2, 1]
+        queue.close()
+    print("✓ Songs are marked done as they finish, not per batch")
+
+
+def test_retries_then_failure():
+    """Failing songs come back with backoff, give up after max attempts, the job still finishes"""
+    with tempfile.TemporaryDirectory() as directory:
+        queue = _queue(directory, max_attempts=2)
+        manager = analysis_jobs.JobManager(queue)
+        app = FakeApp(['f1', 'f2'])
+        app.broken.add('f2')
+        job_id = manager.submit('alice', 'albums', {'user_id': 'alice'})
+
+        worker = app.worker(queue)
+        _drain(worker)
+        assert manager.status(job_id, 'alice')['status'] == analysis_jobs.RUNNING
+        assert queue.stats()['tasks'][work_queue.PENDING] == 1          # f2, waiting out its backoff
+
+        _due(queue)
+        _drain(worker)
+        status = manager.status(job_id, 'alice')
+        assert status['status'] == analysis_jobs.DONE
+        assert status['progress']['done'] == 2 and status['progress']['failed'] == 1
+        assert app.analyzed == ['f1']
+
+        # without a token nothing can run, the job fails once its prepare task runs out of attempts
+        broken = manager.submit('bob', 'albums', {})
+        for _ in range(2):
+            _drain(worker)
+            _due(queue)
+        status = manager.status(broken, 'bob')
+        assert status['status'] == analysis_jobs.FAILED and 'token' in status['error']
+        assert manager.result(broken, 'bob') is None
+        queue.close()
+    print("✓ Failed tasks are retried, then given up on")
+
+
+def test_survives_restart():
+    """Tasks of a worker that died come back after the visibility timeout, in a new process too"""
+    with tempfile.TemporaryDirectory() as directory:
+        queue = _queue(directory)
+        manager = analysis_jobs.JobManager(queue)
+        app = FakeApp(['f1', 'f2', 'f3'])
+        job_id = manager.submit('alice', 'playlists', {'user_id': 'alice'})
+        app.worker(queue).run_once()                      # prepare
+
+        # a worker leases the songs and dies before finishing them
+        crashed = queue.lease('crashed', limit=10, visibility=0.05)
+        assert len(crashed) == 3
+        assert queue.lease('w1', limit=10) == []          # still hidden from everyone else
+        queue.complete(crashed[0]['id'], 'fresh', then=(analysis_jobs.FINISH, {}), worker='crashed')
+        queue.close()
+
+        time.sleep(0.06)
+        restarted = _queue(directory)
+        manager = analysis_jobs.JobManager(restarted)
+        assert restarted.stats()['expired_leases'] == 2
+        worker = app.worker(restarted, name='w2')
+        _drain(worker)                                    # back in the queue, with backoff
+        assert restarted.stats()['tasks'][work_queue.PENDING] == 2
+        _due(restarted)
+        _drain(worker)
+        status = manager.status(job_id, 'alice')
+        assert status['status'] == analysis_jobs.DONE and status['progress']['done'] == 3
+        assert app.analyzed == ['f2', 'f3']               # the finished song was not paid for twice
+        restarted.close()
+    print("✓ Unfinished work resumes after a crash or restart")
+
+
+def test_only_lease_holder_finishes():
+    """A worker whose lease ran out can't complete or retry a task another worker leased since"""
+    with tempfile.TemporaryDirectory() as directory:
+        queue = _queue(directory)
+        job_id = queue.create_job('alice', 'liked', {}, [(analysis_jobs.SONG, {'id': 'f1'})])
+        slow = queue.lease('slow', visibility=0.01)[0]
+        time.sleep(0.02)
+        assert queue.lease('fast') == []                  # back in the queue, with backoff
+        _due(queue)
+        task = queue.lease('fast')[0]
+        assert task['id'] == slow['id']
+
+        assert queue.retry(slow['id'], "timed out", then=(analysis_jobs.FINISH, {}), worker='slow')
+        assert not queue.complete(slow['id'], 'fresh', then=(analysis_jobs.FINISH, {}), worker='slow')
+        assert queue.stats()['tasks'] == {work_queue.LEASED: 1}
+        assert queue.complete(task['id'], 'cached', then=(analysis_jobs.FINISH, {}), worker='fast')
+        assert not queue.complete(task['id'], 'cached', then=(analysis_jobs.FINISH, {}), worker='fast')
+
+        assert queue.task_counts(job_id, analysis_jobs.SONG) == ({work_queue.DONE: 1}, {'cached': 1})
+        assert [row['seq'] for row in queue.finished(job_id, analysis_jobs.SONG)] == [1]
+        assert queue.task_counts(job_id, analysis_jobs.FINISH)[0] == {work_queue.PENDING: 1}
+        queue.close()
+    print("✓ Only the lease holder finishes a task")
+
+
+def test_expired_leases_give_up():
+    """A task that keeps outliving its lease is given up on after max attempts, its job still finishes"""
+    with tempfile.TemporaryDirectory() as directory:
+        queue = _queue(directory, max_attempts=2)
+        manager = analysis_jobs.JobManager(queue)
+        app = FakeApp(['f1', 'f2'])
+        job_id = manager.submit('alice', 'liked', {'user_id': 'alice'})
+        worker = app.worker(queue)
+        worker.run_once()                                 # prepare
+
+        # a worker dies with both songs, then one more with f1
+        assert len(queue.lease('dead', limit=10, visibility=0.01)) == 2
+        time.sleep(0.02)
+        assert queue.lease('w1', limit=10) == []          # backoff before they are tried again
+        assert queue.stats()['tasks'][work_queue.PENDING] == 2
+        _due(queue)
+        assert [task['payload']['id'] for task in queue.lease('dead', visibility=0.01)] == ['f1']
+        time.sleep(0.02)
+
+        _drain(worker)
+        status = manager.status(job_id, 'alice')
+        assert status['status'] == analysis_jobs.DONE
+        assert status['progress']['done'] == 2 and status['progress']['failed'] == 1
+        assert app.analyzed == ['f2']
+
+        # an expired prepare task out of attempts fails its job
+        broken = manager.submit('bob', 'liked', {'user_id': 'bob'})
+        for attempt in range(2):
+            if attempt:
+                assert queue.lease('w1') == []            # back with backoff
+                _due(queue)
+            assert queue.lease('dead', visibility=0.01)[0]['kind'] == analysis_jobs.PREPARE
+            time.sleep(0.02)
+        _drain(worker)
+        status = manager.status(broken, 'bob')
+        assert status['status'] == analysis_jobs.FAILED and 'lease ran out' in status['error']
+        queue.close()
+    print("✓ Tasks that keep killing their worker are given up on")
+
+
+def _events(stream):
+    """(event, id, data) for every event of an SSE stream, comments and retry hints left out"""
+    events = []
+    for chunk in stream:
+        fields = dict(line.split(': ', 1) for line in chunk.strip().split('\n') if not line.startswith(':'))
+        if 'event' in fields:
+            events.append((fields['event'], fields.get('id'), json.loads(fields['data'])))
+    return events
+
+
+def test_event_stream():
+    """Every song is streamed once with the running averages, reconnects skip what the client has"""
+    with tempfile.TemporaryDirectory() as directory:
+        queue = _queue(directory)
+        manager = analysis_jobs.JobManager(queue)
+        app = FakeApp(['c1l', 'f2', 'f3l'])
+        job_id = manager.submit('alice', 'liked', {'user_id': 'alice'})
+
+        # queued: a progress event, then keepalives while nothing happens
+        stream = manager.events(job_id, 'alice', poll=0, keepalive=0)
+        assert next(stream).startswith('retry:')
+        event, _, data = _events([next(stream)])[0]
+        assert event == 'progress' and data['status'] == analysis_jobs.QUEUED
+        assert next(stream) == ": keepalive\n\n"
+        stream.close()
+
+        _drain(app.worker(queue))
+        events = _events(manager.events(job_id, 'alice', poll=0))
+        songs = [data for event, _, data in events if event == 'song']
+        assert [song['song']['id'] for song in songs] == ['c1l', 'f2', 'f3l']
+        ids = [int(event_id) for event, event_id, _ in events if event == 'song']
+        assert ids == sorted(set(ids))
+        assert [song['source'] for song in songs] == ['cached', 'fresh', 'fresh']
+        first, last = songs[0]['aggregate'], songs[-1]['aggregate']
+        assert first['songs'] == 1 and abs(first['features']['energy'] - 0.2) < 1e-9
+        assert last['songs'] == 3 and last['lyric_songs'] == 2
+        assert abs(last['features']['energy'] - 0.4) < 1e-9 and last['features']['tempo'] == 120
+        assert last['emotions'] == {'Joy': 0.8, 'Sadness': 0.2}
+        assert events[-1][0] == analysis_jobs.DONE
+
+        resumed = [data for event, _, data in _events(manager.events(job_id, 'alice', after=ids[1], poll=0)) if event == 'song']
+        assert len(resumed) == 1 and resumed[0]['aggregate'] == last
+        assert _events(manager.events(job_id, 'bob', poll=0)) == [('failed', None, {'error': 'unknown job'})]
+        queue.close()
+    print("✓ Songs stream as they finish, with running averages")
+
+
+def test_known_songs_skip_tasks():
+    """Songs the result already has get no song task but count in progress and the event stream"""
+    with tempfile.TemporaryDirectory() as directory:
+        queue = _queue(directory)
+        manager = analysis_jobs.JobManager(queue)
+        app = FakeApp(['k1', 'f2', 'k3l'])
+        asked = []
+
+        def known(kind, token, params, song_ids):
+            asked.append(list(song_ids))
+            return {song_id: {'id': song_id, 'features': {'energy': 0.5}, 'emotion': {'Joy': 1.0} if song_id.endswith('l') else None}
+                    for song_id in song_ids if song_id.startswith('k')}
+
+        job_id = manager.submit('alice', 'liked', {'user_id': 'alice'})
+        worker = analysis_jobs.Worker(queue, app.token, app.list_songs, app.analyze, app.finish, known=known, name='w1')
+        _drain(worker)
+        assert asked == [['k1', 'f2', 'k3l']] and app.analyzed == ['f2']
+        statuses, _ = queue.task_counts(job_id, analysis_jobs.SONG)
+        assert statuses == {analysis_jobs.DONE: 1}
+        status = manager.status(job_id, 'alice')
+        assert status['status'] == analysis_jobs.DONE
+        progress = status['progress']
+        assert progress['total'] == 3 and progress['done'] == 3 and progress['cached'] == 2 and progress['fresh'] == 1
+
+        events = _events(manager.events(job_id, 'alice', poll=0))
+        songs = [(event_id, data) for event, event_id, data in events if event == 'song']
+        assert [song['song']['id'] for _, song in songs] == ['k1', 'k3l', 'f2']
+        assert [event_id for event_id, _ in songs] == ['1', '2', '3']
+        assert [song['source'] for _, song in songs] == ['cached', 'cached', 'fresh']
+        assert songs[-1][1]['aggregate']['songs'] == 3 and songs[-1][1]['aggregate']['lyric_songs'] == 1
+        resumed = [data for event, _, data in _events(manager.events(job_id, 'alice', after=2, poll=0)) if event == 'song']
+        assert [song['song']['id'] for song in resumed] == ['f2'] and resumed[0]['aggregate'] == songs[-1][1]['aggregate']
+
+        # every song known: straight to the finish task
+        job_id = manager.submit('alice', 'albums', {'user_id': 'alice'})
+        app.songs = ['k1', 'k3l']
+        _drain(worker)
+        assert app.analyzed == ['f2'] and manager.result(job_id, 'alice') == {'kind': 'albums', 'amount': 2}
+        assert manager.status(job_id, 'alice')['progress']['done'] == 2
+        queue.close()
+    print("✓ Known songs skip their song tasks")
+
+
+def test_result_expiry():
+    """Finished jobs are only kept for the result TTL"""
+    with tempfile.TemporaryDirectory() as directory:
+        queue = _queue(directory)
+        manager = analysis_jobs.JobManager(queue, result_ttl=60)
+        job_id = manager.submit('alice', 'recent', {'user_id': 'alice'})
+        _drain(FakeApp([]).worker(queue))
+        assert manager.result(job_id, 'alice') == {'kind': 'recent', 'amount': 0}
+
+        queue._conn().execute('UPDATE jobs SET finished_at = finished_at - 120')
+        assert manager.status(job_id, 'alice') is None
+        manager.submit('alice', 'recent', {'user_id': 'alice'})
+        assert queue.job(job_id) is None
+        queue.close()
+    print("✓ Old results expire")
+
+
+def main():
+    """Run all tests"""
+    tests = [test_job_runs_through_tasks, test_songs_done_during_batch, test_retries_then_failure, test_survives_restart,
+             test_only_lease_holder_finishes, test_expired_leases_give_up, test_event_stream, test_known_songs_skip_tasks,
+             test_result_expiry]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+        except AssertionError as e:
+            failed += 1
+            print(f"✗ {test.__name__} failed: {e}")
+    print(f"\nResults: {len(tests) - failed}/{len(tests)} tests passed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,6 +5,12 @@ Simple test script to verify the MusicAI app can start without critical errors
 
 import os
 import sys
+import tempfile
+
+# the app opens its song store and work queue on import, keep test runs out of the real ones
+_workdir = tempfile.TemporaryDirectory()
+os.environ['SONG_STORE_PATH'] = os.path.join(_workdir.name, 'songs.sqlite3')
+os.environ['WORK_QUEUE_PATH'] = os.path.join(_workdir.name, 'work_queue.db')
 
 def test_imports():
     """Test if all required modules can be imported"""
@@ -108,6 +114,54 @@ def test_meme_functionality():
         print(f"ℹ Meme functionality test skipped: {e}")
         return True  # Not a failure
 
+def test_song_analysis_watson_down():
+    """Test that a song with lyrics still renders while the Watson circuit is open"""
+    import io
+    import contextlib
+
+    # no background workers for a test request
+    os.environ['ANALYSIS_EMBEDDED_WORKERS'] = '0'
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            sys.path.insert(0, '.')
+            import musicAI
+    except ImportError as e:
+        print(f"ℹ Song analysis test skipped: {e}")
+        return
+    import stage_cache
+
+    # everything up to watson comes from the cache, so nothing goes over the network
+    song_id = 'test-watson-down'
+    features = {key: 0.5 for key in ['danceability', 'energy', 'speechiness', 'acousticness', 'liveness', 'valence']}
+    features.update({'tempo': 120.0, 'duration_ms': 200000, 'loudness': -5.0})
+    musicAI.song_stages.put(stage_cache.TRACK, song_id, {'name': 'Song', 'artists': ['Artist']})
+    musicAI.song_stages.put(stage_cache.AUDIO_FEATURES, song_id, features)
+    musicAI.song_stages.put(stage_cache.LYRICS, song_id, ['bar one', 'bar two'])
+
+    breaker = musicAI.watson_breaker
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(breaker.min_calls):
+                breaker.record(False)
+        client = musicAI.application.test_client()
+        with client.session_transaction() as session:
+            session['spotify_token'] = 'token'
+            session['amount'] = 0
+        with contextlib.redirect_stdout(io.StringIO()):
+            response = client.post('/song-analysis', data={
+                'analysis_id': song_id,
+                'song_name': 'Song',
+                'song_artist_name': 'Artist',
+            })
+    finally:
+        breaker.reset()
+        for stage in stage_cache.STAGES:
+            musicAI.song_db.delete(stage_cache.stage_key(stage, song_id))
+
+    assert response.status_code == 200, f"song analysis with Watson down returned {response.status_code}"
+    assert b'Watson' in response.data, "the page does not say Watson was skipped"
+    print("✓ Song analysis renders without Watson while its circuit is open")
+
 def main():
     """Run all tests"""
     print("Testing MusicAI app...\n")
@@ -116,7 +170,8 @@ def main():
         ("Module Imports", test_imports),
         ("Environment Variables", test_env_file),
         ("App Creation", test_app_creation),
-        ("Meme Functionality", test_meme_functionality)
+        ("Meme Functionality", test_meme_functionality),
+        ("Song Analysis With Watson Down", test_song_analysis_watson_down)
     ]
     
     passed = 0
@@ -124,7 +179,13 @@ def main():
     
     for test_name, test_func in tests:
         print(f"Running: {test_name}")
-        if test_func():
+        try:
+            # assert-style tests return None
+            ok = test_func() is not False
+        except AssertionError as e:
+            print(f"✗ {test_name} failed: {e}")
+            ok = False
+        if ok:
             passed += 1
         print()
     
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Test script for the cache metrics
+"""
+
+import os
+import sys
+import tempfile
+
+import cache_metrics
+import song_store
+import stage_cache
+import work_queue
+
+
+class DictStore(dict):
+    """Bare in-memory stand-in for a song store"""
+
+    def put(self, key, record):
+        self[key] = record
+
+
+def test_percentile():
+    """Nearest rank percentiles"""
+    values = list(range(1, 101))
+    assert cache_metrics.percentile(values, 50) == 50
+    assert cache_metrics.percentile(values, 95) == 95
+    assert cache_metrics.percentile([7], 95) == 7
+    assert cache_metrics.percentile([], 50) is None
+    print("✓ Percentiles are nearest rank")
+
+
+def test_stage_counters():
+    """Hits, misses and dead-end hits are counted per stage"""
+    stages = stage_cache.StageCache(DictStore())
+    stages.get_or_fill(stage_cache.TRACK, 'abc', lambda: {'name': 'Song'})
+    stages.get_or_fill(stage_cache.TRACK, 'abc', lambda: {'name': 'Song'})
+    stages.get_or_fill(stage_cache.GENIUS_URL, 'abc', lambda: stage_cache.Negative(stage_cache.NO_HIT))
+    stages.get_or_fill(stage_cache.GENIUS_URL, 'abc', lambda: 'unused')
+
+    snapshot = stages.metrics.snapshot()['stages']
+    track = snapshot[stage_cache.TRACK]
+    assert (track['hits'], track['misses'], track['fills']) == (1, 1, 1)
+    assert track['hit_ratio'] == 0.5
+    assert track['fill_p50_ms'] is not None
+    genius = snapshot[stage_cache.GENIUS_URL]
+    assert (genius['negative_hits'], genius['misses']) == (1, 1)
+    print("✓ Stage lookups are counted")
+
+
+def test_most_expensive_misses():
+    """Only the slowest fills are kept, slowest first"""
+    metrics = cache_metrics.CacheMetrics(top_n=3)
+    for i, seconds in enumerate([0.1, 2.0, 0.5, 3.0, 0.2, 1.0]):
+        metrics.record_fill(stage_cache.LYRICS, f"song{i}", seconds)
+
+    misses = metrics.snapshot(top=2)['most_expensive_misses']
+    assert [miss['key'] for miss in misses] == ['song3', 'song1']
+    assert misses[0]['fill_ms'] == 3000.0
+    print("✓ Most expensive misses are tracked")
+
+
+def test_combine_processes():
+    """Snapshots of several processes add up, through the work queue as worker processes publish them"""
+    web, worker = cache_metrics.CacheMetrics(), cache_metrics.CacheMetrics()
+    web.record_hit(stage_cache.LYRICS)
+    web.record_fill(stage_cache.LYRICS, 'a', 0.1)
+    for song_id, seconds in (('b', 0.3), ('c', 0.2)):
+        worker.record_miss(stage_cache.LYRICS)
+        worker.record_fill(stage_cache.LYRICS, song_id, seconds)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        queue = work_queue.WorkQueue(os.path.join(workdir, 'work_queue.db'))
+        queue.put_worker_metrics('w1', worker.snapshot())
+        published = queue.worker_metrics()
+        assert list(published) == ['w1']
+        assert queue.worker_metrics(max_age=-1) == {}
+        queue.close()
+
+    combined = cache_metrics.combine([web.snapshot(), *published.values()], top=2)
+    lyrics = combined['stages'][stage_cache.LYRICS]
+    assert (lyrics['hits'], lyrics['misses'], lyrics['fills']) == (1, 2, 3)
+    assert abs(lyrics['hit_ratio'] - 1 / 3) < 1e-9
+    assert lyrics['fill_p95_ms'] == 300.0
+    assert [miss['key'] for miss in combined['most_expensive_misses']] == ['b', 'c']
+    print("✓ Metrics of worker processes are added up")
+
+
+def test_store_usage():
+    """Stores report entries and bytes per stage"""
+    with tempfile.TemporaryDirectory() as tmp:
+        store = song_store.SQLiteSongStore(os.path.join(tmp, 'songs.sqlite3'))
+        stages = stage_cache.StageCache(store)
+        stages.put(stage_cache.LYRICS, 'a', ['bar'] * 50)
+        stages.put(stage_cache.LYRICS, 'b', ['bar'])
+        stages.put(stage_cache.TRACK, 'a', {'name': 'Song'})
+        store.put('library:user', {'songs': []})
+
+        usage = store.usage()
+        assert usage[stage_cache.LYRICS]['entries'] == 2
+        assert usage[stage_cache.LYRICS]['bytes'] > usage[stage_cache.TRACK]['bytes']
+        assert usage[stage_cache.TRACK]['entries'] == 1
+        assert usage['library']['entries'] == 1
+        store.close()
+    print("✓ Store usage is split by stage")
+
+
+def main():
+    """Run all tests"""
+    tests = [test_percentile, test_stage_counters, test_most_expensive_misses, test_combine_processes,
+             test_store_usage]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+        except AssertionError as e:
+            failed += 1
+            print(f"✗ {test.__name__} failed: {e}")
+    print(f"\nResults: {len(tests) - failed}/{len(tests)} tests passed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Test script for the per-upstream circuit breakers
+"""
+
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import circuit_breaker
+import http_client
+
+
+def test_opens_and_recovers():
+    """Too many failures open the breaker, a good probe after the cool-down closes it"""
+    breaker = circuit_breaker.CircuitBreaker('test', window=10, min_calls=4, failure_ratio=0.5, open_seconds=0.05)
+    for ok in (True, True, False):
+        assert breaker.allow()
+        breaker.record(ok)
+    assert breaker.state == circuit_breaker.CLOSED
+
+    breaker.record(False)
+    assert breaker.state == circuit_breaker.OPEN
+    assert not breaker.allow()
+    assert breaker.snapshot()['refused'] == 1
+
+    time.sleep(0.06)
+    assert breaker.allow()            # the probe
+    assert not breaker.allow()        # only one at a time
+    breaker.record(False)
+    assert breaker.state == circuit_breaker.OPEN and breaker.opened == 2
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record(True)
+    assert breaker.state == circuit_breaker.CLOSED
+    assert breaker.snapshot()['recent_calls'] == 0
+
+    for _ in range(4):
+        breaker.record(False)
+    assert breaker.state == circuit_breaker.OPEN
+    breaker.reset()
+    assert breaker.state == circuit_breaker.CLOSED and breaker.allow()
+    assert breaker.snapshot()['recent_calls'] == 0 and breaker.opened == 3
+    print("✓ Breaker opens, probes and closes")
+
+
+def test_slow_calls_fail():
+    """Calls slower than the limit count as failures, guard() raises CircuitOpen once open"""
+    breaker = circuit_breaker.CircuitBreaker('slow', min_calls=2, open_seconds=60, slow_seconds=0.01)
+    for _ in range(2):
+        with breaker.guard():
+            time.sleep(0.02)
+    assert breaker.state == circuit_breaker.OPEN
+
+    try:
+        with breaker.guard():
+            assert False, "the block must not run"
+    except circuit_breaker.CircuitOpen as e:
+        assert e.name == 'slow' and e.retry_in > 0
+
+    ignored = circuit_breaker.CircuitBreaker('input', min_calls=2)
+    for _ in range(3):
+        try:
+            with ignored.guard(lambda error: False):
+                raise ValueError("lyrics too short")
+        except ValueError:
+            pass
+    assert ignored.state == circuit_breaker.CLOSED
+    print("✓ Slow calls trip the breaker, ignored errors don't")
+
+
+def test_skipped_per_thread():
+    """Refused upstreams are noted on the refusing thread only"""
+    breaker = circuit_breaker.CircuitBreaker('genius.com', min_calls=1, open_seconds=60)
+    breaker.record(False)
+
+    def job(n):
+        circuit_breaker.reset_skipped()
+        if n % 2:
+            breaker.allow()
+        return circuit_breaker.skipped()
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        assert list(pool.map(job, range(6))) == [[], ['genius.com']] * 3
+    assert circuit_breaker.labels(['genius.com', 'watson', 'other']) == ['Genius lyrics', 'Watson', 'other']
+    print("✓ Skipped upstreams are tracked per song")
+
+
+class _Failing(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    calls = 0
+
+    def do_GET(self):
+        _Failing.calls += 1
+        self.send_response(503)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def test_http_client_fails_fast():
+    """After enough 5xx the client refuses calls to the host without sending them"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Failing)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://localhost:{server.server_address[1]}/"
+    client = http_client.HttpClient()
+    try:
+        for _ in range(circuit_breaker.MIN_CALLS):
+            assert client.get(url).status_code == 503
+        try:
+            client.get(url)
+            assert False, "expected UpstreamUnavailable"
+        except requests.exceptions.ConnectionError as e:
+            assert isinstance(e, http_client.UpstreamUnavailable)
+        assert _Failing.calls == circuit_breaker.MIN_CALLS
+        assert circuit_breaker.snapshot()['localhost']['state'] == circuit_breaker.OPEN
+    finally:
+        circuit_breaker._breakers.pop('localhost', None)
+        client.close()
+        server.shutdown()
+    print("✓ Client fails fast while a host's circuit is open")
+
+
+def test_probe_released_on_any_error():
+    """A half-open probe that fails with something other than a request error doesn't keep the circuit stuck"""
+    breaker = circuit_breaker.breaker('probe.test')
+    breaker.open_seconds = 0
+    for _ in range(breaker.min_calls):
+        breaker.record(False)
+    client = http_client.HttpClient()
+
+    def broken(method, url, **kwargs):
+        raise ValueError("bad hook")
+
+    class Ok:
+        status_code = 200
+
+    try:
+        client.session.request = broken
+        try:
+            client.get('http://probe.test/')
+            assert False, "expected ValueError"
+        except ValueError:
+            pass
+        assert breaker.state == circuit_breaker.OPEN
+
+        client.session.request = lambda method, url, **kwargs: Ok()
+        assert client.get('http://probe.test/').status_code == 200
+        assert breaker.state == circuit_breaker.CLOSED
+    finally:
+        circuit_breaker._breakers.pop('probe.test', None)
+        client.close()
+    print("✓ Half-open probes are released whatever they fail with")
+
+
+def main():
+    """Run all tests"""
+    tests = [test_opens_and_recovers, test_slow_calls_fail, test_skipped_per_thread, test_http_client_fails_fast,
+             test_probe_released_on_any_error]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+        except AssertionError as e:
+            failed += 1
+            print(f"✗ {test.__name__} failed: {e}")
+    print(f"\nResults: {len(tests) - failed}/{len(tests)} tests passed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
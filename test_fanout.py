@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Test script for the fan-out engine
+"""
+
+import asyncio
+import random
+import sys
+import threading
+import time
+
+import fanout
+
+
+def test_results_in_order():
+    """Jobs finish in any order but results line up with the input"""
+    def job(n):
+        time.sleep(random.uniform(0, 0.01))
+        return n * n
+
+    assert fanout.run(job, range(50), workers=8) == [n * n for n in range(50)]
+    assert fanout.run(job, []) == []
+    print("✓ Results keep input order")
+
+
+def test_concurrency():
+    """Jobs overlap, up to the worker count and no further"""
+    lock = threading.Lock()
+    running = [0]
+    peak = [0]
+
+    def job(n):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+
+    started = time.perf_counter()
+    fanout.run(job, range(40), workers=8)
+    assert peak[0] == 8
+    assert time.perf_counter() - started < 40 * 0.02 / 2
+    print("✓ Jobs run concurrently within the worker limit")
+
+
+def test_errors_raised():
+    """An exception in a job reaches the caller"""
+    def job(n):
+        if n == 3:
+            raise ValueError("bad song")
+        return n
+
+    try:
+        fanout.run(job, range(6))
+        assert False, "expected ValueError"
+    except ValueError as e:
+        assert str(e) == "bad song"
+
+def test_shared_loop():
+    """One loop thread serves coroutines from many threads, exceptions reach the caller"""
+    loop = fanout.Loop('test-fanout')
+
+    async def square(n):
+        await asyncio.sleep(0.001)
+        return n * n, threading.current_thread().name
+
+    results = {}
+
+    def call(n):
+        results[n] = loop.call(square(n))
+
+    threads = [threading.Thread(target=call, args=(n,)) for n in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert {n: value for n, (value, _) in results.items()} == {n: n * n for n in range(10)}
+    assert {name for _, name in results.values()} == {'test-fanout'}
+    assert loop.call(fanout.gather(lambda n: n + 1, range(5), workers=2)) == [1, 2, 3, 4, 5]
+
+    async def fail():
+        raise ValueError("loop job failed")
+
+    try:
+        loop.call(fail())
+        assert False, "expected ValueError"
+    except ValueError as e:
+        assert str(e) == "loop job failed"
+    loop.close()
+    print("✓ Shared loop runs coroutines from any thread")
+
+
+def main():
+    """Run all tests"""
+    tests = [test_results_in_order, test_concurrency, test_errors_raised, test_shared_loop]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+        except AssertionError as e:
+            failed += 1
+            print(f"✗ {test.__name__} failed: {e}")
+    print(f"\nResults: {len(tests) - failed}/{len(tests)} tests passed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
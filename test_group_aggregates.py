@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Test script for the incremental group aggregates
+"""
+
+import sys
+
+import group_aggregates
+
+
+class DictStore(dict):
+    """Bare in-memory stand-in for a song store"""
+
+    def put(self, key, record):
+        self[key] = record
+
+    def delete(self, key):
+        self.pop(key, None)
+
+
+def _nlu(joy, keyword, concept='music/jazz', sentiment='positive'):
+    top, *rest = concept.split('/')
+    return {
+        'averageEmotion': {'Anger': 0.1, 'Disgust': 0.1, 'Fear': 0.1, 'Joy': joy, 'Sadness': 1 - joy},
+        'relationsfrequencies': {'locatedAt': ['home']},
+        'sentiment_frequencies': {sentiment: 1},
+        'entityfrequencies': {'Person': [('Bob', 0.5)]},
+        'keywordfrequencies': {'joy': [keyword]},
+        'conceptfrequencies': {top: rest, 'art': []},
+        'subjectsfrequencies': {'past': ['I']},
+    }
+
+
+def _song(song_id, energy, nlu=None, degraded=()):
+    """A song the way musicAI._song_result hands it over"""
+    song = {key: 0.5 for key in group_aggregates.FEATURES}
+    song.update({'energy': energy, 'duration_ms': 200000})
+    song['ai'] = {'lyrics': ['la'] if nlu else None, 'nlu': nlu}
+    song['song_title'] = f"title {song_id}"
+    song['artist_name'] = f"artist {song_id}"
+    song['degraded'] = list(degraded)
+    return song
+
+
+SONGS = {
+    'a': _song('a', 0.2, _nlu(0.8, 'sun')),
+    'b': _song('b', 0.4),
+    'c': _song('c', 0.6, _nlu(0.4, 'rain', 'music/blues', 'negative')),
+    'd': _song('d', 0.8, _nlu(0.6, 'sun')),
+}
+
+
+def _built(song_ids, songs=SONGS):
+    aggregate = group_aggregates.GroupAggregate()
+    for song_id in song_ids:
+        aggregate.add(song_id, songs[song_id])
+    return aggregate
+
+
+def _same(left, right):
+    if isinstance(left, float) or isinstance(right, float):
+        return abs(left - right) < 1e-9
+    if isinstance(left, dict):
+        return left.keys() == right.keys() and all(_same(left[key], right[key]) for key in left)
+    if isinstance(left, (list, tuple)):
+        return len(left) == len(right) and all(_same(a, b) for a, b in zip(left, right))
+    return left == right
+
+
+def test_stats():
+    """Averages, emotion means, frequency tables and counts over the group"""
+    stats = _built(['a', 'b', 'c']).stats(['a', 'b', 'c'])
+    assert _same(stats['energy'], 0.4) and stats['duration_ms'] == 200000
+    ai = stats['ai']
+    assert ai['amount'] == 2 and _same(ai['averageEmotion']['Joy'], 0.6)
+    assert ai['keywordfrequencies'] == {'joy': ['sun', 'rain']}
+    assert ai['conceptfrequencies'] == {'music': ['jazz', 'blues']}
+    assert ai['sentiment_frequencies'] == {'positive': 1, 'negative': 1}
+    assert ai['entityfrequencies'] == {'Person': [['Bob', 0.5], ['Bob', 0.5]]}
+    assert ai['watson_songs'] == [('title a', 'artist a'), ('title c', 'artist c')]
+    assert stats['degraded'] == []
+
+    no_lyrics = _built(['b']).stats(['b'])
+    assert no_lyrics['ai'] is None and _same(no_lyrics['energy'], 0.4)
+    print("✓ Aggregates give the group averages and tables")
+
+
+def test_deltas_match_rebuild():
+    """Adding and removing songs ends where building the new group from scratch does"""
+    aggregate = _built(['a', 'b', 'c'])
+    added, removed = aggregate.delta(['b', 'c', 'd', 'd'])
+    assert added == ['d', 'd'] and removed == ['a']
+    for song_id in removed:
+        aggregate.remove(song_id, SONGS[song_id], SONGS[song_id]['ai']['nlu'])
+    for song_id in added:
+        aggregate.add(song_id, SONGS[song_id])
+    assert _same(aggregate.stats(['b', 'c', 'd', 'd']), _built(['b', 'c', 'd', 'd']).stats(['b', 'c', 'd', 'd']))
+
+    # everything out again leaves nothing behind
+    for song_id in ['b', 'c', 'd', 'd']:
+        aggregate.remove(song_id, SONGS[song_id], SONGS[song_id]['ai']['nlu'])
+    assert aggregate.members == {} and aggregate.songs == 0 and aggregate.lyric_songs == 0
+    assert all(table == {} for table in aggregate.tables.values()) and aggregate.counts == {}
+
+    try:
+        _built(['a']).remove('a', SONGS['a'], _nlu(0.1, 'changed'))
+        assert False, "expected StaleAggregate"
+    except group_aggregates.StaleAggregate:
+        pass
+    print("✓ Deltas match a rebuild")
+
+
+def test_update_only_analyzes_changes():
+    """A kept aggregate only analyzes new songs, retries degraded ones and rebuilds when stale"""
+    store = DictStore()
+    aggregates = group_aggregates.GroupAggregates(store)
+    key = group_aggregates.aggregate_key('liked', 'alice')
+    analyzed = []
+    cache = dict(SONGS)
+
+    def analyze(song_ids):
+        analyzed.append(list(song_ids))
+        return [cache.get(song_id) for song_id in song_ids]
+
+    def cached(song_id):
+        return cache[song_id], cache[song_id]['ai']['nlu']
+
+    cache['b'] = _song('b', 0.4, degraded=['Watson'])
+    aggregate = aggregates.update(key, ['a', 'b', 'a'], analyze, cached, {'nlu': 1})
+    assert analyzed == [['a', 'b']] and aggregate.stats(['a', 'b', 'a'])['degraded'] == ['Watson']
+    assert key in store
+
+    # watson is back for b, c is new, a stays: only b and c are analyzed
+    cache['b'] = _song('b', 0.4, _nlu(0.2, 'fog'))
+    aggregate = aggregates.update(key, ['a', 'b', 'a', 'c'], analyze, cached, {'nlu': 1})
+    assert analyzed[-1] == ['b', 'c']
+    assert _same(aggregate.stats(['a', 'b', 'a', 'c']), _built(['a', 'b', 'a', 'c'], cache).stats(['a', 'b', 'a', 'c']))
+    rows = aggregate.song_rows(['a', 'b', 'a', 'c'])
+    assert list(rows) == ['title a', 'title b', 'title c'] and rows['title c']['id'] == 'c'
+
+    # nothing changed: nothing analyzed
+    aggregates.update(key, ['a', 'b', 'a', 'c'], analyze, cached, {'nlu': 1})
+    assert len(analyzed) == 2
+
+    # a removed song whose cached analysis changed meanwhile: rebuilt from scratch
+    cache['c'] = _song('c', 0.9, _nlu(0.9, 'new'))
+    aggregate = aggregates.update(key, ['a', 'b', 'a'], analyze, cached, {'nlu': 1})
+    assert analyzed[-1] == ['a', 'b']
+    assert _same(aggregate.stats(['a', 'b', 'a']), _built(['a', 'b', 'a'], cache).stats(['a', 'b', 'a']))
+
+    # a new stage version rebuilds too
+    aggregates.update(key, ['a', 'b', 'a'], analyze, cached, {'nlu': 2})
+    assert analyzed[-1] == ['a', 'b']
+
+    # what the next update builds on (analysis jobs only queue its delta)
+    assert set(aggregates.current(key, {'nlu': 2}).members) == {'a', 'b'}
+    assert aggregates.current(key, {'nlu': 3}) is None and aggregates.current(None, {'nlu': 2}) is None
+    print("✓ Kept aggregates only analyze what changed")
+
+
+def main():
+    """Run all tests"""
+    tests = [test_stats, test_deltas_match_rebuild, test_update_only_analyzes_changes]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+        except AssertionError as e:
+            failed += 1
+            print(f"✗ {test.__name__} failed: {e}")
+    print(f"\nResults: {len(tests) - failed}/{len(tests)} tests passed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Test script for the pooled HTTP client
+"""
+
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import http_client
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def do_GET(self):
+        body = b'{"ok": true}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Set-Cookie', 'session=abc')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def test_connections_reused():
+    """Sequential calls to one host share a single keep-alive connection"""
+    server, url = _server()
+    client = http_client.HttpClient()
+    for _ in range(5):
+        assert client.get(url + '/v1/me').json() == {'ok': True}
+
+    counts = client.stats.snapshot()['127.0.0.1']
+    assert counts['requests'] == 5
+    assert counts['connections'] == 1
+    assert counts['reused'] == 4
+    assert not client.session.cookies
+    client.close()
+    server.shutdown()
+    print("✓ Connections are reused")
+
+
+def test_pool_bounded_under_threads():
+    """Concurrent callers open at most pool_size connections"""
+    server, url = _server()
+    client = http_client.HttpClient(pool_size=4)
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = list(pool.map(lambda i: client.get(f"{url}/tracks/{i}").status_code, range(40)))
+
+    assert results == [200] * 40
+    counts = client.stats.snapshot()['127.0.0.1']
+    assert counts['requests'] == 40
+    assert counts['connections'] <= 4
+    client.close()
+    server.shutdown()
+    print("✓ Pool stays bounded across threads")
+
+
+def test_host_slots():
+    """No more calls than the host's limit are in flight at once"""
+    client = http_client.HttpClient(host_limits={'genius.com': 2})
+    lock = threading.Lock()
+    running = [0]
+    peak = [0]
+
+    def job(n):
+        with client.host_slot('genius.com'):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+
+    with ThreadPoolExecutor(max_workers=6) as pool:
+        list(pool.map(job, range(12)))
+    assert peak[0] == 2
+    client.close()
+    print("✓ Per-host limits hold under concurrent calls")
+
+
+def main():
+    """Run all tests"""
+    tests = [test_connections_reused, test_pool_bounded_under_threads, test_host_slots]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+        except AssertionError as e:
+            failed += 1
+            print(f"✗ {test.__name__} failed: {e}")
+    print(f"\nResults: {len(tests) - failed}/{len(tests)} tests passed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Test script for the incremental library mirror
+"""
+
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import library_sync
+import spotify_api
+
+
+class DictStore(dict):
+    """Bare in-memory stand-in for a song store"""
+
+    def put(self, key, record):
+        self[key] = record
+
+    def delete(self, key):
+        self.pop(key, None)
+
+
+class FakeSpotify(BaseHTTPRequestHandler):
+    """/me/tracks, /me/playlists and playlist tracks over a library the test can change"""
+    protocol_version = 'HTTP/1.1'
+    likes = []        # newest first
+    playlists = {}    # id -> (snapshot_id, [track ids])
+    paths = []
+    lock = threading.Lock()
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        offset, limit = int(query.get('offset', ['0'])[0]), int(query.get('limit', ['50'])[0])
+        with self.lock:
+            self.paths.append(url.path)
+            if url.path == '/v1/me/tracks':
+                items = self.likes
+            elif url.path == '/v1/me/playlists':
+                items = [
+                    {'id': pid, 'name': pid, 'description': '', 'owner': {'display_name': 'me'}, 'snapshot_id': snapshot,
+                     'tracks': {'href': f"{self.base}/playlists/{pid}/tracks", 'total': len(tracks)}}
+                    for pid, (snapshot, tracks) in sorted(self.playlists.items())
+                ]
+            else:
+                pid = url.path.split('/')[3]
+                items = [{'track': {'id': tid, 'name': tid, 'artists': [{'name': 'Artist'}]}} for tid in self.playlists[pid][1]]
+            page = items[offset:offset + limit]
+            body = json.dumps({'items': page, 'total': len(items), 'next': 'more' if offset + limit < len(items) else None}).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _like(n):
+    return {'added_at': f"2024-01-01T00:{n // 60:02d}:{n % 60:02d}Z",
+            'track': {'id': f"t{n}", 'name': f"Song {n}", 'artists': [{'name': 'Artist'}], 'popularity': 1}}
+
+
+def _serve():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeSpotify)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    FakeSpotify.base = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    FakeSpotify.paths = []
+    spotify_api.API_URL = FakeSpotify.base
+    return server
+
+
+def test_likes_incremental():
+    """Repeat syncs read one page, new saves are prepended, an unsave triggers a full download"""
+    server = _serve()
+    sync = library_sync.LibrarySync(DictStore())
+    FakeSpotify.likes = [_like(n) for n in range(120, 0, -1)]
+
+    assert [song['id'] for song in sync.likes('token', 'user')][:2] == ['t120', 't119']
+    assert len(FakeSpotify.paths) == 3
+
+    FakeSpotify.paths = []
+    assert len(sync.likes('token', 'user')) == 120
+    assert len(FakeSpotify.paths) == 1
+
+    FakeSpotify.likes.insert(0, _like(121))
+    FakeSpotify.paths = []
+    songs = sync.likes('token', 'user')
+    assert songs[0]['id'] == 't121' and len(songs) == 121
+    assert len(FakeSpotify.paths) == 1
+
+    del FakeSpotify.likes[50]
+    songs = sync.likes('token', 'user')
+    assert len(songs) == 120
+    assert [song['id'] for song in songs] == [item['track']['id'] for item in FakeSpotify.likes]
+    server.shutdown()
+    spotify_api.API_URL = 'https://api.spotify.com/v1'
+    print("✓ Liked songs sync incrementally")
+
+
+def test_unsave_offset_by_save():
+    """An unsave and a new save between two syncs keep the total, the count still gives the unsave away"""
+    server = _serve()
+    sync = library_sync.LibrarySync(DictStore())
+    FakeSpotify.likes = [_like(n) for n in range(120, 0, -1)]
+    sync.likes('token', 'user')
+
+    for removed in (10, 100):            # on the first page, and further down
+        del FakeSpotify.likes[removed]
+        FakeSpotify.likes.insert(0, _like(121 + removed))
+        assert len(FakeSpotify.likes) == 120
+        FakeSpotify.paths = []
+        songs = sync.likes('token', 'user')
+        # mirrored 120 + 1 new != 120: the first page, then everything again
+        assert len(FakeSpotify.paths) == 4
+        assert [song['id'] for song in songs] == [item['track']['id'] for item in FakeSpotify.likes]
+
+    FakeSpotify.paths = []
+    assert len(sync.likes('token', 'user')) == 120 and len(FakeSpotify.paths) == 1
+    server.shutdown()
+    spotify_api.API_URL = 'https://api.spotify.com/v1'
+    print("✓ Unsaves are caught even when a new save keeps the total")
+
+
+def test_playlists_snapshot():
+    """Only playlists whose snapshot_id changed are downloaded again"""
+    server = _serve()
+    sync = library_sync.LibrarySync(DictStore())
+    FakeSpotify.playlists = {'a': ('s1', [f"a{n}" for n in range(150)]), 'b': ('s1', ['b0'])}
+
+    first = sync.playlists('token', 'user')
+    assert [len(playlist['songs']) for playlist in first] == [150, 1]
+
+    FakeSpotify.paths = []
+    assert [len(playlist['songs']) for playlist in sync.playlists('token', 'user')] == [150, 1]
+    assert FakeSpotify.paths == ['/v1/me/playlists']
+
+    FakeSpotify.playlists['b'] = ('s2', ['b0', 'b1'])
+    FakeSpotify.paths = []
+    assert [len(playlist['songs']) for playlist in sync.playlists('token', 'user')] == [150, 2]
+    assert FakeSpotify.paths == ['/v1/me/playlists', '/v1/playlists/b/tracks']
+    server.shutdown()
+    spotify_api.API_URL = 'https://api.spotify.com/v1'
+    print("✓ Unchanged playlists are not downloaded again")
+
+
+def main():
+    """Run all tests"""
+    tests = [test_likes_incremental, test_unsave_offset_by_save, test_playlists_snapshot]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+        except AssertionError as e:
+            failed += 1
+            print(f"✗ {test.__name__} failed: {e}")
+    print(f"\nResults: {len(tests) - failed}/{len(tests)} tests passed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Test script for the in-process song cache tier
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+import memory_cache
+import song_store
+
+
+def test_lru_eviction():
+    """Least recently used records go first once the byte budget is used up"""
+    record = {'lyrics': ['x' * 90]}
+    size = memory_cache.estimate_size(record)
+    cache = memory_cache.LRUCache(max_bytes=size * 3)
+
+    for key in ('a', 'b', 'c'):
+        cache.put(key, record)
+    assert cache.get('a') is record
+    cache.put('d', record)
+
+    assert 'b' not in cache
+    assert 'a' in cache and 'c' in cache and 'd' in cache
+    assert cache.bytes <= cache.max_bytes
+    assert cache.stats()['evictions'] == 1
+    print("✓ LRU eviction respects the byte budget")
+
+
+def test_ttl_expiry():
+    """Entries stop being served once their TTL is up"""
+    cache = memory_cache.LRUCache(ttl=60)
+    cache.put('short', {'v': 1}, ttl=0.01)
+    cache.put('long', {'v': 2})
+    time.sleep(0.02)
+
+    assert cache.get('short') is None
+    assert cache.get('long') == {'v': 2}
+    stats = cache.stats()
+    assert stats['hits'] == 1 and stats['misses'] == 1 and stats['expirations'] == 1
+    print("✓ TTL expiry works")
+
+
+def test_cached_store():
+    """Repeat lookups are served from memory"""
+    with tempfile.TemporaryDirectory() as workdir:
+        backing = song_store.SQLiteSongStore(os.path.join(workdir, 'songs.sqlite3'))
+        backing.put('abc', {'id': 'abc'})
+        store = song_store.CachedStore(backing, memory_cache.LRUCache())
+
+        first = store.get('abc')
+        assert store.get('abc') is first
+        assert store.cache.stats()['hits'] == 1
+        assert store.get('missing') is None
+        store.close()
+    print("✓ Cached store serves repeat lookups from memory")
+
+
+def main():
+    """Run all tests"""
+    tests = [test_lru_eviction, test_ttl_expiry, test_cached_store]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+        except AssertionError as e:
+            failed += 1
+            print(f"✗ {test.__name__} failed: {e}")
+    print(f"\nResults: {len(tests) - failed}/{len(tests)} tests passed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
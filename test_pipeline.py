@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Test script for the staged song analysis pipeline
+"""
+
+import sys
+import threading
+import time
+
+import pipeline
+
+
+def _pipeline(*stages, queue_size=pipeline.QUEUE_SIZE):
+    return pipeline.Pipeline([pipeline.Stage(name, func, workers) for name, func, workers in stages], queue_size=queue_size)
+
+
+def test_results_in_order():
+    """Items pass every stage, results line up with the input, None ends an item early"""
+    seen = []
+
+    def last(n):
+        seen.append(n)
+        return n * 10
+
+    songs = _pipeline(('double', lambda n: n * 2, 3), ('drop odd', lambda n: None if n % 4 else n, 2), ('last', last, 1))
+    assert songs.run(range(8)) == [0, None, 40, None, 80, None, 120, None]
+    assert sorted(seen) == [0, 4, 8, 12]
+    assert songs.run([]) == []
+    stats = songs.stats()
+    assert stats['double']['processed'] == 8 and stats['last']['processed'] == 4
+    songs.close()
+    assert songs.run(range(2)) == [0, None]
+    songs.close()
+    print("✓ Results keep input order")
+
+
+def test_slowest_stage_bounds():
+    """Stages overlap, a group takes about as long as its slowest stage"""
+    def sleeper(seconds):
+        def stage(n):
+            time.sleep(seconds)
+            return n
+        return stage
+
+    songs = _pipeline(('spotify', sleeper(0.01), 4), ('genius', sleeper(0.01), 4), ('watson', sleeper(0.02), 2), queue_size=4)
+    started = time.perf_counter()
+    assert songs.run(range(40)) == list(range(40))
+    elapsed = time.perf_counter() - started
+    # watson alone needs 40 * 0.02 / 2 = 0.4s, all stages one after another 40 * 0.04 / 4 = 0.4s more
+    assert elapsed < 0.7, elapsed
+    stats = songs.stats()
+    assert stats['watson']['capacity_per_second'] < stats['spotify']['capacity_per_second']
+    assert all(stage['max_queued'] <= 4 and stage['queued'] == 0 for stage in stats.values())
+    songs.close()
+    print("✓ Latency follows the slowest stage")
+
+
+def test_errors_and_callbacks():
+    """A stage error is raised after the run, on_result fires per finished item"""
+    def fail_three(n):
+        if n == 3:
+            raise ValueError("watson down")
+        return n
+
+    finished = []
+    lock = threading.Lock()
+
+    def on_result(index, result):
+        with lock:
+            finished.append((index, result))
+
+    songs = _pipeline(('first', fail_three, 2), ('second', lambda n: n + 1, 2))
+    try:
+        songs.run(range(6), on_result=on_result)
+        assert False, "expected ValueError"
+    except ValueError as e:
+        assert str(e) == "watson down"
+    assert sorted(finished) == [(0, 1), (1, 2), (2, 3), (4, 5), (5, 6)]
+    assert songs.stats()['first']['errors'] == 1
+    songs.close()
+    print("✓ Stage errors are raised, results reported as they finish")
+
+
+def test_concurrent_runs():
+    """Runs from several threads share the stage workers and get their own results"""
+    songs = _pipeline(('a', lambda n: n + 1, 3), ('b', lambda n: n * 2, 3), queue_size=2)
+    results = {}
+
+    def run(offset):
+        results[offset] = songs.run(range(offset, offset + 20))
+
+    threads = [threading.Thread(target=run, args=(offset,)) for offset in (0, 100, 200)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for offset, values in results.items():
+        assert values == [(n + 1) * 2 for n in range(offset, offset + 20)]
+    songs.close()
+    print("✓ Concurrent runs share the pipeline")
+
+
+def main():
+    """Run all tests"""
+    tests = [test_results_in_order, test_slowest_stage_bounds, test_errors_and_callbacks, test_concurrent_runs]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+        except AssertionError as e:
+            failed += 1
+            print(f"✗ {test.__name__} failed: {e}")
+    print(f"\nResults: {len(tests) - failed}/{len(tests)} tests passed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Test script for the rate limiter
+"""
+
+import sys
+
+import rate_limit
+
+
+def test_token_bucket():
+    """Bursts up to capacity, then waits 1/rate per request"""
+    bucket = rate_limit.TokenBucket(rate=10, capacity=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert 0.09 < bucket.reserve() <= 0.1
+
+    bucket.pause(5)
+    assert 4.9 < bucket.reserve() <= 5
+    print("✓ Token bucket paces requests")
+
+
+def test_limiter_keys():
+    """Each access token gets its own bucket under the shared app bucket"""
+    waits = []
+    limiter = rate_limit.RateLimiter(app_rate=100, app_burst=100, key_rate=1, key_burst=1, sleep=waits.append)
+    limiter.acquire('token-a')
+    limiter.acquire('token-b')
+    assert waits == []
+    limiter.acquire('token-a')
+    assert len(waits) == 1 and 0.9 < waits[0] <= 1
+    print("✓ Limiter is keyed per token")
+
+
+def test_retry_after_and_budget():
+    """Retry-After in seconds or as a date, retries capped by the budget"""
+    assert rate_limit.parse_retry_after('3') == 3
+    assert rate_limit.parse_retry_after(None, 1.0) == 1.0
+    assert rate_limit.parse_retry_after('Thu, 01 Jan 1970 00:00:00 GMT') == 0
+    assert rate_limit.parse_retry_after('soon', 2.0) == 2.0
+    assert 3 <= rate_limit.backoff_delay(0, retry_after=3) <= 4
+
+    budget = rate_limit.RetryBudget(ratio=0.5, min_retries=1)
+    assert budget.try_spend()
+    assert not budget.try_spend()
+    budget.record_request()
+    budget.record_request()
+    assert budget.try_spend()
+    print("✓ Retry-After parsing and retry budget work")
+
+
+def main():
+    """Run all tests"""
+    tests = [test_token_bucket, test_limiter_keys, test_retry_after_and_budget]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+        except AssertionError as e:
+            failed += 1
+            print(f"✗ {test.__name__} failed: {e}")
+    print(f"\nResults: {len(tests) - failed}/{len(tests)} tests passed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Test script for the shared Redis song store, run against a small in-process Redis stand-in
+"""
+
+import sys
+import fnmatch
+import threading
+import socketserver
+
+import memory_cache
+import redis_store
+import song_store
+import stage_cache
+
+
+class FakeRedis(socketserver.ThreadingTCPServer):
+    """Just enough of the Redis protocol for RedisSongStore"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _FakeRedisHandler)
+        self.data = {}
+        self.commands = []
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"redis://127.0.0.1:{self.server_address[1]}/0"
+
+
+class _FakeRedisHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = []
+            for _ in range(int(line[1:-2])):
+                length = int(self.rfile.readline()[1:-2])
+                args.append(self.rfile.read(length + 2)[:-2])
+            self.wfile.write(self.run(args))
+
+    def run(self, args):
+        server = self.server
+        command = args[0].decode().upper()
+        keys = [arg.decode('latin-1') for arg in args[1:]]
+        with server.lock:
+            server.commands.append(command)
+            data = server.data
+            if command in ('PING', 'AUTH', 'SELECT'):
+                return b'+OK\r\n'
+            if command == 'GET':
+                return _bulk(data.get(keys[0]))
+            if command == 'GETRANGE':
+                value = data.get(keys[0], b'')
+                return _bulk(value[int(keys[1]):int(keys[2]) + 1])
+            if command == 'SET':
+                data[keys[0]] = args[2]
+                return b'+OK\r\n'
+            if command == 'MSET':
+                for i in range(1, len(args), 2):
+                    data[args[i].decode('latin-1')] = args[i + 1]
+                return b'+OK\r\n'
+            if command == 'MGET':
+                return b'*%d\r\n' % len(keys) + b''.join(_bulk(data.get(key)) for key in keys)
+            if command == 'STRLEN':
+                return b':%d\r\n' % len(data.get(keys[0], b''))
+            if command in ('DEL', 'EXISTS'):
+                found = keys[0] in data
+                if command == 'DEL':
+                    data.pop(keys[0], None)
+                return b':%d\r\n' % found
+            if command == 'SCAN':
+                pattern = keys[2].replace('\\', '')
+                matches = [key.encode() for key in data if fnmatch.fnmatchcase(key, pattern)]
+                return b'*2\r\n' + _bulk(b'0') + b'*%d\r\n' % len(matches) + b''.join(_bulk(m) for m in matches)
+        return b'-ERR unknown command\r\n'
+
+
+def _bulk(value):
+    if value is None:
+        return b'$-1\r\n'
+    return b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+def _store(server):
+    return redis_store.RedisSongStore(redis_store.RespClient.from_url(server.url))
+
+
+def test_roundtrip():
+    """Records, headers, multi-get and key listing work over the wire"""
+    server = FakeRedis()
+    store = _store(server)
+    envelope = {'stage': 'lyrics', 'v': 1, 'at': 1.0, 'data': ['Bar one'] * 40}
+
+    store.put('lyrics:abc', envelope)
+    store.put_many({'nlu:abc': {'stage': 'nlu', 'v': 1, 'data': {}}, 'nlu:def': {'stage': 'nlu', 'v': 1, 'data': {}}})
+    assert store.get('lyrics:abc') == envelope
+    assert store.get('missing') is None
+    assert store.get_header('lyrics:abc') == {'stage': 'lyrics', 'v': 1, 'at': 1.0}
+    assert set(store.get_many(['nlu:abc', 'nlu:def', 'nlu:zzz'])) == {'nlu:abc', 'nlu:def'}
+    assert sorted(store.keys('nlu:')) == ['nlu:abc', 'nlu:def']
+    assert 'lyrics:abc' in store and len(store) == 3
+    usage = store.usage()
+    assert usage['nlu']['entries'] == 2 and usage['lyrics']['bytes'] > 0
+
+    store.delete('lyrics:abc')
+    assert 'lyrics:abc' not in store
+    store.close()
+    server.shutdown()
+    print("✓ Redis store round trip works")
+
+
+def test_shared_between_replicas():
+    """A song analyzed through one replica is a cache hit on another"""
+    server = FakeRedis()
+    replica_a = stage_cache.StageCache(song_store.CachedStore(_store(server), memory_cache.LRUCache()))
+    replica_b = stage_cache.StageCache(song_store.CachedStore(_store(server), memory_cache.LRUCache()))
+
+    replica_a.put(stage_cache.NLU, 'abc', {'averageEmotion': {'Joy': 1.0}})
+    calls = []
+    value = replica_b.get_or_fill(stage_cache.NLU, 'abc', lambda: calls.append(1))
+    assert value == {'averageEmotion': {'Joy': 1.0}}
+    assert not calls
+    server.shutdown()
+    print("✓ Replicas share analyses")
+
+
+def test_prefetch_is_pipelined():
+    """A group prefetch is a single MGET, later lookups come from memory"""
+    server = FakeRedis()
+    writer = stage_cache.StageCache(_store(server))
+    song_ids = [f"song{i}" for i in range(50)]
+    for song_id in song_ids:
+        writer.put(stage_cache.AUDIO_FEATURES, song_id, {'id': song_id})
+
+    reader = stage_cache.StageCache(song_store.CachedStore(_store(server), memory_cache.LRUCache()))
+    server.commands.clear()
+    assert reader.prefetch(song_ids, stages=(stage_cache.AUDIO_FEATURES,)) == 50
+    for song_id in song_ids:
+        assert reader.get(stage_cache.AUDIO_FEATURES, song_id) == {'id': song_id}
+    assert server.commands == ['MGET']
+    server.shutdown()
+    print("✓ Group prefetch is one pipelined round trip")
+
+
+def main():
+    """Run all tests"""
+    tests = [test_roundtrip, test_shared_between_replicas, test_prefetch_is_pipelined]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+        except AssertionError as e:
+            failed += 1
+            print(f"✗ {test.__name__} failed: {e}")
+    print(f"\nResults: {len(tests) - failed}/{len(tests)} tests passed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Test script for the song analysis store and the song_db.json migration
+"""
+
+import os
+import sys
+import json
+import sqlite3
+import tempfile
+import threading
+
+import record_codec
+import song_store
+
+
+def _sample(song_id):
+    return {'id': song_id, 'energy': 0.5, 'ai': {'lyrics': None, 'nlu': None}}
+
+
+def test_sqlite_roundtrip():
+    """Records come back exactly as stored and upserts replace them"""
+    with tempfile.TemporaryDirectory() as workdir:
+        store = song_store.SQLiteSongStore(os.path.join(workdir, 'songs.sqlite3'))
+        assert store.get('missing') is None
+
+        store.put('abc', _sample('abc'))
+        assert store.get('abc') == _sample('abc')
+        assert 'abc' in store and len(store) == 1
+
+        updated = _sample('abc')
+        updated['energy'] = 0.9
+        store.put('abc', updated)
+        assert store.get('abc')['energy'] == 0.9
+        assert len(store) == 1
+
+        store.delete('abc')
+        assert 'abc' not in store
+        store.close()
+    print("✓ SQLite store round trip works")
+
+
+def test_sqlite_close_all_threads():
+    """close() closes the connection of every thread that used the store"""
+    with tempfile.TemporaryDirectory() as workdir:
+        store = song_store.SQLiteSongStore(os.path.join(workdir, 'songs.sqlite3'))
+        threads = [threading.Thread(target=store.put, args=(f"song{n}", _sample(f"song{n}"))) for n in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        connections = list(store._connections)
+        assert len(connections) == 4
+        store.close()
+
+        for conn in connections:
+            try:
+                conn.execute('SELECT 1')
+                assert False, "expected a closed connection"
+            except sqlite3.ProgrammingError:
+                pass
+        # the store opens a new connection when used again
+        assert len(store) == 3
+        store.close()
+    print("✓ SQLite store closes every thread's connection")
+
+
+def test_json_store_persists():
+    """The json backend still writes a valid song_db.json"""
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'song_db.json')
+        store = song_store.JsonSongStore(path)
+        store.put('abc', _sample('abc'))
+
+        with open(path, 'r') as f:
+            assert json.load(f) == {'abc': _sample('abc')}
+        assert song_store.JsonSongStore(path).get('abc') == _sample('abc')
+    print("✓ JSON store persists records")
+
+
+def test_migration():
+    """migrate_song_db copies every song once, split into stages"""
+    with tempfile.TemporaryDirectory() as workdir:
+        json_path = os.path.join(workdir, 'song_db.json')
+        with open(json_path, 'w') as f:
+            json.dump({'a': _sample('a'), 'b': _sample('b')}, f)
+
+        store = song_store.SQLiteSongStore(os.path.join(workdir, 'songs.sqlite3'))
+        assert song_store.migrate_song_db(json_path, store) == 2
+        assert song_store.migrate_song_db(json_path, store) == 0
+        assert store.get('audio_features:b')['data'] == {'id': 'b', 'energy': 0.5}
+        store.close()
+    print("✓ song_db.json migration works")
+
+
+def test_write_behind_batches():
+    """Queued songs are readable right away and land on disk in a few batches"""
+    with tempfile.TemporaryDirectory() as workdir:
+        backing = song_store.SQLiteSongStore(os.path.join(workdir, 'songs.sqlite3'))
+        store = song_store.WriteBehindStore(backing, max_batch=500, flush_interval=3600)
+
+        store.put('abc', _sample('abc'))
+        assert store.get('abc') == _sample('abc')
+        assert backing.get('abc') is None
+
+        for i in range(1999):
+            store.put(f"song{i}", _sample(f"song{i}"))
+        store.close()
+
+        assert store.flushes == 4
+        assert len(song_store.SQLiteSongStore(os.path.join(workdir, 'songs.sqlite3'))) == 2000
+    print("✓ Write-behind store batches writes")
+
+
+def test_concurrent_writers():
+    """No result is lost when many threads finish songs at once"""
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'song_db.json')
+        store = song_store.WriteBehindStore(song_store.JsonSongStore(path), max_batch=7, flush_interval=0.01)
+
+        def writer(n):
+            for i in range(50):
+                store.put(f"{n}-{i}", _sample(f"{n}-{i}"))
+
+        threads = [threading.Thread(target=writer, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        store.close()
+
+        with open(path, 'r') as f:
+            assert len(json.load(f)) == 400
+    print("✓ Concurrent writers don't lose results")
+
+
+def test_delete_during_flush():
+    """A song deleted while its batch is being flushed stays deleted"""
+    with tempfile.TemporaryDirectory() as workdir:
+        backing = song_store.JsonSongStore(os.path.join(workdir, 'song_db.json'))
+        writing = threading.Event()
+        release = threading.Event()
+        put_many = backing.put_many
+
+        def slow_put_many(items):
+            writing.set()
+            release.wait(1)
+            put_many(items)
+
+        backing.put_many = slow_put_many
+        store = song_store.WriteBehindStore(backing, max_batch=500, flush_interval=3600)
+        store.put('abc', _sample('abc'))
+
+        flusher = threading.Thread(target=store.flush)
+        flusher.start()
+        writing.wait(1)
+        deleter = threading.Thread(target=store.delete, args=('abc',))
+        deleter.start()
+        release.set()
+        flusher.join()
+        deleter.join()
+
+        assert store.get('abc') is None and backing.get('abc') is None
+        store.close()
+    print("✓ Deletes are not undone by a running flush")
+
+
+def test_read_during_flush():
+    """Records stay readable while their batch is written and are kept when the write fails"""
+    with tempfile.TemporaryDirectory() as workdir:
+        backing = song_store.JsonSongStore(os.path.join(workdir, 'song_db.json'))
+        writing = threading.Event()
+        release = threading.Event()
+        put_many = backing.put_many
+        failing = [False]
+
+        def slow_put_many(items):
+            writing.set()
+            release.wait(1)
+            if failing[0]:
+                raise OSError("disk full")
+            put_many(items)
+
+        backing.put_many = slow_put_many
+        store = song_store.WriteBehindStore(backing, max_batch=500, flush_interval=3600)
+        for failing[0] in (True, False):
+            writing.clear()
+            release.clear()
+            store.put('abc', _sample('abc'))
+            flusher = threading.Thread(target=store.flush)
+            flusher.start()
+            writing.wait(1)
+            assert backing.get('abc') is None
+            assert store.get('abc') == _sample('abc')
+            assert store.get_many(['abc']) == {'abc': _sample('abc')}
+            assert store.get_header('abc') is not None
+            assert 'abc' in store and store.keys() == ['abc']
+            release.set()
+            flusher.join()
+            assert store.get('abc') == _sample('abc')
+
+        assert backing.get('abc') == _sample('abc') and store.pending() == 0
+        assert store.flushes == 1
+        store.close()
+    print("✓ Songs are readable during a flush and survive a failed one")
+
+
+def test_record_codec():
+    """Encoded records round trip, headers read without the payload, old json rows still load"""
+    envelope = {'stage': 'lyrics', 'v': 1, 'at': 1.5, 'data': ['Bar one here'] * 50}
+    blob = record_codec.encode(envelope)
+    assert len(blob) < len(json.dumps(envelope))
+    assert record_codec.decode(blob) == envelope
+    assert record_codec.decode_header(blob) == {'stage': 'lyrics', 'v': 1, 'at': 1.5}
+    assert record_codec.decode(record_codec.encode(_sample('abc'))) == _sample('abc')
+    assert record_codec.decode(json.dumps(_sample('abc'))) == _sample('abc')
+
+    with tempfile.TemporaryDirectory() as workdir:
+        store = song_store.SQLiteSongStore(os.path.join(workdir, 'songs.sqlite3'))
+        store.put('lyrics:abc', envelope)
+        assert store.get('lyrics:abc') == envelope
+        assert store.get_header('lyrics:abc')['v'] == 1
+        store.close()
+    print("✓ Record codec round trips")
+
+
+def main():
+    """Run all tests"""
+    tests = [
+        test_sqlite_roundtrip,
+        test_sqlite_close_all_threads,
+        test_json_store_persists,
+        test_migration,
+        test_write_behind_batches,
+        test_concurrent_writers,
+        test_delete_during_flush,
+        test_read_during_flush,
+        test_record_codec,
+    ]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+        except AssertionError as e:
+            failed += 1
+            print(f"✗ {test.__name__} failed: {e}")
+    print(f"\nResults: {len(tests) - failed}/{len(tests)} tests passed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Test script for the Spotify request layer
+"""
+
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import memory_cache
+import spotify_api
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    replies = []
+    pages = None  # {(path, offset): body} answers by request instead of in order
+    queries = []
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with self.lock:
+            if self.pages is not None:
+                url = urlsplit(self.path)
+                query = parse_qs(url.query)
+                self.queries.append(query)
+                status, headers, body = 200, {}, self.pages[(url.path, int(query['offset'][0]))]
+            else:
+                status, headers, body = self.replies.pop(0)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _server():
+    _Handler.pages = None
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def test_get_many():
+    """Multi-id calls are chunked, unknown ids map to None and failed chunks are left out"""
+    server, url = _server()
+    url += '/tracks'
+
+    _Handler.replies = [
+        (200, {}, b'{"tracks": [{"id": "a"}, null]}'),
+        (404, {}, b'{"error": {"status": 404}}'),
+        (200, {}, b'{"tracks": [{"id": "e"}]}'),
+    ]
+    found = spotify_api.get_many('token', url, ['a', 'b', 'c', 'd', 'e', 'a'], 2, 'tracks')
+    assert found == {'a': {'id': 'a'}, 'b': None, 'e': {'id': 'e'}}
+    assert not _Handler.replies
+    server.shutdown()
+    print("✓ Multi-id lookups are chunked")
+
+
+def test_all_pages():
+    """Remaining pages are fetched from the first page's total and come back in offset order"""
+    server, url = _server()
+    total = 230
+    _Handler.pages = {
+        ('/v1/me/tracks', offset): json.dumps({'total': total, 'items': list(range(offset, min(offset + 50, total)))}).encode()
+        for offset in range(0, total, 50)
+    }
+    pages = spotify_api.get_all_pages('token', url + '/me/tracks', workers=4)
+    assert len(pages) == 5
+    assert [item for page in pages for item in page['items']] == list(range(total))
+    server.shutdown()
+    print("✓ Pages are fetched concurrently and kept in order")
+
+
+def test_pages_across_urls():
+    """Pages of several playlists in one pool, with the fields projection, in the order asked for"""
+    server, url = _server()
+    _Handler.queries = []
+    _Handler.pages = {
+        ('/v1/playlists/a/tracks', 0): b'{"items": ["a0"]}',
+        ('/v1/playlists/a/tracks', 100): b'{"items": ["a100"]}',
+        ('/v1/playlists/b/tracks', 0): b'{"items": ["b0"]}',
+    }
+    wanted = [(url + '/playlists/a/tracks', 0), (url + '/playlists/b/tracks', 0), (url + '/playlists/a/tracks', 100)]
+    pages = spotify_api.get_pages('token', wanted, limit=100, params={'fields': spotify_api.PLAYLIST_TRACK_FIELDS})
+    assert [page['items'] for page in pages] == [['a0'], ['b0'], ['a100']]
+    assert all(query['fields'] == [spotify_api.PLAYLIST_TRACK_FIELDS] for query in _Handler.queries)
+    assert all(query['limit'] == ['100'] for query in _Handler.queries)
+    server.shutdown()
+    print("✓ Pages of many playlists are fetched together")
+
+
+def test_artist_resolver():
+    """Repeated artists cost one batched call, after that they come from the shared cache"""
+    server, url = _server()
+    spotify_api_url, spotify_api.API_URL = spotify_api.API_URL, url
+    _Handler.replies = [(200, {}, json.dumps({'artists': [
+        {'id': 'x', 'name': 'X', 'images': [{'url': 'big'}, {'url': 'small'}], 'genres': ['pop']},
+        None,
+    ]}).encode())]
+    resolver = spotify_api.ArtistResolver(memory_cache.LRUCache(ttl=60))
+
+    thumbnails = resolver.thumbnails('token', ['x', 'x', 'gone', 'x', None], '/fallback')
+    assert thumbnails == {'x': 'small', 'gone': '/fallback'}
+    assert not _Handler.replies
+    assert resolver.resolve('user-b-token', ['x'])['x']['genres'] == ['pop']
+    assert resolver.fetched == 2
+    spotify_api.API_URL = spotify_api_url
+    server.shutdown()
+    print("✓ Artists are resolved in batches and cached")
+
+
+def test_429_retried():
+    """A 429 is waited out and retried, one that keeps asking for too long raises RateLimited"""
+    server, url = _server()
+    url += '/tracks/abc'
+
+    _Handler.replies = [(429, {'Retry-After': '0'}, b''), (503, {}, b''), (200, {}, b'{"id": "abc"}')]
+    response = spotify_api.get('token', url)
+    assert response.status_code == 200 and response.json() == {'id': 'abc'}
+
+    _Handler.replies = [(429, {'Retry-After': '3600'}, b'')]
+    try:
+        spotify_api.get('token', url)
+        assert False, "expected RateLimited"
+    except spotify_api.RateLimited as e:
+        assert e.retry_after == 3600
+    server.shutdown()
+    print("✓ Spotify 429s are retried within limits")
+
+
+def main():
+    """Run all tests"""
+    # the 429 test holds the shared limiter for a minute afterwards, so it goes last
+    tests = [test_get_many, test_all_pages, test_pages_across_urls, test_artist_resolver, test_429_retried]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+        except AssertionError as e:
+            failed += 1
+            print(f"✗ {test.__name__} failed: {e}")
+    print(f"\nResults: {len(tests) - failed}/{len(tests)} tests passed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
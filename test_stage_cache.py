@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Test script for the per-stage song cache
+"""
+
+import sys
+import threading
+import time
+
+import stage_cache
+
+
+class DictStore(dict):
+    """Bare in-memory stand-in for a song store"""
+
+    def put(self, key, record):
+        self[key] = record
+
+    def put_many(self, items):
+        self.update(items)
+
+
+def test_stage_reuse():
+    """A cached stage is not filled again"""
+    stages = stage_cache.StageCache(DictStore())
+    calls = []
+
+    def fill():
+        calls.append(1)
+        return {'name': 'Song'}
+
+    assert stages.get_or_fill(stage_cache.TRACK, 'abc', fill) == {'name': 'Song'}
+    assert stages.get_or_fill(stage_cache.TRACK, 'abc', fill) == {'name': 'Song'}
+    assert len(calls) == 1
+    print("✓ Cached stages are reused")
+
+
+def test_failed_stage_retried():
+    """Only the stage that failed runs again, stages before it stay cached"""
+    stages = stage_cache.StageCache(DictStore())
+    stages.put(stage_cache.LYRICS, 'abc', ['bar one', 'bar two'])
+
+    assert stages.get_or_fill(stage_cache.NLU, 'abc', lambda: None) is None
+    assert stages.get(stage_cache.NLU, 'abc') is None
+    assert stages.get_or_fill(stage_cache.NLU, 'abc', lambda: {'averageEmotion': {}}) == {'averageEmotion': {}}
+    assert stages.get(stage_cache.LYRICS, 'abc') == ['bar one', 'bar two']
+    print("✓ Failed stages are retried on their own")
+
+
+def test_negative_results():
+    """Dead ends are skipped until their TTL runs out, and counted per reason"""
+    stages = stage_cache.StageCache(DictStore(), negative_ttls={stage_cache.WATSON_ERROR: 0.01})
+    calls = []
+
+    def no_hit():
+        calls.append(1)
+        return stage_cache.Negative(stage_cache.NO_HIT)
+
+    assert stages.get_or_fill(stage_cache.GENIUS_URL, 'abc', no_hit) is None
+    assert stages.get_or_fill(stage_cache.GENIUS_URL, 'abc', no_hit) is None
+    assert len(calls) == 1
+    assert stages.negative_reason(stage_cache.GENIUS_URL, 'abc') == stage_cache.NO_HIT
+
+    stages.get_or_fill(stage_cache.NLU, 'abc', lambda: stage_cache.Negative(stage_cache.WATSON_ERROR))
+    time.sleep(0.02)
+    assert stages.get_or_fill(stage_cache.NLU, 'abc', lambda: {'averageEmotion': {}}) == {'averageEmotion': {}}
+
+    stats = stages.negative_stats()
+    assert stats[stage_cache.NO_HIT] == {'skipped': 1, 'stored': 1}
+    assert stats[stage_cache.WATSON_ERROR] == {'skipped': 0, 'stored': 1}
+    print("✓ Negative results are cached with a TTL")
+
+
+def test_version_bump():
+    """Bumping a stage version invalidates that stage and the stages derived from it"""
+    store = DictStore()
+    stages = stage_cache.StageCache(store)
+    stages.put(stage_cache.LYRICS, 'abc', ['bar'])
+    stages.put(stage_cache.WATSON, 'abc', {'sentiment': 'positive'})
+    stages.put(stage_cache.NLU, 'abc', {'averageEmotion': {}})
+
+    bumped = stage_cache.StageCache(store, versions={stage_cache.NLU: 2})
+    assert bumped.get(stage_cache.NLU, 'abc') is None
+    assert bumped.get(stage_cache.WATSON, 'abc') == {'sentiment': 'positive'}
+    assert bumped.stale[stage_cache.NLU] == 1
+
+    # an nlu entry made from old lyrics is still nlu version 1, but derived from outdated lyrics
+    relyric = stage_cache.StageCache(store, versions={stage_cache.LYRICS: 2})
+    entry = store[stage_cache.stage_key(stage_cache.NLU, 'abc')]
+    assert relyric.is_current(entry)
+    assert not relyric.is_derived_from_current(entry)
+    assert relyric.get(stage_cache.NLU, 'abc') is None
+
+    # a new watson version misses the nlu made from the old model, so watson runs again
+    rewatson = stage_cache.StageCache(store, versions={stage_cache.WATSON: 2})
+    calls = []
+
+    def watson():
+        calls.append(1)
+        return {'sentiment': 'negative'}
+
+    assert rewatson.lookup(stage_cache.NLU, 'abc') == (False, None)
+    assert rewatson.get_or_fill(stage_cache.WATSON, 'abc', watson) == {'sentiment': 'negative'}
+    assert len(calls) == 1 and rewatson.stale[stage_cache.NLU] == 1
+    assert rewatson.get(stage_cache.LYRICS, 'abc') == ['bar']
+    print("✓ Version bumps invalidate their stage and what was derived from it")
+
+
+def test_fill_many():
+    """One batch call fills only the songs the stage is missing"""
+    stages = stage_cache.StageCache(DictStore())
+    stages.put(stage_cache.TRACK, 'a', {'name': 'Cached'})
+    calls = []
+
+    def fill_many(ids):
+        calls.append(ids)
+        return {song_id: ({'name': song_id} if song_id != 'c' else None) for song_id in ids}
+
+    assert stages.fill_many(stage_cache.TRACK, ['a', 'b', 'c', 'b'], fill_many) == 1
+    assert calls == [['b', 'c']]
+    assert stages.get(stage_cache.TRACK, 'a') == {'name': 'Cached'}
+    assert stages.get(stage_cache.TRACK, 'b') == {'name': 'b'}
+    assert stages.get(stage_cache.TRACK, 'c') is None
+    assert stages.fill_many(stage_cache.TRACK, ['a', 'b'], fill_many) == 0 and len(calls) == 1
+    print("✓ Batch fills skip cached songs")
+
+
+def test_coalesced_fill():
+    """Concurrent misses for one song share a single fill, its exception included"""
+    stages = stage_cache.StageCache(DictStore())
+    calls = []
+    release = threading.Event()
+    results = []
+
+    def fill():
+        calls.append(1)
+        release.wait(1)
+        return ['bar one', 'bar two', 'bar three', 'bar four']
+
+    threads = [threading.Thread(target=lambda: results.append(stages.get_or_fill(stage_cache.LYRICS, 'x', fill))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    while stages.flights.stats()['coalesced'] < 4:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1 and len(results) == 5 and all(result == results[0] for result in results)
+    metrics = stages.metrics.snapshot()['stages'][stage_cache.LYRICS]
+    assert metrics['fills'] == 1 and metrics['coalesced'] == 4 and metrics['coalesce_ratio'] == 0.8
+
+    errors = []
+    release.clear()
+
+    def failing():
+        release.wait(1)
+        raise ValueError("genius down")
+
+    def call():
+        try:
+            stages.get_or_fill(stage_cache.GENIUS_URL, 'y', failing)
+        except ValueError as e:
+            errors.append(str(e))
+
+    threads = [threading.Thread(target=call) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    while stages.flights.stats()['coalesced'] < 6:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert errors == ["genius down"] * 3
+    assert stages.flights.stats()['in_flight'] == 0
+    assert stages.get_or_fill(stage_cache.GENIUS_URL, 'y', lambda: 'https://genius.com/y') == 'https://genius.com/y'
+
+    # another caller's fill lands between our miss and taking the lead: nothing is paid for twice
+    lookup = stages.lookup
+
+    def late_lookup(stage, song_id):
+        found = lookup(stage, song_id)
+        stages.put(stage, song_id, ['bar one'])
+        return found
+
+    stages.lookup = late_lookup
+    calls.clear()
+    assert stages.get_or_fill(stage_cache.LYRICS, 'z', fill) == ['bar one']
+    assert calls == []
+    print("✓ Concurrent misses are coalesced")
+
+
+def main():
+    """Run all tests"""
+    tests = [test_stage_reuse, test_failed_stage_retried, test_negative_results, test_version_bump, test_fill_many,
+             test_coalesced_fill]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+        except AssertionError as e:
+            failed += 1
+            print(f"✗ {test.__name__} failed: {e}")
+    print(f"\nResults: {len(tests) - failed}/{len(tests)} tests passed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
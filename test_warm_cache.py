@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Test script for the cache warmer
+"""
+
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+
+import warm_cache
+
+
+class FakeApp:
+    """The parts of musicAI warm_cache.py uses: stored tokens, the library and the song analysis"""
+
+    def __init__(self, liked=(), albums=None, playlists=None):
+        self.liked = list(liked)
+        self.albums = albums or {}
+        self.playlists = playlists or {}
+        self.stored = {'alice': {'spotify_token': 'tok1'}}
+        self.tokens = ['tok1']       # what fresh_spotify_token hands out, the last one once the rest are used
+        self.analyzed = []           # (token, song id) per analysis
+        self.prefetched = []
+        self.interrupt = set()       # song ids that stop the run (Ctrl-C)
+        self.broken = set()
+        self._lock = threading.Lock()
+
+    def load_user_token(self, user_id):
+        return self.stored.get(user_id, {})
+
+    def fresh_spotify_token(self, user_id):
+        with self._lock:
+            if user_id not in self.stored:
+                return None
+            return self.tokens.pop(0) if len(self.tokens) > 1 else self.tokens[0]
+
+    def user_likes(self, token, user_id):
+        return self.liked
+
+    def user_albums(self, token, user_id):
+        return self.albums
+
+    def user_playlists(self, token, user_id):
+        return self.playlists
+
+    def _prefetch_spotify_stages(self, token, song_ids):
+        self.prefetched.append(list(song_ids))
+
+    def _song_analysis_details(self, token, song_id, save, name, artist):
+        if song_id in self.interrupt:
+            raise KeyboardInterrupt
+        with self._lock:
+            self.analyzed.append((token, song_id))
+        if song_id in self.broken:
+            return None
+        return {'id': song_id, 'song_title': name, 'artist_name': artist}
+
+
+def _liked(*song_ids):
+    return [{'id': song_id, 'name': f"song {song_id}", 'artists': [f"artist {song_id}"]} for song_id in song_ids]
+
+
+@contextlib.contextmanager
+def _progress_file():
+    """warm_cache_progress.json in a temporary directory"""
+    with tempfile.TemporaryDirectory() as directory:
+        path, warm_cache.PROGRESS_FILE = warm_cache.PROGRESS_FILE, os.path.join(directory, 'warm_cache_progress.json')
+        try:
+            yield warm_cache.PROGRESS_FILE
+        finally:
+            warm_cache.PROGRESS_FILE = path
+
+
+def _quiet(func, *args):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return func(*args)
+
+
+def test_library_dedup():
+    """Songs in several parts of the library are warmed once, songs without an id or artist are skipped"""
+    app = FakeApp(
+        liked=_liked('a', 'b') + [{'id': None, 'name': 'local file', 'artists': ['x']}],
+        albums={0: {'songs': [('b', 'song b', ['artist b']), ('c', 'song c', ['artist c'])]}},
+        playlists={0: {'songs': [('c', 'song c', ['artist c']), ('d', 'song d', []), ('e', 'song e', ['artist e', 'feat'])]}},
+    )
+    songs = _quiet(warm_cache.collect_library, app, 'tok1', warm_cache.SOURCES, 'alice')
+    assert songs == [('a', 'song a', 'artist a'), ('b', 'song b', 'artist b'),
+                     ('c', 'song c', 'artist c'), ('e', 'song e', 'artist e')]
+    assert [song[0] for song in _quiet(warm_cache.collect_library, app, 'tok1', ['albums'], 'alice')] == ['b', 'c']
+    print("✓ Library songs are collected once")
+
+
+def test_resume_after_interrupt():
+    """An interrupted run saves its progress, the next one only analyzes what is left"""
+    with _progress_file() as path:
+        app = FakeApp(liked=_liked('s1', 's2', 's3', 's4', 's5'))
+        keeper = warm_cache.TokenKeeper(app, 'alice')
+        songs = _quiet(warm_cache.collect_library, app, keeper.token(), ['liked'], 'alice')
+        app.interrupt.add('s3')
+        try:
+            _quiet(warm_cache.warm, app, keeper, songs, warm_cache.load_progress('alice'), 1, 'alice')
+            assert False, "expected KeyboardInterrupt"
+        except KeyboardInterrupt:
+            pass
+        assert warm_cache.load_progress('alice') == {'s1', 's2'}
+        with open(path) as f:
+            assert json.load(f) == {'alice': ['s1', 's2']}
+
+        app.interrupt.clear()
+        app.analyzed.clear()
+        app.broken.add('s5')
+        failed = _quiet(warm_cache.warm, app, keeper, songs, warm_cache.load_progress('alice'), 2, 'alice')
+        assert failed == 1
+        assert sorted(song_id for _, song_id in app.analyzed) == ['s3', 's4', 's5']
+        assert app.prefetched[-1] == ['s3', 's4', 's5']
+        # the song that could not be analyzed is tried again next time, other users' progress is kept apart
+        assert warm_cache.load_progress('alice') == {'s1', 's2', 's3', 's4'}
+        assert warm_cache.load_progress('bob') == set()
+
+        app.analyzed.clear()
+        app.broken.clear()
+        assert _quiet(warm_cache.warm, app, keeper, songs, warm_cache.load_progress('alice'), 2, 'alice') == 0
+        assert app.analyzed == [('tok1', 's5')]
+        assert _quiet(warm_cache.warm, app, keeper, songs, warm_cache.load_progress('alice'), 2, 'alice') == 0
+        assert app.analyzed == [('tok1', 's5')]
+    print("✓ Interrupted runs resume from the progress file")
+
+
+def test_token_refresh():
+    """Every song asks for a fresh token, so a token refreshed mid-run is picked up, users without one are refused"""
+    with _progress_file():
+        app = FakeApp(liked=_liked('s1', 's2', 's3'))
+        keeper = warm_cache.TokenKeeper(app, 'alice')
+        app.tokens = ['tok1', 'tok1', 'tok2']
+        songs = _quiet(warm_cache.collect_library, app, 'tok1', ['liked'], 'alice')
+        assert _quiet(warm_cache.warm, app, keeper, songs, set(), 1, 'alice') == 0
+        # one token for the prefetch, then one per song: the run switches to the refreshed token
+        assert [token for token, _ in app.analyzed] == ['tok1', 'tok2', 'tok2']
+
+        try:
+            warm_cache.TokenKeeper(app, 'bob')
+            assert False, "expected ValueError"
+        except ValueError as e:
+            assert 'log in' in str(e)
+        app.stored['carol'] = {'spotify_token': 'old'}
+        keeper = warm_cache.TokenKeeper(app, 'carol')
+        del app.stored['carol']
+        try:
+            keeper.token()
+            assert False, "expected ValueError"
+        except ValueError as e:
+            assert 'carol' in str(e)
+    print("✓ Tokens are refreshed during a run")
+
+
+def main():
+    """Run all tests"""
+    tests = [test_library_dedup, test_resume_after_interrupt, test_token_refresh]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+        except AssertionError as e:
+            failed += 1
+            print(f"✗ {test.__name__} failed: {e}")
+    print(f"\nResults: {len(tests) - failed}/{len(tests)} tests passed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
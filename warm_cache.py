@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Cache warmer for MusicAI
+Pre-analyzes a stored user's liked songs, saved albums and playlists so the
+group analysis routes come straight back from cache.
+
+Usage: python warm_cache.py <user_id> [--workers 4] [--sources liked,albums,playlists]
+Interrupted runs pick up where they stopped (progress in warm_cache_progress.json).
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+PROGRESS_FILE = 'warm_cache_progress.json'
+SOURCES = ('liked', 'albums', 'playlists')
+
+# save progress every this many songs
+CHECKPOINT_EVERY = 25
+
+
+class TokenKeeper:
+    """Hands out a valid Spotify token for a stored user, refreshed by app.fresh_spotify_token when it runs out"""
+
+    def __init__(self, app, user_id):
+        self.app = app
+        self.user_id = user_id
+        if not app.load_user_token(user_id):
+            raise ValueError(f"no stored tokens for user {user_id}, log in through the app first")
+
+    def token(self):
+        token = self.app.fresh_spotify_token(self.user_id)
+        if not token:
+            raise ValueError(f"could not refresh the Spotify token for {self.user_id}")
+        return token
+
+
+def load_progress(user_id):
+    if not os.path.exists(PROGRESS_FILE):
+        return set()
+    try:
+        with open(PROGRESS_FILE, 'r') as f:
+            return set(json.load(f).get(user_id, []))
+    except (OSError, json.JSONDecodeError):
+        return set()
+
+
+def save_progress(user_id, done):
+    progress = {}
+    if os.path.exists(PROGRESS_FILE):
+        try:
+            with open(PROGRESS_FILE, 'r') as f:
+                progress = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            progress = {}
+    progress[user_id] = sorted(done)
+
+    tmp_path = f"{PROGRESS_FILE}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(progress, f)
+    os.replace(tmp_path, PROGRESS_FILE)
+
+
+def collect_library(app, token, sources, user_id):
+    """Unique (id, name, main artist) for every song in the chosen parts of the library"""
+    songs = {}
+
+    if 'liked' in sources:
+        for song in app.user_likes(token, user_id):
+            if song['id'] and song['artists']:
+                songs.setdefault(song['id'], (song['id'], song['name'], song['artists'][0]))
+        print(f"   liked songs: {len(songs)} unique so far")
+
+    groups = []
+    if 'albums' in sources:
+        groups.append(('albums', app.user_albums(token, user_id)))
+    if 'playlists' in sources:
+        groups.append(('playlists', app.user_playlists(token, user_id)))
+    for label, group in groups:
+        for entry in group.values():
+            for song_id, name, artists in entry['songs']:
+                if song_id and artists:
+                    songs.setdefault(song_id, (song_id, name, artists[0]))
+        print(f"   {label}: {len(songs)} unique so far")
+
+    return list(songs.values())
+
+
+def warm(app, keeper, songs, done, workers, user_id):
+    todo = [song for song in songs if song[0] not in done]
+    print(f"🎵 {len(songs)} songs in library, {len(songs) - len(todo)} already warm, {len(todo)} to go")
+    if not todo:
+        return 0
+
+    # track + audio features for every song in a few multi-id calls instead of two calls per song
+    app._prefetch_spotify_stages(keeper.token(), [song[0] for song in todo])
+
+    started = time.time()
+    finished = 0
+    failed = 0
+
+    def analyze(song):
+        song_id, name, artist = song
+        return app._song_analysis_details(keeper.token(), song_id, False, name, artist)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(analyze, song): song for song in todo}
+        try:
+            for future in as_completed(futures):
+                song = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = None
+                    print(f"❌ {song[1]} by {song[2]}: {e}")
+
+                finished += 1
+                if result is None:
+                    failed += 1
+                else:
+                    done.add(song[0])
+
+                if finished % CHECKPOINT_EVERY == 0 or finished == len(todo):
+                    save_progress(user_id, done)
+                    elapsed = time.time() - started
+                    rate = finished / elapsed if elapsed else 0.0
+                    eta = (len(todo) - finished) / rate if rate else 0.0
+                    print(f"   {finished}/{len(todo)} songs | {rate:.2f} songs/s | ETA {eta / 60:.1f} min | {failed} failed")
+        except KeyboardInterrupt:
+            print("\n⏸  Interrupted, saving progress (run again to resume)...")
+            for future in futures:
+                future.cancel()
+            save_progress(user_id, done)
+            raise
+
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-analyze a stored user's library into the song cache")
+    parser.add_argument('user_id', help="user id as stored in user_tokens.json")
+    parser.add_argument('--workers', type=int, default=4, help="songs analyzed at the same time (default 4)")
+    parser.add_argument('--sources', default=','.join(SOURCES), help="comma separated: liked,albums,playlists")
+    args = parser.parse_args()
+
+    sources = [source.strip() for source in args.sources.split(',') if source.strip()]
+    unknown = set(sources) - set(SOURCES)
+    if unknown:
+        print(f"❌ Unknown source(s): {', '.join(sorted(unknown))}")
+        return 1
+
+    # the web app module holds the analysis pipeline, it only starts the server when run directly
+    import musicAI
+
+    try:
+        keeper = TokenKeeper(musicAI, args.user_id)
+        print(f"📚 Reading library for {args.user_id} ({', '.join(sources)})...")
+        songs = collect_library(musicAI, keeper.token(), sources, args.user_id)
+        failed = warm(musicAI, keeper, songs, load_progress(args.user_id), max(1, args.workers), args.user_id)
+    except ValueError as e:
+        print(f"❌ {e}")
+        return 1
+    except KeyboardInterrupt:
+        return 130
+    finally:
+        # flush queued results to the store
+        musicAI.song_db.close()
+
+    print(f"✅ Cache warm for {args.user_id}" + (f" ({failed} song(s) could not be analyzed)" if failed else ""))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -38,6 +38,8 @@ def login():
       authenticator=authenticator)
   natural_language_understanding.set_service_url(url)
   return natural_language_understanding
+# NOTE: changing the features below or ai_to_Text's cleaning means bumping
+# stage_cache.STAGE_VERSIONS['watson'] so cached watson output is refreshed
 def analyzeText(client, text):
   # Analyze Text
   response = client.analyze(
@@ -113,6 +115,8 @@ def ai_to_Text(message):
 
 
 # calculations of arr with ai outputs *** USING ai_to_Text ***
+# NOTE: bump stage_cache.STAGE_VERSIONS['nlu'] when changing this, then run recompute_stages.py
+# to rebuild cached averages from stored watson output (no watson calls)
 def averages_calc( text_Models ):
   # NOTE: TEXT MODEL ITEM KEYS
   # dict_keys   ['overall_emotion', 'relations', 'subjects', 'entities', 'keywords', 'concepts']
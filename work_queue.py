@@ -0,0 +1,411 @@
+"""
+Durable work queue for MusicAI
+Jobs and their tasks are kept in a local SQLite file (WAL mode), so queued and half-finished work survives a
+restart and can be shared by the web app and any number of worker processes on the same disk.
+A worker leases tasks for a visibility timeout; a task whose lease runs out (worker died, container restarted)
+becomes available again. Failed tasks, and tasks whose lease ran out, are retried with backoff until they run
+out of attempts.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import rate_limit
+
+WORK_QUEUE_FILE = 'work_queue.db'
+
+# job states
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# task states (DONE / FAILED as above)
+PENDING = 'pending'
+LEASED = 'leased'
+
+# seconds a leased task stays with its worker before others may take it
+VISIBILITY_TIMEOUT = float(os.getenv('WORK_QUEUE_VISIBILITY_SECONDS', '300'))
+MAX_ATTEMPTS = int(os.getenv('WORK_QUEUE_MAX_ATTEMPTS', '5'))
+# retry delay, full jitter between 0 and min(RETRY_CAP, RETRY_BASE * 2 ** attempt)
+RETRY_BASE = 2.0
+RETRY_CAP = 300.0
+# published worker metrics older than this are from workers that are gone
+WORKER_METRICS_MAX_AGE = 900.0
+
+
+class WorkQueue:
+    """Thread and process safe, every call is its own transaction"""
+
+    def __init__(self, path=WORK_QUEUE_FILE, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            ' id TEXT PRIMARY KEY,'
+            ' owner TEXT NOT NULL,'
+            ' kind TEXT NOT NULL,'
+            ' params TEXT NOT NULL,'
+            ' status TEXT NOT NULL,'
+            ' error TEXT,'
+            ' result TEXT,'
+            ' created_at REAL NOT NULL,'
+            ' started_at REAL,'
+            ' finished_at REAL);'
+            'CREATE TABLE IF NOT EXISTS tasks ('
+            ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            ' job_id TEXT NOT NULL,'
+            ' kind TEXT NOT NULL,'
+            ' payload TEXT NOT NULL,'
+            ' status TEXT NOT NULL,'
+            ' attempts INTEGER NOT NULL DEFAULT 0,'
+            ' available_at REAL NOT NULL,'
+            ' leased_until REAL,'
+            ' worker TEXT,'
+            ' error TEXT,'
+            ' result TEXT,'
+            ' detail TEXT,'
+            ' seq INTEGER);'
+            'CREATE TABLE IF NOT EXISTS metrics ('
+            ' worker TEXT PRIMARY KEY,'
+            ' snapshot TEXT NOT NULL,'
+            ' updated_at REAL NOT NULL);'
+            'CREATE INDEX IF NOT EXISTS tasks_ready ON tasks (status, available_at);'
+            'CREATE INDEX IF NOT EXISTS tasks_job ON tasks (job_id, kind, status);'
+            'CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (owner, kind, status);'
+        )
+        self._add_columns(('detail', 'TEXT'), ('seq', 'INTEGER'))
+        conn.execute('CREATE INDEX IF NOT EXISTS tasks_finished ON tasks (job_id, kind, seq)')
+
+    def _add_columns(self, *columns):
+        # queue files from before a column existed get it added, under the write lock in case two processes start at once
+        with self._write() as conn:
+            existing = {row['name'] for row in conn.execute('PRAGMA table_info(tasks)')}
+            for name, kind in columns:
+                if name not in existing:
+                    conn.execute(f'ALTER TABLE tasks ADD COLUMN {name} {kind}')
+
+    def _conn(self):
+        # one connection per thread, like song_store.SQLiteSongStore
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _write(self):
+        """Transaction that takes the write lock up front, so two workers never lease the same task"""
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        return _Transaction(conn)
+
+    # jobs
+
+    def create_job(self, owner, kind, params, tasks=()):
+        """New job with its first tasks [(kind, payload)], returns the job id"""
+        job_id = uuid.uuid4().hex
+        with self._write() as conn:
+            conn.execute(
+                'INSERT INTO jobs (id, owner, kind, params, status, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (job_id, owner, kind, json.dumps(params), QUEUED, time.time())
+            )
+            self._insert_tasks(conn, job_id, tasks)
+        return job_id
+
+    def active_job(self, owner, kind):
+        """Id of the owner's queued or running job of this kind, if any"""
+        row = self._conn().execute(
+            'SELECT id FROM jobs WHERE owner = ? AND kind = ? AND status IN (?, ?) ORDER BY created_at LIMIT 1',
+            (owner, kind, QUEUED, RUNNING)
+        ).fetchone()
+        return row['id'] if row else None
+
+    def job(self, job_id):
+        row = self._conn().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['params'] = json.loads(job['params'])
+        job['result'] = json.loads(job['result']) if job['result'] is not None else None
+        return job
+
+    def queued_before(self, job_id):
+        """Queued jobs ahead of this one, plus one (its place in line)"""
+        return self._conn().execute(
+            'SELECT COUNT(*) FROM jobs WHERE status = ? AND created_at <= (SELECT created_at FROM jobs WHERE id = ?)',
+            (QUEUED, job_id)
+        ).fetchone()[0]
+
+    def finish_job(self, job_id, result):
+        with self._write() as conn:
+            conn.execute(
+                'UPDATE jobs SET status = ?, result = ?, finished_at = ? WHERE id = ?',
+                (DONE, json.dumps(result), time.time(), job_id)
+            )
+
+    def fail_job(self, job_id, error):
+        """Mark the job failed, its unfinished tasks are dropped"""
+        now = time.time()
+        with self._write() as conn:
+            conn.execute('UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?', (FAILED, error, now, job_id))
+            conn.execute(
+                'UPDATE tasks SET status = ?, error = ? WHERE job_id = ? AND status IN (?, ?)',
+                (FAILED, 'job failed', job_id, PENDING, LEASED)
+            )
+
+    def purge(self, before):
+        """Forget jobs (and their tasks) that finished before this time, returns how many"""
+        with self._write() as conn:
+            ids = [row['id'] for row in conn.execute(
+                'SELECT id FROM jobs WHERE status IN (?, ?) AND finished_at < ?', (DONE, FAILED, before)
+            )]
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                conn.execute(f'DELETE FROM tasks WHERE job_id IN ({placeholders})', chunk)
+                conn.execute(f'DELETE FROM jobs WHERE id IN ({placeholders})', chunk)
+        return len(ids)
+
+    # tasks
+
+    def add_tasks(self, job_id, tasks):
+        with self._write() as conn:
+            self._insert_tasks(conn, job_id, tasks)
+
+    @staticmethod
+    def _insert_tasks(conn, job_id, tasks):
+        now = time.time()
+        conn.executemany(
+            'INSERT INTO tasks (job_id, kind, payload, status, available_at) VALUES (?, ?, ?, ?, ?)',
+            [(job_id, kind, json.dumps(payload), PENDING, now) for kind, payload in tasks]
+        )
+
+    def lease(self, worker, limit=1, visibility=VISIBILITY_TIMEOUT):
+        """Up to `limit` tasks that are due, leased to the worker for `visibility` seconds
+
+        A task whose lease ran out (its worker died or hung on it) goes back with the same backoff as retry().
+        Once it has run out of attempts that way it is handed out with 'expired': True instead, for the worker
+        to give up on it through retry() (see analysis_jobs.Worker).
+        """
+        now = time.time()
+        with self._write() as conn:
+            expired = self._expire_leases(conn, now, limit)
+            rows = conn.execute(
+                'SELECT tasks.id, tasks.job_id, tasks.kind, tasks.payload, tasks.attempts FROM tasks'
+                ' JOIN jobs ON jobs.id = tasks.job_id'
+                ' WHERE jobs.status IN (?, ?) AND tasks.status = ? AND tasks.available_at <= ?'
+                ' ORDER BY tasks.id LIMIT ?',
+                (QUEUED, RUNNING, PENDING, now, limit - len(expired))
+            ).fetchall()
+            if not rows and not expired:
+                return []
+            conn.executemany(
+                'UPDATE tasks SET status = ?, worker = ?, leased_until = ?, attempts = attempts + 1 WHERE id = ?',
+                [(LEASED, worker, now + visibility, row['id']) for row in rows]
+            )
+            conn.executemany(
+                'UPDATE tasks SET worker = ?, leased_until = ? WHERE id = ?',
+                [(worker, now + visibility, row['id']) for row in expired]
+            )
+            conn.executemany(
+                'UPDATE jobs SET status = ?, started_at = ? WHERE id = ? AND status = ?',
+                [(RUNNING, now, job_id, QUEUED) for job_id in {row['job_id'] for row in rows}]
+            )
+        tasks = [
+            {'id': row['id'], 'job_id': row['job_id'], 'kind': row['kind'],
+             'payload': json.loads(row['payload']), 'attempts': row['attempts'], 'expired': True}
+            for row in expired
+        ]
+        tasks.extend(
+            {'id': row['id'], 'job_id': row['job_id'], 'kind': row['kind'],
+             'payload': json.loads(row['payload']), 'attempts': row['attempts'] + 1}
+            for row in rows
+        )
+        return tasks
+
+    def _expire_leases(self, conn, now, limit):
+        """Put tasks with a run out lease back with backoff, returns (up to limit) of those out of attempts"""
+        rows = conn.execute(
+            'SELECT tasks.id, tasks.job_id, tasks.kind, tasks.payload, tasks.attempts FROM tasks'
+            ' JOIN jobs ON jobs.id = tasks.job_id'
+            ' WHERE jobs.status IN (?, ?) AND tasks.status = ? AND tasks.leased_until < ?'
+            ' ORDER BY tasks.id',
+            (QUEUED, RUNNING, LEASED, now)
+        ).fetchall()
+        conn.executemany(
+            'UPDATE tasks SET status = ?, error = ?, available_at = ?, leased_until = NULL WHERE id = ?',
+            [(PENDING, 'lease ran out', now + rate_limit.backoff_delay(row['attempts'] - 1, base=RETRY_BASE, cap=RETRY_CAP),
+              row['id']) for row in rows if row['attempts'] < self.max_attempts]
+        )
+        return [row for row in rows if row['attempts'] >= self.max_attempts][:limit]
+
+    def extend(self, task_ids, worker, visibility=VISIBILITY_TIMEOUT):
+        """Keep leases alive while their tasks are still being worked on"""
+        task_ids = list(task_ids)
+        if not task_ids:
+            return
+        with self._write() as conn:
+            conn.executemany(
+                'UPDATE tasks SET leased_until = ? WHERE id = ? AND worker = ? AND status = ?',
+                [(time.time() + visibility, task_id, worker, LEASED) for task_id in task_ids]
+            )
+
+    def complete(self, task_id, result=None, then=None, detail=None, worker=None):
+        """Mark a task done, with a short result (counted by task_counts) and any JSON detail (read by finished)
+
+        then=(kind, payload) adds a follow-up task to the job once none of its tasks of this
+        task's kind are left unfinished (exactly once, however many workers finish at the same time).
+        With a worker, only a task still leased to it is finished: one whose lease ran out went back
+        to the queue and belongs to whoever leased it next. Returns True if the task was finished.
+        """
+        return self.complete_many([(task_id, result, detail)], then, worker) == 1
+
+    def complete_many(self, tasks, then=None, worker=None):
+        """complete() for many (task id, result, detail) in one transaction, returns how many were finished"""
+        finished = 0
+        with self._write() as conn:
+            for task_id, result, detail in tasks:
+                if self._finish_task(conn, task_id, DONE, worker, result=result, detail=detail):
+                    self._follow_up(conn, task_id, then)
+                    finished += 1
+        return finished
+
+    def retry(self, task_id, error, then=None, worker=None):
+        """Put a failed task back with backoff, or give up on it after max_attempts
+
+        Returns True if the task will be tried again. A task given up on counts as finished for `then` (see complete).
+        A task no longer leased to the worker is left as it is, it is someone else's to try now (True).
+        """
+        with self._write() as conn:
+            row = conn.execute('SELECT attempts, status, worker FROM tasks WHERE id = ?', (task_id,)).fetchone()
+            if row is None:
+                return False
+            if row['status'] != LEASED or (worker is not None and row['worker'] != worker):
+                return True
+            if row['attempts'] < self.max_attempts:
+                delay = rate_limit.backoff_delay(row['attempts'] - 1, base=RETRY_BASE, cap=RETRY_CAP)
+                conn.execute(
+                    'UPDATE tasks SET status = ?, error = ?, available_at = ?, leased_until = NULL WHERE id = ?',
+                    (PENDING, error, time.time() + delay, task_id)
+                )
+                return True
+            if self._finish_task(conn, task_id, FAILED, worker, error=error):
+                self._follow_up(conn, task_id, then)
+            return False
+
+    @staticmethod
+    def _finish_task(conn, task_id, status, worker=None, result=None, error=None, detail=None):
+        # seq numbers the job's finished tasks in the order they finished (writes are serialized by the write lock);
+        # only a leased task finishes, and only by its lease holder, so one redone after its lease ran out is not
+        # counted twice. Returns how many rows changed (0 or 1)
+        return conn.execute(
+            'UPDATE tasks SET status = ?, result = ?, error = COALESCE(?, error), detail = ?, leased_until = NULL,'
+            ' seq = (SELECT COALESCE(MAX(seq), 0) + 1 FROM tasks WHERE job_id = (SELECT job_id FROM tasks WHERE id = ?))'
+            ' WHERE id = ? AND status = ? AND worker = COALESCE(?, worker)',
+            (status, result, error, json.dumps(detail) if detail is not None else None, task_id, task_id, LEASED, worker)
+        ).rowcount
+
+    @staticmethod
+    def _follow_up(conn, task_id, then):
+        if then is None:
+            return
+        task = conn.execute('SELECT job_id, kind FROM tasks WHERE id = ?', (task_id,)).fetchone()
+        unfinished = conn.execute(
+            'SELECT COUNT(*) FROM tasks WHERE job_id = ? AND kind = ? AND status IN (?, ?)',
+            (task['job_id'], task['kind'], PENDING, LEASED)
+        ).fetchone()[0]
+        exists = conn.execute('SELECT 1 FROM tasks WHERE job_id = ? AND kind = ?', (task['job_id'], then[0])).fetchone()
+        if not unfinished and exists is None:
+            WorkQueue._insert_tasks(conn, task['job_id'], [then])
+
+    def task_counts(self, job_id, kind):
+        """{status: count} and {result: count} of the job's tasks of one kind"""
+        statuses, results = {}, {}
+        for row in self._conn().execute(
+            'SELECT status, result, COUNT(*) AS n FROM tasks WHERE job_id = ? AND kind = ? GROUP BY status, result', (job_id, kind)
+        ):
+            statuses[row['status']] = statuses.get(row['status'], 0) + row['n']
+            if row['result'] is not None:
+                results[row['result']] = results.get(row['result'], 0) + row['n']
+        return statuses, results
+
+    def finished(self, job_id, kind, after=0):
+        """The job's finished tasks of one kind with seq > after, in the order they finished"""
+        return [
+            {'seq': row['seq'], 'status': row['status'], 'result': row['result'],
+             'detail': json.loads(row['detail']) if row['detail'] is not None else None}
+            for row in self._conn().execute(
+                'SELECT seq, status, result, detail FROM tasks WHERE job_id = ? AND kind = ? AND seq > ? ORDER BY seq',
+                (job_id, kind, after)
+            )
+        ]
+
+    # worker metrics
+
+    def put_worker_metrics(self, worker, snapshot):
+        """Publish a worker process's metrics (JSON), so the web app can report the work done outside it"""
+        now = time.time()
+        with self._write() as conn:
+            conn.execute(
+                'INSERT INTO metrics (worker, snapshot, updated_at) VALUES (?, ?, ?) '
+                'ON CONFLICT(worker) DO UPDATE SET snapshot = excluded.snapshot, updated_at = excluded.updated_at',
+                (worker, json.dumps(snapshot), now)
+            )
+            conn.execute('DELETE FROM metrics WHERE updated_at < ?', (now - WORKER_METRICS_MAX_AGE,))
+
+    def worker_metrics(self, max_age=WORKER_METRICS_MAX_AGE):
+        """{worker: metrics} of every worker that published in the last max_age seconds"""
+        return {
+            row['worker']: json.loads(row['snapshot'])
+            for row in self._conn().execute(
+                'SELECT worker, snapshot FROM metrics WHERE updated_at >= ? ORDER BY worker', (time.time() - max_age,)
+            )
+        }
+
+    def stats(self):
+        conn = self._conn()
+        now = time.time()
+        jobs = {row['status']: row['n'] for row in conn.execute('SELECT status, COUNT(*) AS n FROM jobs GROUP BY status')}
+        tasks = {row['status']: row['n'] for row in conn.execute('SELECT status, COUNT(*) AS n FROM tasks GROUP BY status')}
+        oldest = conn.execute(
+            'SELECT MIN(available_at) FROM tasks WHERE status = ? AND available_at <= ?', (PENDING, now)
+        ).fetchone()[0]
+        expired = conn.execute('SELECT COUNT(*) FROM tasks WHERE status = ? AND leased_until < ?', (LEASED, now)).fetchone()[0]
+        return {
+            'jobs': jobs,
+            'tasks': tasks,
+            'oldest_ready_seconds': round(now - oldest, 1) if oldest else 0.0,
+            'expired_leases': expired,
+        }
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class _Transaction:
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+        return False
+
+
+def open_work_queue(path=None):
+    return WorkQueue(path or os.getenv('WORK_QUEUE_PATH', WORK_QUEUE_FILE))
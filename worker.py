@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Analysis worker for MusicAI
+Works through the analysis job queue (work_queue.db, see analysis_jobs.py) outside the web app.
+Run as many as the upstream limits allow, on the same disk as the web app; start the web app with
+ANALYSIS_EMBEDDED_WORKERS=0 to leave all the work to them.
+
+Usage: python worker.py [--batch 32] [--once]
+A worker that dies mid-job loses nothing: its leased tasks come back after WORK_QUEUE_VISIBILITY_SECONDS.
+"""
+
+import sys
+import signal
+import argparse
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run queued library analyses")
+    parser.add_argument('--batch', type=int, default=None, help="song tasks leased at once (default ANALYSIS_WORKER_BATCH or 32)")
+    parser.add_argument('--once', action='store_true', help="run one batch and exit")
+    args = parser.parse_args()
+
+    # the web app module holds the analysis pipeline, it only starts the server when run directly
+    import musicAI
+
+    options = {'batch': max(1, args.batch)} if args.batch else {}
+    # its cache hits and fills are published to the queue and added up on the web app's /admin/cache-stats
+    worker = musicAI.analysis_worker(metrics=musicAI.song_stages.metrics.snapshot, **options)
+    # docker stop / kill: finish the batch in hand, unfinished tasks go back when their lease runs out
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+
+    print(f"👷 Analysis worker {worker.name} started (batch {worker.batch})")
+    try:
+        if args.once:
+            print(f"   ran {worker.run_once()} task(s)")
+        else:
+            worker.run()
+    except KeyboardInterrupt:
+        print("\n⏸  Stopping, unfinished tasks return to the queue")
+        worker.stop()
+    finally:
+        # flush queued results to the store
+        musicAI.song_db.close()
+
+    print(f"✅ Worker {worker.name} stopped")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())